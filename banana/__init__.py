@@ -19,21 +19,43 @@ limitations under the License.
 
 from .__about__ import __version__, __authors__
 import os
+from importlib import import_module
+
+# The objects from Arcana used to design and apply Banana studies, along with
+# the BIDS dataset and Analysis classes, are accessible from the package root.
+# They are imported on first access (see __getattr__) so that importing
+# banana, e.g. by the command-line tool, doesn't import Arcana, Nipype and
+# PyBIDS unless they are required
+_LAZY_ATTRS = dict(
+    [(n, 'arcana') for n in (
+        'SubCompSpec', 'Parameter', 'ParamSpec', 'SwitchSpec', 'FileFormat',
+        'Fileset', 'FilesetSpec', 'FilesetFilter', 'InputFilesetSpec',
+        'OutputFilesetSpec', 'FilesetSlice', 'Field', 'FieldSpec',
+        'FieldFilter', 'InputFieldSpec', 'OutputFieldSpec', 'FieldSlice',
+        'SingleProc', 'MultiProc', 'StaticEnv', 'Dataset',
+        'ModulesEnv', 'LocalFileSystemRepo', 'XnatRepo')]
+    + [('SlurmProc', 'banana.processor')]
+    + [(n, 'banana.bids_') for n in ('BidsDataset', 'BidsRepo')]
+    + [(n, 'banana.analysis.base') for n in (
+        'Analysis', 'AnalysisMetaClass', 'MultiAnalysis',
+        'MultiAnalysisMetaClass')])
+
+
+def __getattr__(name):
+    try:
+        module_name = _LAZY_ATTRS[name]
+    except KeyError:
+        raise AttributeError(
+            "module 'banana' has no attribute '{}'".format(name))
+    value = getattr(import_module(module_name), name)
+    # Cache in the module namespace so __getattr__ isn't called again
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
 
-# Import all objects from Arcana used to design and apply Banana studies
-from arcana import (
-    SubCompSpec, Parameter, ParamSpec, SwitchSpec, FileFormat, Fileset,
-    FilesetSpec, FilesetFilter, InputFilesetSpec, OutputFilesetSpec,
-    FilesetSlice, Field, FieldSpec, FieldFilter, InputFieldSpec,
-    OutputFieldSpec, FieldSlice, SingleProc, MultiProc, SlurmProc, StaticEnv,
-    Dataset, ModulesEnv, LocalFileSystemRepo, XnatRepo)
-
-from .bids_ import BidsDataset
-
-
-# Import all Analysis classes into package root
-from .analysis.base import (
-    Analysis, AnalysisMetaClass, MultiAnalysis, MultiAnalysisMetaClass)
 
 # Should be set explicitly in all FSL interfaces, but this squashes the warning
 os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
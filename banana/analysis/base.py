@@ -1,10 +1,17 @@
 from copy import copy
+from itertools import chain
+from collections import defaultdict
+from arcana.exceptions import ArcanaError
 from arcana.analysis import (
     Analysis as ArcanaAnalysis, MultiAnalysis as ArcanaMultiAnalysis,
      AnalysisMetaClass, MultiAnalysisMetaClass)  # noqa: E501 @UnusedImport
 from banana.bids_ import BidsAssocInputs
+from banana.exceptions import BananaUsageError
 
 
+# Frequencies of the data that can be derived independently for each subject
+SUBJECT_FREQUENCIES = frozenset(('per_session', 'per_subject'))
+
 # Extend Arcana Analysis class to support implicit BIDS selectors
 
 # TODO: need to extend for MultiAnalysis's too
@@ -71,3 +78,133 @@ class Analysis(BidsMixin, ArcanaAnalysis):
 class MultiAnalysis(BidsMixin, ArcanaMultiAnalysis):
     pass
 
+
+def derive_batch(derivations, **kwargs):
+    """
+    Derives data from several analyses of the same dataset, submitting the
+    pipelines of all the analyses to the processor in a single run where
+    possible instead of running each analysis separately.
+
+    Arcana identifies the pipelines in a run by name, so analyses that
+    contain different pipelines with the same name (e.g. two analyses of
+    the same class) can't be run together. Such analyses are split into
+    separate runs, each containing the largest set of analyses whose
+    pipelines (including their prerequisites) have unique names.
+
+    Parameters
+    ----------
+    derivations : list[tuple(Analysis, list[str])]
+        The analyses and the names of the derivatives to generate from each
+    kwargs : dict
+        Keyword arguments passed to the processor's 'run' method (e.g.
+        'subject_ids', 'visit_ids')
+
+    Returns
+    -------
+    runs : list[list[Analysis]]
+        The groups of analyses that were run together
+    """
+    if len(set(id(a.dataset) for a, _ in derivations)) > 1:
+        raise BananaUsageError(
+            "All analyses derived in a batch need to share the same dataset")
+    batches = []
+    for analysis, names in derivations:
+        pipelines = _batch_pipelines(analysis, names)
+        if not pipelines:
+            continue
+        pipeline_names = set()
+        to_check = [p for p, _ in pipelines]
+        while to_check:
+            pipeline = to_check.pop()
+            if pipeline.name not in pipeline_names:
+                pipeline_names.add(pipeline.name)
+                to_check.extend(analysis.pipeline(g)
+                                for g in pipeline.prerequisites)
+        for batch in batches:
+            if not (batch['names'] & pipeline_names):
+                break
+        else:
+            batch = {'names': set(), 'analyses': [], 'pipelines': []}
+            batches.append(batch)
+        batch['names'] |= pipeline_names
+        batch['analyses'].append(analysis)
+        batch['pipelines'].extend(pipelines)
+    for batch in batches:
+        pipelines, required_outputs = zip(*batch['pipelines'])
+        batch['analyses'][0].processor.run(
+            *pipelines, required_outputs=required_outputs, **kwargs)
+    return [b['analyses'] for b in batches]
+
+
+def _batch_pipelines(analysis, names):
+    """
+    Returns the pipelines (and their required outputs) that need to be run
+    to derive the given specs of an analysis (as in Analysis.derive)
+    """
+    pipeline_getters = defaultdict(set)
+    for name in names:
+        spec = analysis.spec(name)
+        if spec.derived or spec.derivable:
+            pipeline_getters[(spec.pipeline_getter,
+                              spec.pipeline_args)].add(name)
+    try:
+        return [(analysis.pipeline(getter, pipeline_args=args), req_outs)
+                for (getter, args), req_outs in pipeline_getters.items()]
+    except ArcanaError as e:
+        e.msg += ", in order to derive '{}' in {}".format(
+            "', '".join(names), analysis)
+        raise e
+
+
+def shard_derivatives(analysis, names):
+    """
+    Determines which data need to be derived to generate the given
+    derivatives that can be derived independently for each subject, i.e. by
+    pipelines that (along with their prerequisites) don't join across
+    subjects or generate per-visit/per-dataset outputs. Used to split a
+    derivation into shards of subjects, the remaining pipelines being run
+    in a final reduction step over all subjects.
+
+    Parameters
+    ----------
+    analysis : Analysis
+        The analysis to derive the data from
+    names : list[str]
+        The names of the derivatives requested
+
+    Returns
+    -------
+    shard_names : list[str]
+        The names of the requested derivatives, or prerequisites of the
+        requested derivatives that join across subjects, that can be
+        derived within each shard
+    """
+    is_local = {}
+
+    def subject_local(pipeline):
+        if pipeline.name not in is_local:
+            is_local[pipeline.name] = (
+                not pipeline.joins_subjects
+                and pipeline.output_frequencies <= SUBJECT_FREQUENCIES
+                and all(subject_local(analysis.pipeline(g))
+                        for g in pipeline.prerequisites))
+        return is_local[pipeline.name]
+
+    shard_names = []
+    to_check = list(names)
+    checked = set()
+    while to_check:
+        name = to_check.pop(0)
+        if name in checked:
+            continue
+        checked.add(name)
+        spec = analysis.spec(name)
+        if not (spec.derived or spec.derivable):
+            continue
+        pipeline = analysis.pipeline(spec.pipeline_getter,
+                                     pipeline_args=spec.pipeline_args)
+        if subject_local(pipeline):
+            shard_names.append(name)
+        else:
+            to_check.extend(sorted(chain(*pipeline.prerequisites.values())))
+    return shard_names
@@ -29,6 +29,7 @@ from banana.file_format import (
     nifti_format, motion_mats_format, nifti_gz_format, custom_kspace_format,
     multi_nifti_gz_format, zip_format, text_matrix_format, STD_IMAGE_FORMATS,
     KSPACE_FORMATS, dicom_format, gif_format, nifti_gz_x_format)
+from banana.utils.image import PRECISIONS
 from banana.citation import fsl_cite, bet_cite, bet2_cite, ants_cite, spm_cite
 from banana.requirement import (
     fsl_req, mrtrix_req, ants_req, spm_req, c3d_req, matlab_req)
@@ -162,6 +163,12 @@ class MriAnalysis(Analysis, metaclass=AnalysisMetaClass):
                          desc=(""))]
 
     add_param_specs = [
+        SwitchSpec('precision', 'double', PRECISIONS,
+                   desc=("The precision that images are computed and stored "
+                         "in by interfaces that support it. 'single' halves "
+                         "the memory and disk usage of 'double', 'scaled' "
+                         "stores non-integer images as int16 with "
+                         "scl_slope/inter")),
         ParamSpec('grappa_acceleration', 2,
                   desc=("The amount of acceleration that should be used for "
                         "grappa reconstruction")),
@@ -158,7 +158,8 @@ class T2starAnalysis(MriAnalysis, metaclass=AnalysisMetaClass):
         # Combine channels to produce phase and magnitude images
         channel_combine = pipeline.add(
             'channel_combine',
-            HipCombineChannels(),
+            HipCombineChannels(
+                precision=self.parameter('precision')),
             inputs={
                 'channels_dir': ('channels', multi_nifti_gz_format),
                 'echo_times': ('echo_times', float)},
@@ -247,7 +248,8 @@ class T2starAnalysis(MriAnalysis, metaclass=AnalysisMetaClass):
         pipeline.add(
             'swi',
             Swi(
-                alpha=self.parameter('swi_power')),
+                alpha=self.parameter('swi_power'),
+                precision=self.parameter('precision')),
             inputs={
                 'tissue_phase': ('tissue_phase', nifti_gz_format),
                 'magnitude': ('magnitude', nifti_gz_format),
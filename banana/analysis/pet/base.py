@@ -10,11 +10,12 @@ import os
 from banana.requirement import fsl_req, mrtrix_req
 from banana.interfaces.pet import PreparePetDir
 from banana.interfaces.dicom import PetTimeInfo
-from arcana.analysis import ParamSpec
+from arcana.analysis import ParamSpec, SwitchSpec
 from banana.interfaces.pet import (
     PrepareUnlistingInputs, PETListModeUnlisting, SSRB, MergeUnlistingOutputs)
 from banana.requirement import stir_req
 from banana.exceptions import BananaUsageError
+from banana.utils.image import PRECISIONS
 
 
 template_path = os.path.abspath(
@@ -37,7 +38,11 @@ class PetAnalysis(Analysis, metaclass=AnalysisMetaClass):
                        ParamSpec('crop_ysize', 130),
                        ParamSpec('crop_zmin', 20),
                        ParamSpec('crop_zsize', 100),
-                       ParamSpec('image_orientation_check', False)]
+                       ParamSpec('image_orientation_check', False),
+                       SwitchSpec('precision', 'double', PRECISIONS,
+                                  desc=("The precision that images are "
+                                        "computed and stored in by "
+                                        "interfaces that support it"))]
 
     add_data_specs = [
         InputFilesetSpec('list_mode', list_mode_format),
@@ -83,7 +88,8 @@ class PetAnalysis(Analysis, metaclass=AnalysisMetaClass):
             'ICA',
             FastICA(
                 n_components=self.parameter('ica_n_components'),
-                ica_type=self.parameter('ica_type')),
+                ica_type=self.parameter('ica_type'),
+                precision=self.parameter('precision')),
             inputs={
                 'volume': ('registered_volumes', nifti_gz_format)},
             ouputs={
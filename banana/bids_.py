@@ -1,17 +1,23 @@
 import os
 import json
+import hashlib
+import tempfile
 import os.path as op
 import stat
 import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from bids.layout import BIDSLayout
 from arcana.exceptions import (
     ArcanaInputMissingMatchError, ArcanaUsageError)
 from banana.exceptions import BananaUsageError, BananaUnrecognisedBidsFormat
 from arcana.data.input import FilesetFilter
-from arcana.data.item import Fileset
+from arcana.data.item import Fileset, Field
+from arcana.pipeline.provenance import Record
 from arcana.utils import split_extension
 from arcana.repository import LocalFileSystemRepo, Dataset
 from arcana.analysis.multi import MultiAnalysis
+from banana.utils.bids_index import BidsIndex
 from banana.file_format import (
     nifti_gz_format, nifti_gz_x_format, fsl_bvecs_format, fsl_bvals_format,
     tsv_format, json_format, nifti_format)
@@ -40,12 +46,17 @@ class BidsRepo(LocalFileSystemRepo):
 
     Parameters
     ----------
-    root_dir : str
-        The path to the root of the BidsRepo
+    num_threads : int | None
+        The number of threads to scan the directories of separate subjects
+        with. Defaults to the ThreadPoolExecutor default
     """
 
     type = 'bids'
 
+    def __init__(self, num_threads=None):
+        super().__init__()
+        self.num_threads = num_threads
+
     def derivatives_dir(self, dataset):
         return op.join(dataset.name, 'derivatives')
 
@@ -56,9 +67,38 @@ class BidsRepo(LocalFileSystemRepo):
         """
         return op.join(self.derivatives_dir(dataset), '__metadata__')
 
+    def metadata_path(self, dataset, metadata):
+        """
+        The path of the file to write combined JSON side-car metadata to.
+        Side-cars are stored by the digest of their contents so files that
+        share the same metadata (e.g. across subjects and visits) share the
+        same file
+        """
+        digest = hashlib.sha256(
+            json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+        return op.join(self.metadata_dir(dataset), digest + '.json')
+
     def layout(self, dataset):
         return BIDSLayout(dataset.name)
 
+    def index(self, dataset, subject_ids=None):
+        """
+        Returns the persistent index of the files in the dataset (stored in
+        the metadata dir), refreshed to match the current state of the tree
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the index for
+        subject_ids : iterable[str] | None
+            If provided, only the directories of these subjects are rescanned
+            when refreshing the index
+        """
+        index = BidsIndex(dataset.name, op.join(self.metadata_dir(dataset),
+                                                'bids_index.sqlite'))
+        index.refresh(subject_ids=subject_ids, num_threads=self.num_threads)
+        return index
+
     def __repr__(self):
         return "BidsRepo()"
 
@@ -88,9 +128,9 @@ class BidsRepo(LocalFileSystemRepo):
             the repository
         """
         filesets = []
-        layout = self.layout(dataset)
-        all_subject_ids = set(layout.get_subjects())
-        all_visit_ids = set(layout.get_sessions())
+        index = self.index(dataset, subject_ids=subject_ids)
+        all_subject_ids = index.subject_ids()
+        all_visit_ids = index.session_ids()
         if subject_ids is None:
             subject_ids = all_subject_ids
         else:
@@ -104,66 +144,160 @@ class BidsRepo(LocalFileSystemRepo):
             dataset._depth = 1
         else:
             dataset._depth = 2
-        for item in layout.get(return_type='object'):
-            if item.path.startswith(self.derivatives_dir(dataset)):
-                # We handle derivatives using the LocalFileSystemRepo base
-                # class methods
-                continue
-            if not hasattr(item, 'entities') or not item.entities.get('suffix',
-                                                                      False):
+        # Combined side-car metadata and paths for each unique chain of
+        # side-cars
+        merged = {}
+        # Filter the files by subject and visit in the index query so that
+        # only the relevant parts of the tree are loaded
+        for path, entities in index.files(
+                subject_ids=subject_ids,
+                visit_ids=visit_ids if all_visit_ids else None):
+            if not entities['suffix']:
                 logger.warning("Skipping unrecognised file '{}' in BIDS tree"
-                               .format(op.join(item.dirname, item.filename)))
-                continue  # Ignore hidden file
-            try:
-                item_subject_ids = subject_ids & set(
-                    [item.entities['subject']])
-            except KeyError:
+                               .format(path))
+                continue
+            if entities.get('subject') is not None:
+                item_subject_ids = subject_ids & set([entities['subject']])
+            else:
                 # If item exists in top-levels of in the directory structure
                 # it is inferred to exist for all subjects in the tree
                 item_subject_ids = subject_ids
-            try:
-                item_visit_ids = visit_ids & set([item.entities['session']])
-            except KeyError:
+            if entities.get('session') is not None:
+                item_visit_ids = visit_ids & set([entities['session']])
+            else:
                 # If item exists in top-levels of in the directory structure
                 # it is inferred to exist for all visits in the tree
                 item_visit_ids = visit_ids
+            aux_files = {}
+            metadata = None
+            if item_subject_ids and item_visit_ids and not path.endswith(
+                    '.json'):
+                chain = index.sidecars(path, entities)
+                try:
+                    metadata_path, metadata = merged[chain]
+                except KeyError:
+                    metadata = index.merge_sidecars(chain)
+                    metadata_path = (self.metadata_path(dataset, metadata)
+                                     if metadata else None)
+                    merged[chain] = (metadata_path, metadata)
+                if metadata_path is not None:
+                    aux_files['json'] = metadata_path
             for subject_id in item_subject_ids:
                 for visit_id in item_visit_ids:
-                    aux_files = {}
-                    metadata = layout.get_metadata(item.path)
-                    if metadata and not item.path.endswith('.json'):
-                        # Write out the combined JSON side cars to a temporary
-                        # file to include in extended NIfTI filesets
-                        metadata_path = op.join(
-                            self.metadata_dir(dataset),
-                            'sub-{}'.format(subject_id),
-                            'ses-{}'.format(visit_id),
-                            item.filename + '.json')
-                        os.makedirs(op.dirname(metadata_path), exist_ok=True)
-                        if not op.exists(metadata_path):
-                            with open(metadata_path, 'w') as f:
-                                json.dump(metadata, f)
-                        aux_files['json'] = metadata_path
                     try:
                         fileset = BidsFileset(
-                            path=op.join(item.dirname, item.filename),
-                            type=item.entities['suffix'],
+                            path=path,
+                            type=entities['suffix'],
                             subject_id=subject_id, visit_id=visit_id,
                             dataset=dataset,
-                            modality=item.entities.get('modality', None),
-                            task=item.entities.get('task', None),
-                            aux_files=aux_files)
+                            modality=entities['datatype'],
+                            task=entities.get('task', None),
+                            aux_files=dict(aux_files),
+                            metadata=metadata if aux_files else None)
                     except BananaUnrecognisedBidsFormat:
                         pass
                     else:
                         filesets.append(fileset)
-        # Get derived filesets, fields and records using the same method using
-        # the method in the LocalFileSystemRepo base class
-        derived_filesets, fields, records = super().find_data(
+        derived_filesets, fields, records = self._find_derived_data(
             dataset, subject_ids=subject_ids, visit_ids=visit_ids)
         filesets.extend(derived_filesets)
         return filesets, fields, records
 
+    def _find_derived_data(self, dataset, subject_ids, visit_ids):
+        """
+        Finds the derived filesets, fields and provenance records in the
+        derivatives directory. Equivalent to the find_data method of the
+        LocalFileSystemRepo base class, except that only the derivatives
+        directory is walked and the directories of each analysis/subject are
+        walked concurrently
+        """
+        subject_dirs = []
+        derivatives_dir = self.derivatives_dir(dataset)
+        if op.isdir(derivatives_dir):
+            for analysis_name in sorted(os.listdir(derivatives_dir)):
+                analysis_dir = op.join(derivatives_dir, analysis_name)
+                if (analysis_name.startswith('.')
+                        or analysis_dir == self.metadata_dir(dataset)
+                        or not op.isdir(analysis_dir)):
+                    continue
+                for subj_dname in sorted(os.listdir(analysis_dir)):
+                    subj_id = subj_dname[len('sub-'):]
+                    if (subj_dname.startswith('sub-')
+                            and (subj_id == self.SUMMARY_NAME
+                                 or subj_id in subject_ids)):
+                        subject_dirs.append(op.join(analysis_dir, subj_dname))
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            results = list(executor.map(
+                partial(self._scan_derived_subject, dataset,
+                        visit_ids=visit_ids), subject_dirs))
+        filesets = []
+        fields = []
+        records = []
+        for subj_filesets, subj_fields, subj_records in results:
+            filesets.extend(subj_filesets)
+            fields.extend(subj_fields)
+            records.extend(subj_records)
+        return filesets, fields, records
+
+    def _scan_derived_subject(self, dataset, subject_dir, visit_ids):
+        filesets = []
+        fields = []
+        records = []
+        for session_path, dirs, files in os.walk(subject_dir):
+            path_parts = op.relpath(session_path, dataset.name).split(op.sep)
+            ids = self._extract_ids_from_path(dataset.depth, path_parts, dirs,
+                                              files)
+            if ids is None:
+                continue
+            subj_id, visit_id, from_analysis = ids
+            if subj_id == self.SUMMARY_NAME:
+                subj_id = None
+            if visit_id == self.SUMMARY_NAME:
+                visit_id = None
+            elif visit_ids is not None and visit_id not in visit_ids:
+                continue
+            subj_id = dataset.map_subject_id(subj_id)
+            visit_id = dataset.map_visit_id(visit_id)
+            if (subj_id, visit_id) == (None, None):
+                frequency = 'per_dataset'
+            elif subj_id is None:
+                frequency = 'per_visit'
+            elif visit_id is None:
+                frequency = 'per_subject'
+            else:
+                frequency = 'per_session'
+            filtered_files = self._filter_files(files, session_path)
+            for fname in filtered_files:
+                basename = split_extension(fname)[0]
+                filesets.append(Fileset.from_path(
+                    op.join(session_path, fname), frequency=frequency,
+                    subject_id=subj_id, visit_id=visit_id, dataset=dataset,
+                    from_analysis=from_analysis,
+                    potential_aux_files=[
+                        f for f in filtered_files
+                        if split_extension(f)[0] == basename and f != fname]))
+            for fname in self._filter_dirs(dirs, session_path):
+                filesets.append(Fileset.from_path(
+                    op.join(session_path, fname), frequency=frequency,
+                    subject_id=subj_id, visit_id=visit_id, dataset=dataset,
+                    from_analysis=from_analysis))
+            if self.FIELDS_FNAME in files:
+                with open(op.join(session_path, self.FIELDS_FNAME)) as f:
+                    dct = json.load(f)
+                fields.extend(
+                    Field(name=k, value=v, frequency=frequency,
+                          subject_id=subj_id, visit_id=visit_id,
+                          dataset=dataset, from_analysis=from_analysis)
+                    for k, v in dct.items())
+            if self.PROV_DIR in dirs:
+                base_prov_dir = op.join(session_path, self.PROV_DIR)
+                for fname in os.listdir(base_prov_dir):
+                    records.append(Record.load(
+                        split_extension(fname)[0], frequency, subj_id,
+                        visit_id, from_analysis,
+                        op.join(base_prov_dir, fname)))
+        return filesets, fields, records
+
     def fileset_path(self, fileset, dataset=None, fname=None):
         if not fileset.derived:
             raise ArcanaUsageError(
@@ -288,10 +422,16 @@ class BidsFileset(Fileset, BaseBidsFileset):
     aux_files : dict[str, str]
         A dictionary containing a mapping from a side car name to path of the
         file
+    metadata : dict[str, *] | None
+        The combined JSON side-car metadata of the fileset. If provided, it is
+        written to the 'json' aux file the first time the aux files are
+        accessed (if the file doesn't already exist)
     """
 
     def __init__(self, path, type, subject_id, visit_id, dataset,
-                 modality=None, task=None, checksums=None, aux_files=None):
+                 modality=None, task=None, checksums=None, aux_files=None,
+                 metadata=None):
+        self._metadata = metadata
         Fileset.__init__(
             self,
             name=op.basename(path),
@@ -305,6 +445,34 @@ class BidsFileset(Fileset, BaseBidsFileset):
             aux_files=aux_files)
         BaseBidsFileset.__init__(self, type, modality, task)
 
+    def aux_file(self, name):
+        self._write_metadata()
+        return super().aux_file(name)
+
+    @property
+    def aux_files(self):
+        self._write_metadata()
+        return super().aux_files
+
+    def _write_metadata(self):
+        """
+        Writes the combined JSON side-car to its (content-addressed) path if
+        it hasn't been written already
+        """
+        if self._metadata is None:
+            return
+        metadata_path = self._aux_files['json']
+        if not op.exists(metadata_path):
+            metadata_dir = op.dirname(metadata_path)
+            os.makedirs(metadata_dir, exist_ok=True)
+            # Write to a temporary file and rename so that concurrent readers
+            # never see a partially written side-car
+            fd, tmp_path = tempfile.mkstemp(dir=metadata_dir, suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._metadata, f)
+            os.replace(tmp_path, metadata_path)
+        self._metadata = None
+
     def __repr__(self):
         return ("{}(type={}, task={}, modality={}, format={}, subj={}, vis={})"
                 .format(self.__class__.__name__, self.type, self.task,
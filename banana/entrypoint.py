@@ -1,21 +1,23 @@
 import sys
 import os.path as op
 import os
-from argparse import ArgumentParser
+import json
+import math
+import time
+import shlex
+import textwrap
+import subprocess as sp
+from argparse import ArgumentParser, SUPPRESS
 from importlib import import_module
-from setuptools import find_packages
-from pkgutil import iter_modules
 from multiprocessing import cpu_count
-from arcana.utils import parse_value
-from banana.utils.testing import AnalysisTester, PipelineTester
-from banana.exceptions import BananaUsageError
-from banana import (
-    FilesetFilter, FieldFilter, MultiProc, SingleProc, SlurmProc, StaticEnv,
-    ModulesEnv, LocalFileSystemRepo, BidsDataset, XnatRepo, Analysis,
-    MultiAnalysis, Dataset)
 import logging
-from arcana.utils import wrap_text
 from banana.__about__ import __version__
+from banana.registry import AnalysisRegistry
+
+# NB: Arcana, Nipype and the rest of Banana are imported within the 'run'
+# methods of the commands that need them, so that the tool starts up quickly
+# for commands that don't (e.g. 'help'). This is checked by the import-time
+# benchmark in test/unittests/test_entrypoint.py
 
 logger = logging.getLogger('banana')
 
@@ -25,6 +27,17 @@ DEFAULT_LINE_LENGTH = 79
 DEFAULT_INDENT = 4
 DEFAULT_SPACER = 4
 
+# The modes subjects can be sharded across when using the '--shards' option
+SHARD_MODES = ('local', 'slurm')
+# Shell variable that expands to the index of a job within a SLURM job array
+SLURM_ARRAY_INDEX = '${SLURM_ARRAY_TASK_ID}'
+# The default number of CPUs, the memory (GB) per CPU if it can't be
+# estimated from the run history and the wall time (minutes) requested for
+# each SLURM job when submitting shards
+SHARD_CPUS = 4
+SHARD_MEM_GB_PER_CPU = 4.0
+SHARD_WALL_TIME = 24 * 60
+
 
 def set_loggers(loggers):
 
@@ -40,10 +53,35 @@ def set_loggers(loggers):
         logger.addHandler(handler)
 
 
+def wrap_text(text, line_length, indent):
+    """
+    Wraps a text block to the specified line-length, without breaking across
+    words, using the specified indent to join the lines (equivalent to
+    arcana.utils.wrap_text, which would require Arcana to be imported)
+    """
+    return ('\n' + ' ' * indent).join(
+        textwrap.wrap(text, line_length - indent, break_long_words=False))
+
+
 def resolve_class(class_str, prefixes=(DEFAULT_STUDY_CLASS_PATH,)):
     """
-    Resolves a class from the '.' delimted module + class name string
+    Resolves a class from the '.' delimted module + class name string. The
+    analysis class registry is checked first so that only the module that
+    defines the class is imported, falling back to importing the module
+    path directly for classes that aren't in the registry
     """
+    from banana.exceptions import BananaUsageError
+    registry = AnalysisRegistry(prefixes)
+    for prefix in [None] + list(prefixes):
+        full_str = (prefix + '.' + class_str) if prefix else class_str
+        matches = registry.find(full_str)
+        if len(matches) == 1:
+            try:
+                return getattr(import_module(matches[0].module),
+                               matches[0].name)
+            except (ImportError, AttributeError):
+                # Fall back to resolving the class by importing the path
+                break
     parts = class_str.split('.')
     module_name = '.'.join(parts[:-1])
     class_name = parts[-1]
@@ -73,6 +111,35 @@ def resolve_class(class_str, prefixes=(DEFAULT_STUDY_CLASS_PATH,)):
     return cls
 
 
+def shard_subjects(subject_ids, num_shards):
+    """
+    Splits a list of subject IDs into (at most) 'num_shards' contiguous
+    shards of near equal size
+
+    Parameters
+    ----------
+    subject_ids : list[str]
+        The subject IDs to split
+    num_shards : int
+        The number of shards to split them into
+
+    Returns
+    -------
+    shards : list[list[str]]
+        The subject IDs in each shard. Fewer than 'num_shards' shards are
+        returned if there are fewer subjects than shards
+    """
+    num_shards = min(num_shards, len(subject_ids))
+    size, remainder = divmod(len(subject_ids), max(num_shards, 1))
+    shards = []
+    start = 0
+    for i in range(num_shards):
+        end = start + size + (1 if i < remainder else 0)
+        shards.append(list(subject_ids[start:end]))
+        start = end
+    return shards
+
+
 class DeriveCmd():
 
     desc = "Generate derivatives from a Banana Analysis class"
@@ -92,6 +159,54 @@ class DeriveCmd():
                                   "under (e.g. parenthood)"))
         parser.add_argument('derivatives', nargs='+',
                             help=("The names of the derivatives to generate"))
+        cls.add_options(parser)
+        parser.add_argument('--shards', nargs='+', default=None,
+                            metavar='ARG',
+                            help=(
+                                "Split the subjects into NUM shards that are "
+                                "processed independently, followed by a "
+                                "reduction step over all subjects that runs "
+                                "the pipelines that join across subjects. "
+                                "Takes the form NUM [MODE], where MODE is "
+                                "either 'local' (default), which runs the "
+                                "shards in NUM worker processes using the "
+                                "'--processor' option, or 'slurm', which "
+                                "submits the shards as a SLURM job array "
+                                "(and the reduction step as a dependent job)"
+                                " using the account and partition passed to "
+                                "'--processor slurm', with each job "
+                                "processing its shard with a 'multi' "
+                                "processor (see '--shard_cpus', "
+                                "'--shard_mem' and '--shard_wall_time')"))
+        parser.add_argument('--shard_cpus', type=int, default=SHARD_CPUS,
+                            metavar='N',
+                            help=("The number of CPUs requested for each "
+                                  "SLURM job when submitting shards, which "
+                                  "is also the number of processes used by "
+                                  "its 'multi' processor (default: {})"
+                                  .format(SHARD_CPUS)))
+        parser.add_argument('--shard_mem', type=float, default=None,
+                            metavar='GB',
+                            help=("The memory requested for each SLURM job "
+                                  "when submitting shards. Defaults to the "
+                                  "peak memory of the nodes recorded in the "
+                                  "run history (see '--history') for each "
+                                  "CPU, or {} GB per CPU if none have been "
+                                  "recorded".format(SHARD_MEM_GB_PER_CPU)))
+        parser.add_argument('--shard_wall_time', type=int,
+                            default=SHARD_WALL_TIME, metavar='MINUTES',
+                            help=("The wall time requested for each SLURM "
+                                  "job when submitting shards (default: {})"
+                                  .format(SHARD_WALL_TIME)))
+        # Used internally to run the derivatives of a single shard
+        parser.add_argument('--shard', type=int, default=None, help=SUPPRESS)
+        return parser
+
+    @classmethod
+    def add_options(cls, parser):
+        """
+        Adds the options shared by the 'derive' and 'derive-batch' commands
+        """
         parser.add_argument('--dataset', nargs='+', default=['bids'],
                             metavar='ARG',
                             help=("Specify the dataset type and any options"
@@ -134,6 +249,12 @@ class DeriveCmd():
                                   "If a single value with a '/' in it is "
                                   "provided then it is interpreted as a text "
                                   "file containing a list of IDs"))
+        parser.add_argument('--scan_threads', type=int, default=None,
+                            metavar='N',
+                            help=("The number of threads used to scan the "
+                                  "subject directories of BIDS datasets. "
+                                  "Only the directories of the subjects in "
+                                  "'--subject_ids' are scanned"))
         parser.add_argument('--scratch', type=str, default=None,
                             metavar='PATH',
                             help=("The scratch directory to use for the "
@@ -141,6 +262,50 @@ class DeriveCmd():
         parser.add_argument('--cache', nargs='+', default=(), metavar='SPEC',
                             help=("Input filesets to cache locally before "
                                   "running workflows"))
+        parser.add_argument('--conversion_cache_size', type=float,
+                            default=None, metavar='GB',
+                            help=("The maximum size of the cache of format "
+                                  "conversions (e.g. DICOM->NIfTI) shared "
+                                  "between analyses in the scratch directory"))
+        parser.add_argument('--no_conversion_cache', action='store_true',
+                            default=False,
+                            help=("Don't reuse format conversions from other "
+                                  "analyses/runs"))
+        parser.add_argument('--compression_level', type=int, default=None,
+                            choices=range(10), metavar='LEVEL',
+                            help=("The gzip compression level (0-9) of "
+                                  "'.nii.gz' images written by interfaces. "
+                                  "0 writes uncompressed blocks, which is "
+                                  "fastest when running in scratch space"))
+        parser.add_argument('--compression_threads', type=int, default=None,
+                            metavar='N',
+                            help=("The number of threads used to compress "
+                                  "'.nii.gz' images written by interfaces "
+                                  "(defaults to the number of CPUs)"))
+        parser.add_argument('--redetect_requirements', action='store_true',
+                            default=False,
+                            help=("Clear the cache of detected versions of "
+                                  "the software requirements so they are "
+                                  "detected again, e.g. after software has "
+                                  "been updated in place"))
+        parser.add_argument('--history', default=None, metavar='PATH',
+                            help=(
+                                "Path to the file the resources used by the "
+                                "nodes of previous runs are recorded in, "
+                                "which is used to estimate the wall time and "
+                                "memory to request for SLURM jobs. Defaults "
+                                "to the value of the BANANA_RUN_HISTORY "
+                                "environment variable or 'run-history.jsonl' "
+                                "in the scratch directory"))
+        parser.add_argument('--profile', nargs='?', const='', default=None,
+                            metavar='PATH',
+                            help=("Record the wall time, CPU time, peak "
+                                  "memory and I/O of each node run in a "
+                                  "JSON-lines file (defaults to a file named "
+                                  "after the analysis in 'profiles' in the "
+                                  "scratch directory), print a summary of "
+                                  "each pipeline afterwards and add the "
+                                  "records to the run history"))
         parser.add_argument('--enforce_inputs', action='store_true',
                             default=False,
                             help=("Whether to enforce inputs for non-optional "
@@ -162,25 +327,387 @@ class DeriveCmd():
                             help=("Disable logging output"))
         parser.add_argument('--bids_task', default=None,
                             help=("A task to use to filter the BIDS inputs"))
-        return parser
 
     @classmethod
     def run(cls, args):
-
         if not args.quiet:
             set_loggers(args.logger)
 
         analysis_class = resolve_class(args.analysis_class)
 
-        if args.scratch is not None:
-            scratch_dir = args.scratch
+        dataset, input_dataset, processor, environment = cls.setup(args)
+
+        analysis = cls.init_analysis(
+            analysis_class, args.analysis_name, args, dataset=dataset,
+            input_dataset=input_dataset, processor=processor,
+            environment=environment, inputs=args.input,
+            parameters=args.parameter, cache=args.cache,
+            bids_task=args.bids_task)
+
+        if args.shard is not None:
+            from banana.analysis.base import shard_derivatives
+            # Only derive the data that can be generated independently for
+            # each subject, leaving the joins to the reduction step
+            derivatives = shard_derivatives(analysis, args.derivatives)
+            if derivatives:
+                analysis.derive(derivatives)
+            logger.info("Generated derivatives for '{}' in shard {}"
+                        .format(derivatives, args.shard))
+            return
+        elif args.shards is not None:
+            tree = (input_dataset if input_dataset is not None
+                    else dataset).tree
+            if cls.run_shards(args, sorted(tree.subject_ids)):
+                # Submitted to SLURM, which will run the reduction step
+                return
+            # The tree was read and the specs bound before the workers were
+            # started, so the caches need to be cleared for the reduction
+            # step to see the derivatives generated by the shards
+            analysis.clear_caches()
+            if input_dataset is not None:
+                input_dataset.clear_cache()
+
+        # Generate data
+        analysis.derive(args.derivatives)
+
+        logger.info("Generated derivatives for '{}'".format(args.derivatives))
+
+        cls.report_profile(args, environment)
+
+    @classmethod
+    def report_profile(cls, args, environment):
+        """
+        Prints a summary of the resources used by each pipeline if the run
+        was profiled and adds the records to the run history
+        """
+        profile_path = getattr(environment, 'profile_path', None)
+        if profile_path is None:
+            return
+        from banana.utils.history import RunHistory
+        from banana.utils.telemetry import (
+            read_profile, summarise_profile, format_profile_summary,
+            history_records)
+        records = read_profile(profile_path)
+        if not records:
+            logger.info("No nodes were run so no resources were recorded in "
+                        "'{}'".format(profile_path))
+            return
+        print(format_profile_summary(summarise_profile(records)))
+        num_added = RunHistory(cls.history_path(args)).add(
+            history_records(records, profile_path))
+        logger.info("Recorded resources used by {} nodes in '{}' ({} added "
+                    "to the run history)".format(len(records), profile_path,
+                                                 num_added))
+
+    @classmethod
+    def run_shards(cls, args, subject_ids):
+        """
+        Runs the subject-level derivatives of each shard of subjects in
+        separate worker processes or submits them as a SLURM job array (along
+        with a dependent reduction job)
+
+        Parameters
+        ----------
+        args : argparse.Namespace
+            The parsed arguments of the command
+        subject_ids : list[str]
+            The IDs of the subjects to shard
+
+        Returns
+        -------
+        submitted : bool
+            Whether the shards (and the reduction step) were submitted to
+            SLURM instead of being run locally
+        """
+        from banana.exceptions import BananaUsageError
+        try:
+            num_shards = int(args.shards[0])
+            mode = args.shards[1] if len(args.shards) > 1 else 'local'
+        except ValueError:
+            num_shards = 0
+        if num_shards < 1 or len(args.shards) > 2 or mode not in SHARD_MODES:
+            raise BananaUsageError(
+                "Unrecognised arguments passed to '--shards' option ({}), "
+                "expected NUM [MODE], where NUM is a positive integer and "
+                "MODE is one of '{}'".format(args.shards,
+                                             "', '".join(SHARD_MODES)))
+        shards = shard_subjects(subject_ids, num_shards)
+        shard_dir = op.abspath(op.join(cls.scratch_dir(args), 'shards',
+                                       args.analysis_name))
+        os.makedirs(shard_dir, exist_ok=True)
+        for i, shard in enumerate(shards):
+            with open(op.join(shard_dir, 'shard-{}.txt'.format(i)), 'w') as f:
+                f.write('\n'.join(shard) + '\n')
+        if mode == 'slurm':
+            cls.submit_shards(args, len(shards), shard_dir)
+            return True
+        processor = list(args.processor)
+        if processor == ['multi']:
+            # Share the available CPUs between the workers
+            processor.append(str(max(cpu_count() // len(shards), 1)))
+        workers = []
+        for i in range(len(shards)):
+            argv = cls.shard_argv(args, i, shard_dir, processor=processor)
+            with open(op.join(shard_dir, 'shard-{}.log'.format(i)), 'w') as f:
+                workers.append(sp.Popen(argv, stdout=f, stderr=sp.STDOUT))
+            logger.info("Started worker for shard {} ({} subjects)"
+                        .format(i, len(shards[i])))
+        failed = [i for i, w in enumerate(workers) if w.wait()]
+        if failed:
+            raise BananaUsageError(
+                "Shards {} failed, see the logs in '{}'".format(failed,
+                                                               shard_dir))
+        return False
+
+    @classmethod
+    def submit_shards(cls, args, num_shards, shard_dir):
+        """
+        Submits the shards as a SLURM job array and the reduction step as a
+        job that depends on the successful completion of the array
+        """
+        from banana.exceptions import BananaUsageError
+        if len(args.processor) > 1 and args.processor[0] == 'slurm':
+            slurm_args = args.processor[1:]
         else:
-            scratch_dir = op.join(op.expanduser('~'), 'banana-scratch')
+            slurm_args = []
+        email = args.email if args.email is not None else os.environ.get(
+            'EMAIL')
+        header = ['#!/bin/bash']
+        if slurm_args:
+            header.append('#SBATCH --account={}'.format(slurm_args[0]))
+        if len(slurm_args) > 1:
+            header.append('#SBATCH --partition={}'.format(slurm_args[1]))
+        if email is not None:
+            header.extend(['#SBATCH --mail-user={}'.format(email),
+                           '#SBATCH --mail-type=FAIL'])
+        cpus, mem_gb = cls.shard_resources(args)
+        header.extend([
+            '#SBATCH --cpus-per-task={}'.format(cpus),
+            '#SBATCH --mem={}M'.format(int(math.ceil(mem_gb * 1000))),
+            '#SBATCH --time={}'.format(args.shard_wall_time)])
+        processor = ['multi', str(cpus)]
+        # The shell expands the array index in the arguments of each job
+        array_script = op.join(shard_dir, 'shards.sh')
+        with open(array_script, 'w') as f:
+            f.write('\n'.join(header + [
+                '#SBATCH --job-name={}-shards'.format(args.analysis_name),
+                '#SBATCH --array=0-{}'.format(num_shards - 1),
+                '#SBATCH --output={}'.format(
+                    op.join(shard_dir, 'shard-%a.log')),
+                cls.shard_argv(args, SLURM_ARRAY_INDEX, shard_dir,
+                               processor=processor, as_str=True)]) + '\n')
+        reduce_script = op.join(shard_dir, 'reduce.sh')
+        with open(reduce_script, 'w') as f:
+            f.write('\n'.join(header + [
+                '#SBATCH --job-name={}-reduce'.format(args.analysis_name),
+                '#SBATCH --output={}'.format(
+                    op.join(shard_dir, 'reduce.log')),
+                cls.shard_argv(args, None, shard_dir, processor=processor,
+                               as_str=True)]) + '\n')
+        try:
+            array_id = sp.check_output(
+                ['sbatch', '--parsable', array_script]).decode().strip()
+            reduce_id = sp.check_output(
+                ['sbatch', '--parsable',
+                 '--dependency=afterok:{}'.format(array_id.split(';')[0]),
+                 reduce_script]).decode().strip()
+        except (OSError, sp.CalledProcessError) as e:
+            raise BananaUsageError(
+                "Could not submit shard jobs in '{}' to SLURM ({})"
+                .format(shard_dir, e))
+        logger.info("Submitted {} shards as SLURM job array {} with reduction "
+                    "job {}".format(num_shards, array_id, reduce_id))
+
+    @classmethod
+    def shard_resources(cls, args):
+        """
+        Determines the number of CPUs and memory to request for each SLURM
+        job when submitting shards. Unless set explicitly, the memory is
+        estimated from the peak memory of the nodes recorded in the run
+        history, as each of the CPUs can run one of them at a time
+
+        Parameters
+        ----------
+        args : argparse.Namespace
+            The parsed arguments of the command
+
+        Returns
+        -------
+        cpus : int
+            The number of CPUs to request
+        mem_gb : float
+            The memory to request in GB
+        """
+        from banana.exceptions import BananaUsageError
+        from banana.processor import SlurmProc
+        from banana.utils.history import RunHistory
+        cpus = args.shard_cpus
+        if cpus < 1:
+            raise BananaUsageError(
+                "Number of CPUs passed to '--shard_cpus' must be positive "
+                "({})".format(cpus))
+        if args.shard_mem is not None:
+            return cpus, args.shard_mem
+        mems = [e.mem_gb for e in RunHistory(
+            cls.history_path(args)).estimates().values()
+            if e.mem_gb is not None]
+        if not mems:
+            return cpus, cpus * SHARD_MEM_GB_PER_CPU
+        # Use the same margin as the SLURM processor does for single nodes
+        return cpus, cpus * max(max(mems) * SlurmProc.MEM_MARGIN,
+                                SlurmProc.MIN_MEM_GB)
+
+    @classmethod
+    def shard_argv(cls, args, shard, shard_dir, processor, as_str=False):
+        """
+        Builds the command line that runs a single shard of the derivation
+        (or the reduction step if 'shard' is None) from the parsed arguments
+
+        Parameters
+        ----------
+        args : argparse.Namespace
+            The parsed arguments of the command
+        shard : int | str | None
+            The index of the shard (or a shell variable that expands to it)
+        shard_dir : str
+            The directory containing the subject IDs of each shard
+        processor : list[str]
+            The arguments to pass to the '--processor' option
+        as_str : bool
+            Whether to return the command as a string for a shell script
+
+        Returns
+        -------
+        argv : list[str] | str
+            The command line
+        """
+        overrides = {'shards': None, 'processor': processor, 'shard': None,
+                     'shard_cpus': None, 'shard_mem': None,
+                     'shard_wall_time': None}
+        if shard is not None:
+            overrides['subject_ids'] = [
+                op.join(shard_dir, 'shard-{}.txt'.format(shard))]
+        argv = [sys.executable, '-m', 'banana.entrypoint', 'derive']
+        for action in cls.parser()._actions:
+            if action.dest == 'help':
+                continue
+            value = overrides.get(action.dest, getattr(args, action.dest))
+            if action.option_strings:
+                option = action.option_strings[0]
+                if value is None or value == action.default:
+                    continue
+                elif action.nargs == 0:
+                    argv.append(option)
+                elif action.nargs == '?':
+                    argv.extend([option] + ([str(value)] if value else []))
+                elif action.nargs == '+':
+                    argv.extend([option] + [str(v) for v in value])
+                elif action.nargs is not None:  # appended tuples
+                    for vals in value:
+                        argv.extend([option] + [str(v) for v in vals])
+                else:
+                    argv.extend([option, str(value)])
+            elif action.nargs == '+':
+                argv.extend(value)
+            else:
+                argv.append(value)
+        if shard is not None:
+            argv.extend(['--shard', str(shard)])
+        if as_str:
+            # Double-quote the arguments containing the array index so that
+            # the shell expands it
+            return ' '.join(
+                '"{}"'.format(a) if SLURM_ARRAY_INDEX in a
+                else shlex.quote(a) for a in argv)
+        return argv
+
+    @staticmethod
+    def scratch_dir(args):
+        if args.scratch is not None:
+            return args.scratch
+        return op.join(op.expanduser('~'), 'banana-scratch')
+
+    @classmethod
+    def history_path(cls, args):
+        if args.history is not None:
+            return args.history
+        # Same as banana.utils.history.RUN_HISTORY_ENV, which isn't imported
+        # here as it would import Arcana
+        return os.environ.get('BANANA_RUN_HISTORY', op.join(
+            cls.scratch_dir(args), 'run-history.jsonl'))
+
+    @classmethod
+    def setup(cls, args):
+        """
+        Configures the scratch directory and creates the dataset, processor
+        and environment from the command-line arguments
+
+        Returns
+        -------
+        dataset : Dataset
+            The dataset to store the derivatives in
+        input_dataset : Dataset | None
+            The dataset to read the inputs from if different to 'dataset'
+        processor : Processor
+            The processor to run the pipelines with
+        environment : Environment
+            The environment to run the pipelines in
+        """
+        from banana.exceptions import BananaUsageError
+        from banana.utils.cache import (
+            CONVERSION_CACHE_ENV, CONVERSION_CACHE_SIZE_ENV)
+        from banana.utils.dicom import DICOM_INDEX_CACHE_ENV
+        from banana.requirement import requirement_cache
+        from banana.utils.history import RunHistory
+        from banana.utils.telemetry import (
+            ProfiledStaticEnv, ProfiledModulesEnv)
+        from banana.utils.image import (
+            COMPRESSION_LEVEL_ENV, COMPRESSION_THREADS_ENV)
+        from banana import (
+            MultiProc, SingleProc, SlurmProc, StaticEnv, ModulesEnv,
+            BidsDataset, BidsRepo, XnatRepo, Dataset)
+
+        scratch_dir = cls.scratch_dir(args)
 
         # Ensure scratch dir exists
         os.makedirs(scratch_dir, exist_ok=True)
 
         work_dir = op.join(scratch_dir, 'work')
+        if getattr(args, 'shard', None) is not None:
+            # Shards running concurrently need separate working directories
+            work_dir = op.join(work_dir, 'shard-{}'.format(args.shard))
+
+        # Converters pick up the conversion cache from the environment so that
+        # it is also used by nodes run in separate processes/jobs
+        if not args.no_conversion_cache:
+            os.environ.setdefault(CONVERSION_CACHE_ENV,
+                                  op.join(scratch_dir, 'conversion-cache'))
+            if args.conversion_cache_size is not None:
+                os.environ[CONVERSION_CACHE_SIZE_ENV] = str(
+                    args.conversion_cache_size)
+        else:
+            os.environ.pop(CONVERSION_CACHE_ENV, None)
+        # Likewise for the compression settings of images written by
+        # interfaces and the indices of DICOM series headers
+        if args.compression_level is not None:
+            os.environ[COMPRESSION_LEVEL_ENV] = str(args.compression_level)
+        if args.compression_threads is not None:
+            os.environ[COMPRESSION_THREADS_ENV] = str(
+                args.compression_threads)
+        os.environ.setdefault(DICOM_INDEX_CACHE_ENV,
+                              op.join(scratch_dir, 'dicom-index'))
+        if args.redetect_requirements:
+            requirement_cache().clear()
+        if args.profile is not None:
+            if not args.profile:
+                args.profile = op.join(
+                    scratch_dir, 'profiles', '{}-{}.jsonl'.format(
+                        getattr(args, 'analysis_name', 'batch'),
+                        time.strftime('%Y%m%d-%H%M%S')))
+            # Resolve the path of the profile so that the shards of the run
+            # (which are passed the same arguments) append to the same file
+            args.profile = op.abspath(args.profile)
+            os.makedirs(op.dirname(args.profile), exist_ok=True)
 
         if args.dataset is None:
             if args.input:
@@ -213,7 +740,10 @@ class DeriveCmd():
             if dataset_type == 'bids':
                 if create_root:
                     os.makedirs(dataset_path, exist_ok=True)
-                dataset = BidsDataset(dataset_path, **kwargs)
+                dataset = BidsDataset(
+                    dataset_path,
+                    repository=BidsRepo(num_threads=args.scan_threads),
+                    **kwargs)
             elif dataset_type == 'basic':
                 if len(dataset_args) != 1:
                     raise BananaUsageError(
@@ -324,57 +854,303 @@ class DeriveCmd():
                 work_dir, account=(args.processor[1] if nargs >= 2 else None),
                 partition=(args.processor[2] if nargs >= 3 else None),
                 email=email, mail_on=('FAIL',),
-                **proc_args)
+                history=RunHistory(cls.history_path(args)), **proc_args)
         else:
             raise BananaUsageError(
                 "Unrecognised processor type provided as first argument to "
                 "'--processor' option ({})".format(args.processor[0]))
 
-        if args.environment == 'static':
+        if args.profile is not None:
+            if args.environment == 'static':
+                environment = ProfiledStaticEnv(args.profile)
+            else:
+                environment = ProfiledModulesEnv(args.profile)
+        elif args.environment == 'static':
             environment = StaticEnv()
         else:
             environment = ModulesEnv()
 
-        parameters = {}
-        for name, value in args.parameter:
-            parameters[name] = parse_value(
-                value, dtype=analysis_class.param_spec(name).dtype)
+        return dataset, input_dataset, processor, environment
+
+    @classmethod
+    def init_analysis(cls, analysis_class, name, args, dataset,
+                      input_dataset, processor, environment, inputs=(),
+                      parameters=(), cache=(), bids_task=None):
+        """
+        Creates an analysis from the command-line arguments
+
+        Parameters
+        ----------
+        analysis_class : type
+            The class of the analysis to create
+        name : str
+            The name of the analysis
+        args : argparse.Namespace
+            The parsed command-line arguments
+        dataset, input_dataset, processor, environment
+            As returned by setup
+        inputs : list[tuple(str, str)]
+            Names of input specs and the patterns to match them with
+        parameters : list[tuple(str, *)]
+            Names and values of the parameters to pass to the analysis. Values
+            provided as strings are parsed into the dtype of the parameter
+        cache : list[str]
+            Names of input specs to cache locally before running
+        bids_task : str | None
+            A task to use to filter the BIDS inputs
+        """
+        from arcana.utils import parse_value
+        from banana.exceptions import BananaUsageError
+        from banana import FilesetFilter, FieldFilter
+
+        parsed_params = {}
+        for param_name, value in parameters:
+            if isinstance(value, str):
+                value = parse_value(
+                    value, dtype=analysis_class.param_spec(param_name).dtype)
+            parsed_params[param_name] = value
 
         if input_dataset is not None and input_dataset.type == 'bids':
-            inputs = analysis_class.get_bids_inputs(args.bids_task,
-                                                    dataset=input_dataset)
+            bound_inputs = analysis_class.get_bids_inputs(
+                bids_task, dataset=input_dataset)
         else:
-            inputs = {}
-        for name, pattern in args.input:
-            spec = analysis_class.data_spec(name)
+            bound_inputs = {}
+        for spec_name, pattern in inputs:
+            spec = analysis_class.data_spec(spec_name)
             if spec.is_fileset:
                 inpt_cls = FilesetFilter
             else:
                 inpt_cls = FieldFilter
-            inputs[name] = inpt_cls(name, pattern=pattern, is_regex=True,
-                                    dataset=input_dataset)
+            bound_inputs[spec_name] = inpt_cls(
+                spec_name, pattern=pattern, is_regex=True,
+                dataset=input_dataset)
 
         analysis = analysis_class(
-            name=args.analysis_name,
+            name=name,
             dataset=dataset,
             processor=processor,
             environment=environment,
-            inputs=inputs,
-            parameters=parameters,
+            inputs=bound_inputs,
+            parameters=parsed_params,
             enforce_inputs=args.enforce_inputs,
-            bids_task=args.bids_task)
+            bids_task=bids_task)
 
-        for spec_name in args.cache:
+        for spec_name in cache:
             spec = analysis.bound_spec(spec_name)
             if not isinstance(spec, FilesetFilter):
                 raise BananaUsageError(
                     "Cannot cache non-input fileset '{}'".format(spec_name))
             spec.cache()
+        return analysis
 
-        # Generate data
-        analysis.derive(args.derivatives)
 
-        logger.info("Generated derivatives for '{}'".format(args.derivatives))
+class PlanCmd():
+
+    desc = ("Show the pipelines and nodes that would be run to generate "
+            "derivatives and estimate their cost without running them")
+
+    @classmethod
+    def parser(cls):
+        parser = ArgumentParser(prog='banana plan', description=cls.desc)
+        # Accepts the same arguments as 'derive' so that a derive command can
+        # be planned by replacing 'derive' with 'plan'
+        parser.add_argument('dataset_path',
+                            help=("Either the path to the dataset if of "
+                                  "'bids' or 'basic' types, or the name of the"
+                                  " project ID for 'xnat' type"))
+        parser.add_argument('analysis_class',
+                            help=("Name of the class to instantiate"))
+        parser.add_argument('analysis_name',
+                            help=("The name of the analysis (used to name the "
+                                  "derivatives)"))
+        parser.add_argument('derivatives', nargs='+',
+                            help=("The names of the derivatives to plan"))
+        DeriveCmd.add_options(parser)
+        parser.add_argument('--nodes', action='store_true', default=False,
+                            help="List the individual nodes to be run")
+        parser.add_argument('--json', action='store_true', default=False,
+                            help="Print the plan in JSON format")
+        return parser
+
+    @classmethod
+    def run(cls, args):
+        from banana.utils.history import RunHistory
+        from banana.utils.plan import plan_derivation, plan_summary
+
+        if not args.quiet:
+            set_loggers(args.logger)
+
+        analysis_class = resolve_class(args.analysis_class)
+
+        dataset, input_dataset, processor, environment = DeriveCmd.setup(
+            args)
+
+        analysis = DeriveCmd.init_analysis(
+            analysis_class, args.analysis_name, args, dataset=dataset,
+            input_dataset=input_dataset, processor=processor,
+            environment=environment, inputs=args.input,
+            parameters=args.parameter, cache=args.cache,
+            bids_task=args.bids_task)
+
+        history_path = DeriveCmd.history_path(args)
+        history = RunHistory(history_path)
+        history.ingest_work_dir(processor.work_dir)
+
+        plan = plan_derivation(analysis, args.derivatives, history=history)
+        cpu_hours, peak_mem_gb = plan_summary(plan)
+
+        if args.json:
+            print(json.dumps({
+                'pipelines': [dict(p._asdict(),
+                                   nodes=[n._asdict() for n in p.nodes])
+                              for p in plan],
+                'cpu_hours': cpu_hours,
+                'peak_mem_gb': peak_mem_gb}, indent=2))
+            return
+        name_width = max([len(p.name) for p in plan] + [len('Pipeline')])
+        row = '{:<' + str(name_width) + '}  {:>10}  {:>6}  {:>8}  {:>8}'
+        print(row.format('Pipeline', 'Sessions', 'Nodes', 'CPU-h',
+                         'Mem (GB)'))
+        for pipeline in plan:
+            if pipeline.nodes:
+                p_cpu_hours, p_mem_gb = plan_summary([pipeline])
+                cost = ('{:.2f}'.format(p_cpu_hours),
+                        '{:.1f}'.format(p_mem_gb))
+            else:
+                cost = ('-', '-')
+            print(row.format(
+                pipeline.name, '{}/{}'.format(pipeline.to_process,
+                                              pipeline.num_sessions),
+                len(pipeline.nodes), *cost))
+            if args.nodes:
+                for node in pipeline.nodes:
+                    print('    {} ({}) {}: {:.1f} min, {:.1f} GB{}'.format(
+                        node.name, node.interface, node.iterables,
+                        node.wall_time, node.mem_gb,
+                        '' if node.from_history else ' (declared)'))
+        num_nodes = sum(len(p.nodes) for p in plan)
+        num_estimated = sum(n.from_history for p in plan for n in p.nodes)
+        print("\n{} of {} pipelines need to be run ({} nodes), estimated "
+              "{:.2f} CPU-hours with a peak of {:.1f} GB per node. {} of the "
+              "nodes are estimated from runs recorded in '{}', the rest from "
+              "their declared wall times and memory".format(
+                  sum(1 for p in plan if p.nodes), len(plan), num_nodes,
+                  cpu_hours, peak_mem_gb, num_estimated, history_path))
+
+
+class DeriveBatchCmd():
+
+    desc = ("Generate derivatives from several Banana Analysis classes listed "
+            "in a manifest in a single run")
+
+    # Keys recognised in each analysis entry of the manifest
+    MANIFEST_KEYS = ('class', 'name', 'derivatives', 'parameters', 'inputs',
+                     'cache', 'bids_task')
+
+    @classmethod
+    def parser(cls):
+        parser = ArgumentParser(prog='banana derive-batch',
+                                description=cls.desc)
+        parser.add_argument('dataset_path',
+                            help=("Either the path to the dataset if of "
+                                  "'bids' or 'basic' types, or the name of the"
+                                  " project ID for 'xnat' type"))
+        parser.add_argument('manifest',
+                            help=(
+                                "Path to a JSON (or YAML if PyYAML is "
+                                "installed) manifest containing a list of "
+                                "analyses under the 'analyses' key. Each "
+                                "analysis requires 'class', 'name' and "
+                                "'derivatives' keys and can optionally "
+                                "provide 'parameters' and 'inputs' "
+                                "(mappings), 'cache' (a list) and "
+                                "'bids_task'. Parameters and inputs passed on"
+                                " the command line are applied to all "
+                                "analyses"))
+        DeriveCmd.add_options(parser)
+        return parser
+
+    @classmethod
+    def run(cls, args):
+        from banana.analysis.base import derive_batch
+
+        if not args.quiet:
+            set_loggers(args.logger)
+
+        manifest = cls.load_manifest(args.manifest)
+        analysis_classes = [resolve_class(a['class']) for a in manifest]
+
+        # The dataset (and its tree), processor and environment (and
+        # therefore the resolution of its requirements) are shared between
+        # all analyses
+        dataset, input_dataset, processor, environment = DeriveCmd.setup(
+            args)
+
+        derivations = []
+        for entry, analysis_class in zip(manifest, analysis_classes):
+            analysis = DeriveCmd.init_analysis(
+                analysis_class, entry['name'], args, dataset=dataset,
+                input_dataset=input_dataset, processor=processor,
+                environment=environment,
+                inputs=(list(args.input)
+                        + list(entry.get('inputs', {}).items())),
+                parameters=(list(args.parameter)
+                            + list(entry.get('parameters', {}).items())),
+                cache=list(args.cache) + list(entry.get('cache', [])),
+                bids_task=entry.get('bids_task', args.bids_task))
+            derivations.append((analysis, entry['derivatives']))
+
+        runs = derive_batch(derivations)
+
+        logger.info("Generated derivatives for {} analyses in {} run(s)"
+                    .format(len(derivations), len(runs)))
+
+        DeriveCmd.report_profile(args, environment)
+
+    @classmethod
+    def load_manifest(cls, path):
+        """
+        Loads and checks the list of analyses in a batch manifest
+        """
+        from banana.exceptions import BananaUsageError
+        with open(path) as f:
+            if path.endswith(('.yml', '.yaml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise BananaUsageError(
+                        "PyYAML needs to be installed to read YAML manifests "
+                        "('{}'), use JSON instead".format(path))
+                manifest = yaml.safe_load(f)
+            else:
+                manifest = json.load(f)
+        if isinstance(manifest, dict):
+            manifest = manifest.get('analyses')
+        if not isinstance(manifest, list) or not manifest:
+            raise BananaUsageError(
+                "Manifest '{}' doesn't contain a list of analyses under the "
+                "'analyses' key".format(path))
+        for i, entry in enumerate(manifest):
+            if not isinstance(entry, dict):
+                raise BananaUsageError(
+                    "Analysis {} in manifest '{}' is not a mapping"
+                    .format(i, path))
+            missing = [k for k in ('class', 'name', 'derivatives')
+                       if k not in entry]
+            unrecognised = [k for k in entry if k not in cls.MANIFEST_KEYS]
+            if missing or unrecognised:
+                raise BananaUsageError(
+                    "Analysis {} in manifest '{}' is missing required keys "
+                    "({}) or has unrecognised keys ({})".format(
+                        i, path, missing, unrecognised))
+            if isinstance(entry['derivatives'], str):
+                entry['derivatives'] = [entry['derivatives']]
+        names = [e['name'] for e in manifest]
+        if len(set(names)) != len(names):
+            raise BananaUsageError(
+                "Duplicate analysis names in manifest '{}' ({})"
+                .format(path, names))
+        return manifest
 
 
 # class TestGenCmd():
@@ -519,6 +1295,8 @@ class GenRefDataCmd():
 
     @classmethod
     def run(cls, args):
+        from banana.exceptions import BananaUsageError
+        from banana import MultiProc, SingleProc, StaticEnv, ModulesEnv
 
         if not args.quiet:
             set_loggers(args.logger)
@@ -630,46 +1408,19 @@ class AvailableCmd():
 
     @classmethod
     def run(cls, args):
-        available = {}
-
-        def find_analysis_classes(pkg_or_module, pkg_or_module_path):
-            for cls_name in dir(pkg_or_module):
-                if cls_name.startswith('_'):
-                    continue
-                cls = getattr(pkg_or_module, cls_name)
-                try:
-                    if (issubclass(cls, (Analysis, MultiAnalysis))
-                            and 'desc' in cls.__dict__):
-                        try:
-                            old_path = available[cls]
-                        except KeyError:
-                            available[cls] = pkg_or_module_path
-                        else:
-                            if len(pkg_or_module_path) < len(old_path):
-                                available[cls] = pkg_or_module_path
-                except TypeError:
-                    pass
-
-        search_paths = [cls.default_path] + args.search_paths
-        for search_path in search_paths:
-            base_module = import_module(search_path)
-            for pkg_name in find_packages(op.dirname(base_module.__file__)):
-                pkg_path = search_path + '.' + pkg_name
-                pkg = import_module(pkg_path)
-                find_analysis_classes(pkg, pkg_path)
-                for module_info in iter_modules([op.dirname(pkg.__file__)]):
-                    module_path = pkg_path + '.' + module_info.name
-                    module = import_module(module_path)
-                    find_analysis_classes(module, module_path)
+        # Analysis classes are found by statically scanning the modules in
+        # the search paths (see banana.registry) so they don't need to be
+        # imported
+        registry = AnalysisRegistry([cls.default_path] + args.search_paths)
         msg = ("\nThe following Analysis classes are available:\n")
         to_print = []
-        for avail_cls, module_path in sorted(available.items(),
-                                             key=lambda x: x[0].__name__):
+        for info in sorted(registry.classes, key=lambda c: c.name):
+            if info.desc is None:
+                continue
+            module_path = min(info.paths, key=len)
             if module_path.startswith(DEFAULT_STUDY_CLASS_PATH):
                 module_path = module_path[(len(DEFAULT_STUDY_CLASS_PATH) + 1):]
-            full_name = module_path + '.' + avail_cls.__name__
-            to_print.append((full_name, avail_cls.desc))
-
+            to_print.append((module_path + '.' + info.name, info.desc))
         desc_start = max(len(l[0]) for l in to_print) + DEFAULT_SPACER
         for cls_name, desc in to_print:
             spaces = ' ' * (desc_start - len(cls_name))
@@ -686,6 +1437,8 @@ class MainCmd():
         'avail': AvailableCmd,
         'menu': MenuCmd,
         'derive': DeriveCmd,
+        'derive-batch': DeriveBatchCmd,
+        'plan': PlanCmd,
         # 'test-gen': TestGenCmd,
         'gen-ref': GenRefDataCmd,
         'help': HelpCmd}
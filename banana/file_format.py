@@ -3,14 +3,20 @@ from abc import ABCMeta, abstractmethod
 import os
 import os.path as op
 import json
-import pydicom
+import tempfile
 import numpy as np
 from arcana.data.file_format import FileFormat, Converter
 from banana.interfaces.mrtrix import MRConvert
 from banana.requirement import (
     dcm2niix_req, mrtrix_req, matlab_req)
-from banana.interfaces.converters import Dcm2niix, TwixReader
+from banana.interfaces.converters import (
+    Dcm2niix, TwixReader, NativeImageConvert, CachedConversion)
 from banana.exceptions import BananaUsageError
+from banana.utils.image import (
+    read_mrtrix_header, map_mrtrix_data, compare_arrays, array_digest,
+    header_digest)
+from banana.utils.cache import ConversionCache
+from banana.utils.dicom import DicomSeriesIndex
 import nibabel
 # Import base file formats from Arcana for convenience
 from arcana.data.file_format import (
@@ -19,34 +25,98 @@ from arcana.data.file_format import (
     UnzipConverter, UnTarGzConverter, IdentityConverter)
 
 
-class Dcm2niixConverter(Converter):
+class CachedConverter(Converter):
+    """
+    Base class for converters whose outputs are stored in the conversion cache
+    shared between analyses (see banana.utils.cache.ConversionCache), which is
+    enabled by setting the BANANA_CONVERSION_CACHE environment variable to the
+    cache directory (done by 'banana derive' by default).
 
-    interface = Dcm2niix(compression='y')
+    Subclasses should define the interface that performs the conversion as
+    'base_interface', and increment 'version' whenever its outputs change
+    """
+
+    version = 1
+
+    @property
+    def base_interface(self):
+        # To be overridden by subclasses
+        raise NotImplementedError
+
+    @property
+    def interface(self):
+        cache = ConversionCache.from_env()
+        if cache is None:
+            return self.base_interface
+        return CachedConversion(
+            deepcopy(self.base_interface), cache, in_field=self.input,
+            converter_name='{}.{}'.format(type(self).__module__,
+                                          type(self).__name__),
+            version=str(self.version), requirements=self.requirements)
+
+
+class Dcm2niixConverter(CachedConverter):
+
+    base_interface = Dcm2niix(compression='y')
     input = 'input_dir'
     output = 'converted'
     requirements = [dcm2niix_req.v('1.0.2')]
 
 
-class MrtrixConverter(Converter):
+class MrtrixConverter(CachedConverter):
 
     input = 'in_file'
     output = 'out_file'
     requirements = [mrtrix_req.v(3)]
 
     @property
-    def interface(self):
+    def base_interface(self):
         return MRConvert(
             out_ext=self.output_format.extension,
             quiet=True)
 
 
-class TwixConverter(Converter):
+class NativeImageConverter(Converter):
+    """
+    Converts between NIfTI, Analyze and MRtrix image formats within the
+    Python process, avoiding the overhead of launching 'mrconvert'
+
+    Parameters
+    ----------
+    compression_level : int | None
+        The gzip compression level (0-9) to use for '.nii.gz' outputs.
+        Defaults to the value of the BANANA_COMPRESSION_LEVEL environment
+        variable (when the conversion is run) if set
+    """
+
+    input = 'in_file'
+    output = 'out_file'
+    requirements = []
+
+    def __init__(self, input_format, output_format,
+                 compression_level=None, **kwargs):
+        super().__init__(input_format, output_format, **kwargs)
+        self._compression_level = compression_level
+
+    @property
+    def compression_level(self):
+        return self._compression_level
+
+    @property
+    def interface(self):
+        interface = NativeImageConvert(out_ext=self.output_format.extension)
+        if self.compression_level is not None:
+            interface.inputs.compression_level = self.compression_level
+        return interface
+
+
+class TwixConverter(CachedConverter):
 
     input = 'in_file'
     output = 'out_file'
     output_aux_files = {'ref': 'ref_file', 'json': 'hdr_file'}
     requirements = [matlab_req.v('R2018a')]
-    interface = TwixReader()
+    base_interface = TwixReader()
 
 
 # =====================================================================
@@ -58,6 +128,7 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
 
     INCLUDE_HDR_KEYS = None
     IGNORE_HDR_KEYS = None
+    FINGERPRINT_VERSION = 1
 
     @abstractmethod
     def get_header(self, fileset):
@@ -67,10 +138,12 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def get_array(self, fileset):
+    def get_array(self, fileset, lazy=False):
         """
-        Returns header data associated with the given path for the
-        file format
+        Returns array data associated with the given path for the
+        file format. If 'lazy' is True and the format supports it, an
+        array-like proxy is returned that only reads the slices that are
+        accessed from disk
         """
 
     def contents_equal(self, fileset, other_fileset, rms_tol=None, **kwargs):
@@ -85,19 +158,24 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
         other_fileset : Fileset
             The other fileset to compare
         rms_tol : float
-            The root-mean-square tolerance that is acceptable between the array
-            data for the images to be considered equal
+            The root-mean-square (per voxel) tolerance that is acceptable
+            between the array data for the images to be considered equal
         """
         if other_fileset.format != self:
             return False
+        if not kwargs:
+            # Settle the comparison from previously calculated fingerprints
+            # if they are available and match
+            fingerprint = self.cached_fingerprint(fileset)
+            if (fingerprint is not None and
+                    fingerprint == self.cached_fingerprint(other_fileset)):
+                return True
         if self.headers_diff(fileset, other_fileset, **kwargs):
             return False
+        diff = self.image_diff(fileset, other_fileset, exact=not rms_tol)
         if rms_tol:
-            rms_diff = self.rms_diff(fileset, other_fileset)
-            return (rms_diff < rms_tol)
-        else:
-            return np.array_equiv(fileset.get_array(),
-                                  other_fileset.get_array())
+            return not diff.nan_mismatches and diff.rms < rms_tol
+        return diff.equal
 
     def headers_diff(self, fileset, other_fileset, include_keys=None,
                      ignore_keys=None, **kwargs):
@@ -106,29 +184,9 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
         """
         diff = []
         hdr = fileset.get_header()
-        hdr_keys = set(hdr.keys())
         other_hdr = other_fileset.get_header()
-        if include_keys is not None:
-            if ignore_keys is not None:
-                raise BananaUsageError(
-                    "Doesn't make sense to provide both 'include_keys' ({}) "
-                    "and ignore_keys ({}) to headers_equal method"
-                    .format(include_keys, ignore_keys))
-            include_keys &= hdr_keys
-        elif ignore_keys is not None:
-            include_keys = hdr_keys - set(ignore_keys)
-        else:
-            if self.INCLUDE_HDR_KEYS is not None:
-                if self.IGNORE_HDR_KEYS is not None:
-                    raise BananaUsageError(
-                        "Doesn't make sense to have both 'INCLUDE_HDR_FIELDS'"
-                        "and 'IGNORE_HDR_FIELDS' class attributes of class {}"
-                        .format(type(self).__name__))
-                include_keys = self.INCLUDE_HDR_KEYS  # noqa pylint: disable=no-member
-            elif self.IGNORE_HDR_KEYS is not None:
-                include_keys = hdr_keys - set(self.IGNORE_HDR_KEYS)
-            else:
-                include_keys = hdr_keys
+        include_keys = self._header_keys(hdr, include_keys=include_keys,
+                                         ignore_keys=ignore_keys)
         for key in include_keys:
             value = hdr[key]
             try:
@@ -152,12 +210,144 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
                     diff.append(key)
         return diff
 
+    def _header_keys(self, hdr, include_keys=None, ignore_keys=None):
+        """
+        Returns the keys of the header fields to compare, given explicit
+        include/ignore keys or the INCLUDE_HDR_KEYS/IGNORE_HDR_KEYS class
+        attributes
+        """
+        hdr_keys = set(hdr.keys())
+        if include_keys is not None:
+            if ignore_keys is not None:
+                raise BananaUsageError(
+                    "Doesn't make sense to provide both 'include_keys' ({}) "
+                    "and ignore_keys ({}) to headers_equal method"
+                    .format(include_keys, ignore_keys))
+            include_keys = set(include_keys) & hdr_keys
+        elif ignore_keys is not None:
+            include_keys = hdr_keys - set(ignore_keys)
+        else:
+            if self.INCLUDE_HDR_KEYS is not None:
+                if self.IGNORE_HDR_KEYS is not None:
+                    raise BananaUsageError(
+                        "Doesn't make sense to have both 'INCLUDE_HDR_FIELDS'"
+                        "and 'IGNORE_HDR_FIELDS' class attributes of class {}"
+                        .format(type(self).__name__))
+                include_keys = self.INCLUDE_HDR_KEYS  # noqa pylint: disable=no-member
+            elif self.IGNORE_HDR_KEYS is not None:
+                include_keys = hdr_keys - set(self.IGNORE_HDR_KEYS)
+            else:
+                include_keys = hdr_keys
+        return include_keys
+
+    def image_diff(self, fileset, other_fileset, exact=False):
+        """
+        Compares the image arrays a block at a time so that neither is read
+        into memory in full (see banana.utils.image.compare_arrays)
+
+        Parameters
+        ----------
+        fileset : Fileset
+            One of the two filesets to compare
+        other_fileset : Fileset
+            The other fileset to compare
+        exact : bool
+            Whether to stop at the first block that differs
+
+        Returns
+        -------
+        diff : ArrayDiff
+            The number of voxels compared, sum of squared differences,
+            maximum absolute difference and number of NaN mismatches
+        """
+        return compare_arrays(fileset.get_array(lazy=True),
+                              other_fileset.get_array(lazy=True),
+                              exact=exact)
+
     def rms_diff(self, fileset, other_fileset):
         """
-        Return the RMS difference between the image arrays
+        Return the RMS difference per voxel between the image arrays
         """
-        return np.sqrt(np.sum((fileset.get_array()
-                               - other_fileset.get_array()) ** 2))
+        return self.image_diff(fileset, other_fileset).rms
+
+    def fingerprint(self, fileset):
+        """
+        Returns a fingerprint of the image, made up of digests of its
+        (normalised) header fields, honouring INCLUDE_HDR_KEYS and
+        IGNORE_HDR_KEYS, and of its voxel data, which is read a block at a
+        time. Identical fingerprints imply equal contents.
+
+        The fingerprint is cached in a hidden sidecar file next to the
+        fileset, '.<name>.fingerprint.json' (which is ignored by the
+        repositories), along with the sizes and modification times of the
+        fileset's files so that it is recalculated when they change.
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to fingerprint
+
+        Returns
+        -------
+        fingerprint : str
+            '<header digest>:<voxel digest>'
+        """
+        fingerprint = self.cached_fingerprint(fileset)
+        if fingerprint is None:
+            hdr = fileset.get_header()
+            fingerprint = '{}:{}'.format(
+                header_digest(hdr, (k for k in self._header_keys(hdr)
+                                    if k in hdr)),
+                array_digest(fileset.get_array(lazy=True)))
+            sidecar = {'version': self.FINGERPRINT_VERSION,
+                       'files': self._file_stats(fileset),
+                       'fingerprint': fingerprint}
+            try:
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=op.dirname(fileset.path), prefix='.', suffix='.tmp')
+            except OSError:
+                # The directory is read-only so the fingerprint can't be
+                # cached
+                pass
+            else:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(sidecar, f)
+                os.replace(tmp_path, self._fingerprint_path(fileset))
+        return fingerprint
+
+    def cached_fingerprint(self, fileset):
+        """
+        Returns the cached fingerprint of the fileset (see fingerprint), or
+        None if it hasn't been cached or the fileset has changed since
+        """
+        try:
+            with open(self._fingerprint_path(fileset)) as f:
+                sidecar = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if (sidecar.get('version') != self.FINGERPRINT_VERSION or
+                sidecar.get('files') != self._file_stats(fileset)):
+            return None
+        return sidecar['fingerprint']
+
+    def _fingerprint_path(self, fileset):
+        return op.join(op.dirname(fileset.path),
+                       '.{}.fingerprint.json'.format(
+                           op.basename(fileset.path)))
+
+    def _file_stats(self, fileset):
+        stats = []
+        for path in fileset.paths:
+            if op.isdir(path):
+                fpaths = sorted(op.join(d, f) for d, _, fnames in os.walk(path)
+                                for f in fnames)
+            else:
+                fpaths = [path]
+            for fpath in fpaths:
+                stat = os.stat(fpath)
+                stats.append([op.relpath(fpath, op.dirname(fileset.path)),
+                              stat.st_size, stat.st_mtime_ns])
+        return stats
 
 
 class NiftiFormat(ImageFormat):
@@ -165,8 +355,26 @@ class NiftiFormat(ImageFormat):
     def get_header(self, fileset):
         return dict(nibabel.load(fileset.path).header)
 
-    def get_array(self, fileset):
-        return nibabel.load(fileset.path).get_data()
+    def get_array(self, fileset, lazy=False):
+        """
+        Returns the array data of the image
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to load the array data of
+        lazy : bool
+            If True, the nibabel array proxy of the image is returned instead
+            of an in-memory array. Slices of the proxy are read on demand,
+            through a memory-map for uncompressed images and a seekable
+            file handle for gzipped images (which is block-indexed if the
+            optional 'indexed_gzip' package is installed), so that only the
+            data that is actually accessed is loaded into memory
+        """
+        image = nibabel.load(fileset.path, mmap=True, keep_file_open=lazy)
+        if lazy:
+            return image.dataobj
+        return np.asanyarray(image.dataobj)
 
     def get_vox_sizes(self, fileset):
         # FIXME: This won't work for 4-D files
@@ -190,30 +398,61 @@ class DicomFormat(ImageFormat):
 
     SERIES_NUMBER_TAG = ('0020', '0011')
 
+    def series_index(self, fileset):
+        """
+        Returns the index of the headers in the series, which is built the
+        first time it is accessed and then reused until the files in the
+        series change (see banana.utils.dicom.DicomSeriesIndex)
+        """
+        return DicomSeriesIndex.load(fileset.path)
+
     def dcm_files(self, fileset):
-        return [f for f in os.listdir(fileset.path) if f.endswith('.dcm')]
+        return self.series_index(fileset).files
 
-    def get_array(self, fileset):
-        image_stack = []
-        for fname in self.dcm_files(fileset):
-            image_stack.append(
-                pydicom.dcmread(op.join(fileset.path, fname)).pixel_array)
-        return np.asarray(image_stack)
+    def get_array(self, fileset, lazy=False, split=None, num_threads=None):
+        """
+        Loads the pixel data of the series, sorted by slice geometry and
+        decoded in parallel (see banana.utils.dicom.DicomSeriesIndex)
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to load the array data of
+        lazy : bool
+            Ignored, DICOM slices are stored in separate files so are always
+            loaded
+        split : str | None
+            Reshape the stack into a 4-D array split by 'echo' or 'volume'
+        num_threads : int | None
+            The number of threads to decode the slices with
+        """
+        return self.series_index(fileset).load_array(split=split,
+                                                     num_threads=num_threads)
 
     def get_header(self, fileset, index=0):
-        dcm_files = [f for f in os.listdir(fileset.path) if f.endswith('.dcm')]
-        # TODO: Probably should collate fields that vary across the set of
-        #       files in the set into lists
-        return pydicom.dcmread(op.join(fileset.path, dcm_files[index]))
+        # Fields that vary across the files in the set are collated in the
+        # series index (see series_index)
+        return self.series_index(fileset).header(index)
 
     def get_vox_sizes(self, fileset):
-        hdr = self.get_header(fileset)
-        return np.array(hdr.PixelSpacing + [hdr.SliceThickness])
+        index = self.series_index(fileset)
+        pixel_spacing = index.get('PixelSpacing')
+        slice_thickness = index.get('SliceThickness')
+        if pixel_spacing is None or slice_thickness is None:
+            hdr = index.header()
+            pixel_spacing = hdr.PixelSpacing
+            slice_thickness = hdr.SliceThickness
+        return np.array(list(pixel_spacing) + [slice_thickness])
 
     def get_dims(self, fileset):
-        hdr = self.get_header(fileset)
-        return np.array((hdr.Rows, hdr.Columns, len(self.dcm_files(fileset))),
-                        dtype=int)
+        index = self.series_index(fileset)
+        rows = index.get('Rows')
+        columns = index.get('Columns')
+        if rows is None or columns is None:
+            hdr = index.header()
+            rows = hdr.Rows
+            columns = hdr.Columns
+        return np.array((rows, columns, len(index)), dtype=int)
 
     def extract_id(self, fileset):
         return int(fileset.dicom_values([self.SERIES_NUMBER_TAG])[0])
@@ -242,9 +481,15 @@ class DicomFormat(ImageFormat):
                 hdr = fileset.dataset.repository.dicom_header(self)
                 dct = [hdr[t] for t in tags]
             else:
-                # Get the DICOM object for the first file in the fileset
-                dcm = fileset.get_header(0)
-                dct = [dcm[t].value for t in tags]
+                # Fields shared by all files in the series are served from
+                # the series index, the first file in the fileset is only
+                # read if any of the requested fields aren't in it
+                index = self.series_index(fileset)
+                dct = [index.get(t) for t in tags]
+                if any(v is None for v in dct):
+                    dcm = index.header(0)
+                    dct = [dcm[t].value if v is None else v
+                           for t, v in zip(tags, dct)]
         except KeyError as e:
             e.msg = ("{} does not have dicom tag {}".format(
                      self, str(e)))
@@ -253,42 +498,36 @@ class DicomFormat(ImageFormat):
 
 
 class MrtrixImageFormat(ImageFormat):
-
-    def _load_header_and_array(self, fileset):
-        with open(fileset.path, 'rb') as f:
-            contents = f.read()
-        hdr_end = contents.find(b'\nEND\n')
-        hdr_contents = contents[:hdr_end].decode('utf-8')
-        hdr = dict(l.split(': ', maxsplit=1) for l in hdr_contents.split('\n'))
-        for key, value in list(hdr.items()):
-            if ',' in value:
-                try:
-                    hdr[key] = np.array(value.split(','), dtype=int)
-                except ValueError:
-                    try:
-                        hdr[key] = np.array(value.split(','), dtype=float)
-                    except ValueError:
-                        pass
-            else:
-                try:
-                    hdr[key] = int(value)
-                except ValueError:
-                    try:
-                        hdr[key] = float(value)
-                    except ValueError:
-                        pass
-        del hdr['mrtrix image']  # Delete "magic line" at start of header
-        array_start = int(hdr['file'].split()[1])
-        array = np.asarray(contents[array_start:])
-        dim = [hdr['dim'][int(l[1])] for l in hdr['layout']]
-        array = array.reshape(dim)
-        return hdr, array
+    """
+    The MRtrix image format (.mif), which consists of a text header followed
+    by (or pointing to, in the case of the .mih variant) the voxel data. See
+    https://mrtrix.readthedocs.io/en/latest/getting_started/image_data.html
+    """
 
     def get_header(self, fileset):
-        self._load_header_and_array(fileset)[0]
+        """
+        Reads the header of the image without reading any of the voxel data
+        (see banana.utils.image.read_mrtrix_header)
+        """
+        return read_mrtrix_header(fileset.path)
+
+    def get_array(self, fileset, lazy=False):
+        """
+        Maps the voxel data of the image into memory, honouring the datatype,
+        endianness, layout and intensity scaling declared in the header
 
-    def get_array(self, fileset):
-        self._load_header_and_array(fileset)[1]
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to load the array data of
+        lazy : bool
+            If True, a MrtrixArrayProxy is returned, from which only the
+            slices that are accessed are read from disk (and scaled)
+        """
+        proxy = map_mrtrix_data(fileset.path)
+        if lazy:
+            return proxy
+        return np.asanyarray(proxy)
 
     def get_vox_sizes(self, fileset):
         return self.get_header(fileset)['vox']
@@ -321,31 +560,37 @@ analyze_format = NiftiFormat(name='analyze', extension='.img',
 mrtrix_image_format = MrtrixImageFormat(name='mrtrix_image', extension='.mif',
                                         resource_names={'xnat': ['MIF',
                                                                  'MRTRIX']})
+mrtrix_image_header_format = MrtrixImageFormat(
+    name='mrtrix_image_header', extension='.mih', aux_files={'data': '.dat'},
+    resource_names={'xnat': ['MIH']})
 
 # Set converters between image formats
 
 nifti_gz_x_format.set_converter(dicom_format, Dcm2niixConverter)
 
 nifti_format.set_converter(dicom_format, Dcm2niixConverter)
-nifti_format.set_converter(analyze_format, MrtrixConverter)
-nifti_format.set_converter(nifti_gz_format, MrtrixConverter)
-nifti_format.set_converter(mrtrix_image_format, MrtrixConverter)
+nifti_format.set_converter(analyze_format, NativeImageConverter)
+nifti_format.set_converter(nifti_gz_format, NativeImageConverter)
+nifti_format.set_converter(mrtrix_image_format, NativeImageConverter)
+nifti_format.set_converter(mrtrix_image_header_format, NativeImageConverter)
 
 nifti_gz_format.set_converter(dicom_format, Dcm2niixConverter)
-nifti_gz_format.set_converter(nifti_format, MrtrixConverter)
-nifti_gz_format.set_converter(analyze_format, MrtrixConverter)
-nifti_gz_format.set_converter(mrtrix_image_format, MrtrixConverter)
+nifti_gz_format.set_converter(nifti_format, NativeImageConverter)
+nifti_gz_format.set_converter(analyze_format, NativeImageConverter)
+nifti_gz_format.set_converter(mrtrix_image_format, NativeImageConverter)
+nifti_gz_format.set_converter(mrtrix_image_header_format,
+                              NativeImageConverter)
 nifti_gz_format.set_converter(nifti_gz_x_format, IdentityConverter)
 
 analyze_format.set_converter(dicom_format, MrtrixConverter)
-analyze_format.set_converter(nifti_format, MrtrixConverter)
-analyze_format.set_converter(nifti_gz_format, MrtrixConverter)
-analyze_format.set_converter(mrtrix_image_format, MrtrixConverter)
+analyze_format.set_converter(nifti_format, NativeImageConverter)
+analyze_format.set_converter(nifti_gz_format, NativeImageConverter)
+analyze_format.set_converter(mrtrix_image_format, NativeImageConverter)
 
 mrtrix_image_format.set_converter(dicom_format, MrtrixConverter)
-mrtrix_image_format.set_converter(nifti_format, MrtrixConverter)
-mrtrix_image_format.set_converter(nifti_gz_format, MrtrixConverter)
-mrtrix_image_format.set_converter(analyze_format, MrtrixConverter)
+mrtrix_image_format.set_converter(nifti_format, NativeImageConverter)
+mrtrix_image_format.set_converter(nifti_gz_format, NativeImageConverter)
+mrtrix_image_format.set_converter(analyze_format, NativeImageConverter)
 
 STD_IMAGE_FORMATS = [dicom_format, nifti_format, nifti_gz_format,
                      nifti_gz_x_format, analyze_format, mrtrix_image_format]
@@ -4,9 +4,9 @@ from nipype.interfaces.base import (
     traits)
 import os
 import shutil
-import pydicom
 import numpy as np
 import glob
+from banana.utils.dicom import scan_series, distinct
 
 
 class PrepareFIXInputSpec(BaseInterfaceInputSpec):
@@ -96,8 +96,7 @@ class FieldMapTimeInfo(BaseInterface):
     def _run_interface(self, runtime):
 
         fm_mag = sorted(glob.glob(self.inputs.fm_mag+'/*'))
-        tes = [pydicom.read_file(x).EchoTime for x in fm_mag]
-        tes = list(set(tes))
+        tes = distinct(scan_series(fm_mag).echo_times)
         if len(tes) != 2:
             print('Something went wrong when trying to estimate '
                   'the delta TE between the two echos field map '
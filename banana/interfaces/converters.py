@@ -1,15 +1,17 @@
 import os.path as op
 import os.path
 from nipype.interfaces.base import (
-    TraitedSpec, BaseInterface, File, Directory, traits, isdefined,
-    CommandLineInputSpec, CommandLine)
-import pydicom
+    TraitedSpec, BaseInterface, BaseInterfaceInputSpec, File, Directory,
+    traits, isdefined, CommandLineInputSpec, CommandLine)
 import nibabel as nib
 from arcana.utils import split_extension
 import re
 from arcana.exceptions import ArcanaError
 import numpy as np
 from nipype.utils.filemanip import split_filename
+from banana.utils.image import convert_image, save_image
+from banana.utils.dicom import (
+    load_templates, write_dicom_slices, write_enhanced_dicom)
 from .matlab import BaseMatlab, BaseMatlabInputSpec, BaseMatlabOutputSpec
 
 
@@ -63,7 +65,7 @@ class Dcm2niix(CommandLine):
                 f = nib.load(el)
                 merged_file[:, :, :, i] = f.get_data()
             im2save = nib.Nifti1Image(merged_file, ex_file.affine)
-            nib.save(im2save, out_dir + fname)
+            save_image(im2save, out_dir + fname)
             converted = out_dir + fname
         elif len(products) > 1 and not self.inputs.multifile_concat:
             converted = products[-1]
@@ -97,9 +99,154 @@ class Dcm2niix(CommandLine):
         return out_name
 
 
+class NativeImageConvertInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="The image to convert")
+    out_ext = traits.Str(mandatory=True,
+                         desc="The extension of the format to convert to")
+    out_file = File(genfile=True, desc="The path of the converted image")
+    compression_level = traits.Range(
+        low=0, high=9,
+        desc=("The gzip compression level of '.nii.gz' outputs. Defaults to "
+              "the value of the BANANA_COMPRESSION_LEVEL environment variable "
+              "if set"))
+
+
+class NativeImageConvertOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The converted image")
+
+
+class NativeImageConvert(BaseInterface):
+    """
+    Converts between NIfTI, NIfTI-pair/Analyze and MRtrix image formats
+    within the Python process, streaming the voxel data between the files one
+    slab at a time (see banana.utils.image.convert_image)
+    """
+
+    input_spec = NativeImageConvertInputSpec
+    output_spec = NativeImageConvertOutputSpec
+
+    def _run_interface(self, runtime):
+        compression_level = (self.inputs.compression_level
+                             if isdefined(self.inputs.compression_level)
+                             else None)
+        convert_image(self.inputs.in_file, self._gen_outfilename(),
+                      compression_level=compression_level)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_outfilename()
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            fname = self._gen_outfilename()
+        else:
+            assert False
+        return fname
+
+    def _gen_outfilename(self):
+        if isdefined(self.inputs.out_file):
+            fpath = self.inputs.out_file
+        else:
+            fname = (split_extension(op.basename(self.inputs.in_file))[0]
+                     + self.inputs.out_ext)
+            fpath = op.join(os.getcwd(), fname)
+        return op.abspath(fpath)
+
+
+class CachedConversion(BaseInterface):
+    """
+    Wraps the interface of a converter so that its outputs are stored in a
+    shared conversion cache, and hard-linked from the cache instead of
+    rerunning the conversion when the same input contents are converted again
+    by the same version of the converter, with the same versions of its
+    requirements and the same options. The versions of the requirements are
+    detected when the conversion is run (i.e. within the environment of the
+    node), so updating a tool in place invalidates its cached conversions.
+
+    The inputs and outputs of the wrapped interface are exposed unchanged, so
+    the wrapper can be used in place of the wrapped interface.
+
+    Parameters
+    ----------
+    interface : BaseInterface
+        The interface that performs the conversion
+    cache : banana.utils.cache.ConversionCache
+        The cache to store the outputs in
+    in_field : str
+        The name of the input of the interface holding the path to convert
+    converter_name : str
+        The fully-qualified name of the converter class
+    version : str
+        The version of the converter
+    requirements : list[Version | VersionRange]
+        The requirements of the converter
+    """
+
+    def __init__(self, interface, cache, in_field, converter_name, version,
+                 requirements=()):
+        self._interface = interface
+        self._cache = cache
+        self._in_field = in_field
+        self._converter_name = converter_name
+        self._version = version
+        self._requirements = list(requirements)
+        self.input_spec = interface.input_spec
+        self.output_spec = interface.output_spec
+        super().__init__()
+        # Share inputs with the wrapped interface so they are set on both
+        self.inputs = interface.inputs
+        self._converted = {}
+
+    def _run_interface(self, runtime):
+        options = {k: v for k, v in self.inputs.get().items()
+                   if k != self._in_field and isdefined(v)}
+        key = self._cache.key(getattr(self.inputs, self._in_field),
+                              self._converter_name, self.version_str(),
+                              options)
+        converted = self._cache.fetch(key, runtime.cwd)
+        if converted is None:
+            results = self._interface.run(cwd=runtime.cwd)
+            converted = {k: v for k, v in results.outputs.get().items()
+                         if isdefined(v) and isinstance(v, str)
+                         and op.exists(v)}
+            self._cache.store(key, converted)
+        self._converted = converted
+        return runtime
+
+    def version_str(self):
+        """
+        The version of the converter combined with the detected versions of
+        its requirements (or the requested versions if they can't be
+        detected)
+        """
+        versions = []
+        for req_range in self._requirements:
+            try:
+                version = req_range.requirement.detect_version()
+            except ArcanaError:
+                version = req_range
+            versions.append('{}={}'.format(req_range.name, version))
+        return '{}:{}'.format(self._version, ','.join(versions))
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._converted)
+        return outputs
+
+
 class Nii2DicomInputSpec(TraitedSpec):
     in_file = File(mandatory=True, desc='input nifti file')
     reference_dicom = traits.List(mandatory=True, desc='original umap')
+    multiframe = traits.Bool(
+        False, usedefault=True,
+        desc=("Write the image into a single enhanced (multi-frame) DICOM "
+              "file instead of a file for each slice"))
+    num_threads = traits.Int(
+        desc=("The number of threads used to read the reference files and "
+              "write the slices (defaults to the ThreadPoolExecutor "
+              "default)"))
 #     out_file = Directory(genfile=True, desc='the output dicom file')
 
 
@@ -115,41 +262,35 @@ class Nii2Dicom(BaseInterface):
 
     Attenuation Correction pipeline
 
+    The headers of the reference DICOMs are parsed once (and cached between
+    runs within the same process), the image is cast to the pixel type of
+    the references in a single step and the slices are written concurrently
+    (see banana.utils.dicom.write_dicom_slices)
     """
 
     input_spec = Nii2DicomInputSpec
     output_spec = Nii2DicomOutputSpec
 
     def _run_interface(self, runtime):
-        dcms = self.inputs.reference_dicom
-        to_remove = [x for x in dcms if '.dcm' not in x]
-        if to_remove:
-            for f in to_remove:
-                dcms.remove(f)
-#         dcms = glob.glob(self.inputs.reference_dicom+'/*.dcm')
-#         if not dcms:
-#             dcms = glob.glob(self.inputs.reference_dicom+'/*.IMA')
-#         if not dcms:
-#             raise Exception('No DICOM files found in {}'
-#                             .format(self.inputs.reference_dicom))
+        dcms = [x for x in self.inputs.reference_dicom if '.dcm' in x]
         nifti_image = nib.load(self.inputs.in_file)
-        nii_data = nifti_image.get_data()
+        nii_data = np.asanyarray(nifti_image.dataobj)
         if len(dcms) != nii_data.shape[2]:
             raise Exception('Different number of nifti and dicom files '
                             'provided. Dicom to nifti conversion require the '
                             'same number of files in order to run. Please '
                             'check.')
+        num_threads = (self.inputs.num_threads
+                       if isdefined(self.inputs.num_threads) else None)
+        templates = load_templates(dcms, num_threads=num_threads)
         os.mkdir('nifti2dicom')
         _, basename, _ = split_filename(self.inputs.in_file)
-        for i in range(nii_data.shape[2]):
-            dcm = pydicom.read_file(dcms[i])
-            nifti = nii_data[:, :, i]
-            nifti = nifti.astype('uint16')
-            dcm.pixel_array.setflags(write=True)
-            dcm.pixel_array.flat[:] = nifti.flat[:]
-            dcm.PixelData = dcm.pixel_array.T.tostring()
-            dcm.save_as('nifti2dicom/{0}_vol{1}.dcm'
-                        .format(basename, str(i).zfill(4)))
+        if self.inputs.multiframe:
+            write_enhanced_dicom(nii_data, templates,
+                                 'nifti2dicom/{}.dcm'.format(basename))
+        else:
+            write_dicom_slices(nii_data, templates, 'nifti2dicom', basename,
+                               num_threads=num_threads)
 
         return runtime
 
@@ -2,29 +2,26 @@ import numpy as np
 import glob
 import json
 import pydicom
-import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 import os.path
-import warnings
 import nibabel as nib
-from nipype.utils.filemanip import split_filename
 from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
                                     traits, TraitedSpec, Directory, File,
                                     isdefined)
 from arcana.utils import split_extension
 from logging import getLogger
 from banana.exceptions import BananaMissingHeaderValue
-
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import nibabel.nicom.csareader as csareader
+from banana.utils.dicom import (
+    siemens_protocol, siemens_phase_encoding, scan_series, distinct)
+from banana.utils.pet import list_mode_acquisitions, parse_time
+# Nii2Dicom used to be duplicated in this module
+from banana.interfaces.converters import (  # noqa: E501 @UnusedImport
+    Nii2DicomInputSpec, Nii2DicomOutputSpec, Nii2Dicom)
 
 
 logger = getLogger('banana')
 
 
-PEDP_TO_SIGN = {0: '-1', 1: '+1'}
-
-
 class DicomHeaderInfoExtractionInputSpec(BaseInterfaceInputSpec):
 
     dicom_folder = Directory(exists=True, desc='Directory with DICOM files',
@@ -65,7 +62,7 @@ class DicomHeaderInfoExtraction(BaseInterface):
         self.outpt = {}
 
         # Read header from first DICOM file in list
-        hd = pydicom.read_file(list_dicom[0])
+        hd = pydicom.dcmread(list_dicom[0], stop_before_pixels=True)
 
         # Get acquisition start time
         try:
@@ -78,27 +75,16 @@ class DicomHeaderInfoExtraction(BaseInterface):
                 raise BananaMissingHeaderValue(
                     'No acquisition time found for this scan.')
 
-        # Get echo times
-        echo_times = set()
-        try:
-            for f in list_dicom:
-                hdr = pydicom.read_file(f, specific_tags=['EchoTime'])
-                echo_time = hdr.EchoTime
-                if echo_time in echo_times:
-                    # Assumes that consequetive echos are in sequence. Maybe
-                    # a bit dangerous but otherwise very expensive
-                    break
-                echo_times.add(hdr.EchoTime)
-        except AttributeError:
-            pass
-        else:
+        # Get echo times, reading only the start of each header
+        echo_times = distinct(scan_series(list_dicom).echo_times)
+        if echo_times:
             # Convert to secs
-            self.outpt['echo_times'] = [float(t) / 1000.0 for t in echo_times]
+            self.outpt['echo_times'] = [t / 1000.0 for t in echo_times]
 
         # Get the orientation of the main magnetic field as a vector
         try:
             img_orient = np.reshape(np.asarray(hd.ImageOrientationPatient),
-                                    newshape=(2, 3))
+                                    (2, 3))
         except AttributeError:
             pass
         else:
@@ -121,43 +107,17 @@ class DicomHeaderInfoExtraction(BaseInterface):
         except AttributeError:
             pass
 
-        # Extract fields that are not read by pydicom
-        dwi_directions = total_duration = phase_offset = tr = ped = None
-
-        with open(list_dicom[0], 'rb') as f:
-            for line in f:
-                try:
-                    line = line[:-1].decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                if 'TotalScan' in line:
-                    total_duration = line.split('=')[-1].strip()
-                    if not self.inputs.multivol:
-                        real_duration = total_duration
-                elif 'alTR[0]' in line:
-                    tr = float(line.split('=')[-1].strip()) / 1000000
-                elif ('SliceArray.asSlice[0].dInPlaneRot' in line and
-                        (not phase_offset or not ped)):
-                    if len(line.split('=')) > 1:
-                        phase_offset = float(line.split('=')[-1].strip())
-                        if (np.abs(phase_offset) > 1 and
-                                np.abs(phase_offset) < 3):
-                            ped = 'ROW'
-                        elif (np.abs(phase_offset) < 1 or
-                                np.abs(phase_offset) > 3):
-                            ped = 'COL'
-                            if np.abs(phase_offset) > 3:
-                                phase_offset = -1
-                            else:
-                                phase_offset = 1
-                elif 'lDiffDirections' in line:
-                    dwi_directions = float(line.split('=')[-1].strip())
+        # Extract fields that are not read by pydicom from the Siemens
+        # protocol (which is only parsed once for each series)
+        protocol = siemens_protocol(list_dicom[0], header=hd)
+        total_duration = protocol.get('lTotalScanTimeSec')
+        real_duration = total_duration if not self.inputs.multivol else None
+        tr = protocol.get('alTR[0]')
+        if tr is not None:
+            tr = float(tr) / 1000000
+        dwi_directions = protocol.get('sDiffusion.lDiffDirections')
 
-        try:
-            phase_offset, ped = self.get_phase_encoding_direction(
-                list_dicom[0])
-        except KeyError:
-            pass  # image does not have ped info in the header
+        phase_offset, ped = siemens_phase_encoding(hd, protocol)
 
         if phase_offset is not None:
             self.outpt['pe_angle'] = str(phase_offset)
@@ -200,16 +160,6 @@ class DicomHeaderInfoExtraction(BaseInterface):
 
         return outputs
 
-    def get_phase_encoding_direction(self, dicom_path):
-
-        dcm = pydicom.read_file(dicom_path)
-        inplane_pe_dir = dcm[int('00181312', 16)].value
-        csa_str = dcm[int('00291010', 16)].value
-        csa_tr = csareader.read(csa_str)
-        pedp = csa_tr['tags']['PhaseEncodingDirectionPositive']['items'][0]
-        sign = PEDP_TO_SIGN[pedp]
-        return sign, inplane_pe_dir
-
 
 class NiftixHeaderInfoExtractionInputSpec(BaseInterfaceInputSpec):
 
@@ -348,21 +298,15 @@ class ScanTimesInfo(BaseInterface):
     output_spec = ScanTimesInfoOutputSpec
 
     def _run_interface(self, runtime):
-        start_times = []
-        for dcm in self.inputs.dicom_infos:
-            dcm_info = []
-            with open(dcm, 'r') as f:
-                for line in f:
-                    dcm_info.append(line.strip())
-                f.close()
-            start_times.append((dcm_info[0], dcm_info[1].split()[-1],
-                                dcm_info[4].split()[-1]))
+        with ThreadPoolExecutor() as executor:
+            start_times = list(executor.map(read_dicom_info,
+                                            self.inputs.dicom_infos))
         start_times = sorted(start_times, key=lambda k: k[1])
         time_info = {}
         for i in range(1, len(start_times)):
             time_info[start_times[i-1][0]] = {}
-            start = dt.datetime.strptime(start_times[i-1][1], '%H%M%S.%f')
-            end = dt.datetime.strptime(start_times[i][1], '%H%M%S.%f')
+            start = parse_time(start_times[i-1][1])
+            end = parse_time(start_times[i][1])
             duration = float((end-start).total_seconds())
             time_info[start_times[i-1][0]]['scan_duration'] = duration
             time_offset = duration - float(start_times[i-1][2])
@@ -385,6 +329,25 @@ class ScanTimesInfo(BaseInterface):
         return outputs
 
 
+def read_dicom_info(path):
+    """
+    Reads the scan name, start time and real duration from the text file
+    summarising the header of a scan
+
+    Returns
+    -------
+    name : str
+        The name of the scan
+    start_time : str
+        The start time of the scan ('HHMMSS.ffffff')
+    real_duration : str
+        The duration of the scan in seconds
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    return (lines[0].strip(), lines[1].split()[-1], lines[4].split()[-1])
+
+
 class PetTimeInfoInputSpec(BaseInterfaceInputSpec):
     pet_data_dir = Directory(exists=True,
                              desc='Directory the the list-mode data.')
@@ -403,50 +366,20 @@ class PetTimeInfo(BaseInterface):
     output_spec = PetTimeInfoOutputSpec
 
     def _run_interface(self, runtime):
-        pet_data_dir = self.inputs.pet_data_dir
         self.dict_output = {}
-        pet_duration = None
-        for root, dirs, files in os.walk(pet_data_dir):
-            bf_files = [f for f in files if not f[0] == '.' and '.bf' in f]
-            dirs[:] = [d for d in dirs if not d[0] == '.']
-
-        if not bf_files:
-            pet_start_time = None
-            pet_endtime = None
+        # Sorted by size so the main list-mode file is first
+        acquisitions = list_mode_acquisitions(self.inputs.pet_data_dir)
+        if not acquisitions:
             logger.warning(
                 'No .bf file found in {}. If you want to perform motion '
-                'correction please provide the right pet data. ')
+                'correction please provide the right pet data. '
+                .format(self.inputs.pet_data_dir))
+            pet_start_time = pet_endtime = pet_duration = None
         else:
-            max_size = 0
-            for bf in bf_files:
-                size = os.path.getsize(os.path.join(root, bf))
-                if size > max_size:
-                    max_size = size
-                    list_mode_file = os.path.join(root, bf)
-
-            pet_image = list_mode_file.split('.bf')[0] + '.dcm'
-            try:
-                hd = pydicom.read_file(pet_image)
-                pet_start_time = hd.AcquisitionTime
-            except AttributeError:
-                pet_start_time = None
-            with open(pet_image, 'rb') as f:
-                for line in f:
-                    try:
-                        line = line[:-1].decode('utf-8')
-                    except UnicodeDecodeError:
-                        continue
-                    if 'image duration' in line:
-                        pet_duration = line.strip()
-                        pet_duration = int(pet_duration.split(':=')[-1])
-            if pet_duration:
-                pet_endtime = ((
-                    dt.datetime.strptime(pet_start_time, '%H%M%S.%f') +
-                    dt.timedelta(seconds=pet_duration))
-                    .strftime('%H%M%S.%f'))
-                pet_duration = pet_duration
-            else:
-                pet_endtime = None
+            acquisition = acquisitions[0]
+            pet_start_time = acquisition.start_time
+            pet_duration = acquisition.duration
+            pet_endtime = acquisition.end_time
         self.dict_output['pet_endtime'] = pet_endtime
         self.dict_output['pet_duration'] = pet_duration
         self.dict_output['pet_start_time'] = pet_start_time
@@ -461,77 +394,3 @@ class PetTimeInfo(BaseInterface):
         outputs["pet_duration"] = self.dict_output['pet_duration']
 
         return outputs
-
-
-class Nii2DicomInputSpec(TraitedSpec):
-    in_file = File(mandatory=True, desc='input nifti file')
-    reference_dicom = traits.List(mandatory=True, desc='original umap')
-#     out_file = Directory(genfile=True, desc='the output dicom file')
-
-
-class Nii2DicomOutputSpec(TraitedSpec):
-    out_file = Directory(exists=True, desc='the output dicom file')
-
-
-class Nii2Dicom(BaseInterface):
-    """
-    Creates two umaps in dicom format
-
-    fully compatible with the UTE analysis:
-
-    Attenuation Correction pipeline
-
-    """
-
-    input_spec = Nii2DicomInputSpec
-    output_spec = Nii2DicomOutputSpec
-
-    def _run_interface(self, runtime):
-        dcms = self.inputs.reference_dicom
-        to_remove = [x for x in dcms if '.dcm' not in x]
-        if to_remove:
-            for f in to_remove:
-                dcms.remove(f)
-        nifti_image = nib.load(self.inputs.in_file)
-        nii_data = nifti_image.get_data()
-        if len(dcms) != nii_data.shape[2]:
-            raise Exception('Different number of nifti and dicom files '
-                            'provided. Dicom to nifti conversion require the '
-                            'same number of files in order to run. Please '
-                            'check.')
-        os.mkdir('nifti2dicom')
-        _, basename, _ = split_filename(self.inputs.in_file)
-        for i in range(nii_data.shape[2]):
-            dcm = pydicom.read_file(dcms[i])
-            nifti = nii_data[:, :, i]
-            nifti = nifti.astype('uint16')
-            dcm.pixel_array.setflags(write=True)
-            dcm.pixel_array.flat[:] = nifti.flat[:]
-            dcm.PixelData = dcm.pixel_array.T.tostring()
-            dcm.save_as('nifti2dicom/{0}_vol{1}.dcm'
-                        .format(basename, str(i).zfill(4)))
-
-        return runtime
-
-    def _list_outputs(self):
-        outputs = self._outputs().get()
-        outputs['out_file'] = (
-            os.getcwd()+'/nifti2dicom')
-        return outputs
-
-    def _gen_filename(self, name):
-        if name == 'out_file':
-            fname = self._gen_outfilename()
-        else:
-            assert False
-        return fname
-
-    def _gen_outfilename(self):
-        if isdefined(self.inputs.out_file):
-            fpath = self.inputs.out_file
-        else:
-            fname = (
-                split_extension(os.path.basename(self.inputs.in_file))[0] +
-                '_dicom')
-            fpath = os.path.join(os.getcwd(), fname)
-        return fpath
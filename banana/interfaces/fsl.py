@@ -17,6 +17,7 @@ import subprocess as sp
 import scipy
 from random import shuffle
 import shutil
+from banana.utils.image import save_image
 
 
 warn = warnings.warn
@@ -176,7 +177,7 @@ class SignalRegression(BaseInterface):
                                    betaICA[bad_components, :])
         im_filt = np.reshape(im2filt.T, (x, y, z, t), order='F')
         im2save = nib.Nifti1Image(im_filt, affine=ref.get_affine())
-        nib.save(
+        save_image(
             im2save, self.inputs.fix_dir+'/filtered_func_data_clean.nii.gz')
 
         return runtime
@@ -196,7 +197,7 @@ class SignalRegression(BaseInterface):
                 np.reshape(confounds.T, (confounds.shape[1], 1, 1,
                                          confounds.shape[0]), order='F'),
                 affine=np.eye(4))
-            nib.save(im2save, self.inputs.fix_dir+'/mc/mc_par_conf.nii.gz')
+            save_image(im2save, self.inputs.fix_dir+'/mc/mc_par_conf.nii.gz')
             cmd = (
                 'fslmaths {0}/mc_par_conf.nii.gz -bptf {1} -1 '
                 '{0}/mc_par_conf_hp'.format(self.inputs.fix_dir+'/mc',
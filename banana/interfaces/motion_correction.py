@@ -12,6 +12,8 @@ import nibabel as nib
 from nipype.interfaces.base import isdefined
 import scipy.ndimage.measurements as snm
 import datetime as dt
+import copy
+from concurrent.futures import ThreadPoolExecutor
 try:
     import matplotlib
     matplotlib.use('Agg')
@@ -1318,6 +1320,12 @@ class CreateMocoSeriesInputSpec(BaseInterfaceInputSpec):
                        'the sequences (or volumes) acquired in the analysis ('
                        'this is the output of the mean displacement calculatio'
                        'n pipeline).')
+    out_dir = Directory(desc='Directory to write the new moco series into '
+                        '(created if it doesn\'t exist). Defaults to '
+                        '\'new_moco_series\' in the working directory')
+    num_threads = traits.Int(desc='The number of threads used to write the '
+                             'series (defaults to the ThreadPoolExecutor '
+                             'default)')
 
 
 class CreateMocoSeriesOutputSpec(TraitedSpec):
@@ -1344,27 +1352,36 @@ class CreateMocoSeries(BaseInterface):
                             'order to create a new moco series. Please check.')
         motion_par_moco = [self.fsl2moco(x) for x in motion_par]
         new_uid = pydicom.uid.generate_uid()
-        for i in range(len(start_times)):
-            hd = pydicom.read_file(moco_template)
-            for n in range(3):
-                hd[0x19, 0x1025].value[n] = motion_par_moco[i][n]
-            for n in range(3):
-                hd[0x19, 0x1026].value[n] = motion_par_moco[i][n + 3]
+        out_dir = self._out_dir()
+        os.makedirs(out_dir, exist_ok=True)
+        # Parse the template once instead of for each time point
+        template = pydicom.dcmread(moco_template)
+        template.SeriesInstanceUID = new_uid
+        template.SeriesDescription = 'MoCoSeries'
+        template.SeriesNumber = '150'
+
+        def write(i):
+            hd = copy.deepcopy(template)
+            hd[0x19, 0x1025].value = motion_par_moco[i][:3]
+            hd[0x19, 0x1026].value = motion_par_moco[i][3:]
             hd.AcquisitionTime = start_times[i]
             hd.InstanceNumber = pydicom.valuerep.IS(i + 1)
             hd.AcquisitionNumber = pydicom.valuerep.IS(i + 1)
-            hd.SeriesInstanceUID = new_uid
-            hd.SeriesDescription = 'MoCoSeries'
-            hd.SeriesNumber = '150'
-            hd.save_as('{}.IMA'.format(str(i).zfill(6)))
+            hd.save_as(op.join(out_dir, '{}.IMA'.format(str(i).zfill(6))))
 
-        os.mkdir('new_moco_series')
-        dicoms = sorted(glob.glob('*.IMA'))
-        for dcm in dicoms:
-            shutil.move(dcm, 'new_moco_series')
+        num_threads = (self.inputs.num_threads
+                       if isdefined(self.inputs.num_threads) else None)
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            # Consume the results so any exceptions are raised here
+            list(executor.map(write, range(len(start_times))))
 
         return runtime
 
+    def _out_dir(self):
+        if isdefined(self.inputs.out_dir):
+            return op.abspath(self.inputs.out_dir)
+        return op.join(os.getcwd(), 'new_moco_series')
+
     def fsl2moco(self, mp):
         rot_x_moco = -self.rad2degree(mp[1])
         rot_y_moco = self.rad2degree(mp[0])
@@ -1381,7 +1398,7 @@ class CreateMocoSeries(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["modified_moco"] = os.getcwd() + '/new_moco_series'
+        outputs["modified_moco"] = self._out_dir()
 
         return outputs
 
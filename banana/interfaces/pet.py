@@ -13,6 +13,7 @@ import shutil
 import glob
 import pydicom
 from nipype.interfaces import fsl
+from banana.utils.image import save_image
 
 
 list_mode_framing_path = os.path.abspath(
@@ -82,7 +83,7 @@ class PETdr(BaseInterface):
 
         im2save = nib.Nifti1Image(
             sm_zscore.reshape(spatial_regressor.shape), affine=img.affine)
-        nib.save(
+        save_image(
             im2save, '{0}_{1}_GLM_fit_zscore.nii.gz'.format(base, base_map))
 
         plot.plot(timecourse)
@@ -148,7 +149,7 @@ class GlobalTrendRemoval(BaseInterface):
         new_ts = ts.T-np.dot(baseline, np.dot(np.linalg.pinv(baseline), ts.T))
         im2save = nib.Nifti1Image(
             new_ts.T.reshape(data.shape), affine=img.affine)
-        nib.save(
+        save_image(
             im2save, '{}_baseline_removed.nii.gz'.format(base))
 
         return runtime
@@ -200,7 +201,7 @@ class SUVRCalculation(BaseInterface):
         mean_uptake = np.mean(data[x[ii], y[ii], z[ii]])
         new_data = data / mean_uptake
         im2save = nib.Nifti1Image(new_data, affine=img.affine)
-        nib.save(im2save, '{}_SUVR.nii.gz'.format(base))
+        save_image(im2save, '{}_SUVR.nii.gz'.format(base))
 
         return runtime
 
@@ -560,7 +561,7 @@ class PETFovCropping(BaseInterface):
         im2save = nib.Nifti1Image(pet_cropped, affine=new_affine)
         im2save.set_qform(new_affine, code='scanner')
         im2save.set_sform(new_affine, code='scanner')
-        nib.save(im2save, outname)
+        save_image(im2save, outname)
 
         return runtime
 
@@ -14,6 +14,7 @@ from nipype.interfaces.base import (
     TraitedSpec, traits, BaseInterface, BaseInterfaceInputSpec, File,
     Directory, isdefined)
 from banana.exceptions import BananaUsageError
+from banana.utils.image import save_image, precision_dtype, PRECISIONS
 logger = logging.getLogger('banana')
 
 
@@ -27,6 +28,8 @@ class HipCombineChannelsInputSpec(BaseInterfaceInputSpec):
     q = File(genfile=True, desc="Q image")
     r2star = File(genfile=True, desc="R2* image")
     echo_times = traits.List(traits.Float, mandatory=True, desc="Echo times")
+    precision = traits.Enum(*PRECISIONS, usedefault=True, desc=(
+        "The precision to compute and store the images in"))
 
 
 class HipCombineChannelsOutputSpec(TraitedSpec):
@@ -49,15 +52,17 @@ class HipCombineChannels(BaseInterface):
 
     def _list_outputs(self):
         outputs = self._outputs().get()
+        dtype = precision_dtype(self.inputs.precision)
         hip = None
         for fname in os.listdir(self.inputs.channels_dir):
             img = nib.load(op.join(self.inputs.channels_dir, fname))
-            img_data = img.get_fdata()
+            img_data = img.get_fdata(dtype=dtype)
             if hip is None:
-                hip = np.zeros(img_data.shape[:3], dtype=complex)
-                sum_mag = np.zeros(img_data.shape[:3])
-                r2star = np.zeros(img_data.shape[:3])
-                mag = np.zeros(img_data.shape[:3])
+                hip = np.zeros(img_data.shape[:3],
+                               dtype=np.result_type(dtype, np.complex64))
+                sum_mag = np.zeros(img_data.shape[:3], dtype=dtype)
+                r2star = np.zeros(img_data.shape[:3], dtype=dtype)
+                mag = np.zeros(img_data.shape[:3], dtype=dtype)
             num_echos = img_data.shape[3]
             if len(self.inputs.echo_times) != num_echos:
                 raise BananaUsageError(
@@ -104,10 +109,11 @@ class HipCombineChannels(BaseInterface):
         q_img = nib.Nifti1Image(q, img.affine, img.header)
         r2star_img = nib.Nifti1Image(r2star, img.affine, img.header)
         # Save NIfTIs
-        nib.save(phase_img, outputs['phase'])
-        nib.save(mag_img, outputs['magnitude'])
-        nib.save(q_img, outputs['q'])
-        nib.save(r2star_img, outputs['r2star'])
+        precision = self.inputs.precision
+        save_image(phase_img, outputs['phase'], precision=precision)
+        save_image(mag_img, outputs['magnitude'], precision=precision)
+        save_image(q_img, outputs['q'], precision=precision)
+        save_image(r2star_img, outputs['r2star'], precision=precision)
         return outputs
 
     def _gen_filename(self, name):
@@ -168,10 +174,10 @@ def arlo(te, y):
             'Last dimension of y has size {}, expected {}'.format(
                 y.shape[-1], num_echos))
 
-    yy = np.zeros(y.shape[:3])
-    yx = np.zeros(y.shape[:3])
-    beta_yx = np.zeros(y.shape[:3])
-    beta_xx = np.zeros(y.shape[:3])
+    yy = np.zeros(y.shape[:3], dtype=y.dtype)
+    yx = np.zeros(y.shape[:3], dtype=y.dtype)
+    beta_yx = np.zeros(y.shape[:3], dtype=y.dtype)
+    beta_xx = np.zeros(y.shape[:3], dtype=y.dtype)
 
     for j in range(num_echos - 2):
         alpha = ((te[j + 2] - te[j]) * (te[j + 2] - te[j]) / 2) / (te[j + 1] -
@@ -210,6 +216,8 @@ class SwiInputSpec(BaseInterfaceInputSpec):
     out_file = File(genfile=True, desc="Path for generated SWI image")
     alpha = traits.Int(4, usedefault=True,
                        desc="The power which the phase image is raised to")
+    precision = traits.Enum(*PRECISIONS, usedefault=True, desc=(
+        "The precision to compute and store the SWI image in"))
 
 
 class SwiOutputSpec(TraitedSpec):
@@ -232,9 +240,10 @@ class Swi(BaseInterface):
         mag_img = nib.load(self.inputs.magnitude)
         tissue_phase_img = nib.load(self.inputs.tissue_phase)
         mask_img = nib.load(self.inputs.mask)
-        mag = mag_img.get_fdata()
-        tissue_phase = tissue_phase_img.get_fdata()
-        mask = np.array(mask_img.get_fdata(), dtype=bool)
+        dtype = precision_dtype(self.inputs.precision)
+        mag = mag_img.get_fdata(dtype=dtype)
+        tissue_phase = tissue_phase_img.get_fdata(dtype=dtype)
+        mask = np.asarray(mask_img.dataobj).astype(bool)
         if mag.shape != tissue_phase.shape:
             raise BananaUsageError(
                 "Dimensions of provided magnitude and phase images "
@@ -246,7 +255,8 @@ class Swi(BaseInterface):
         # Set filenames in output spec
         outputs['out_file'] = self._gen_filename('out_file')
         out_file_img = nib.Nifti1Image(swi, mag_img.affine, mag_img.header)
-        nib.save(out_file_img, outputs['out_file'])
+        save_image(out_file_img, outputs['out_file'],
+                   precision=self.inputs.precision)
         return outputs
 
     def _gen_filename(self, name):
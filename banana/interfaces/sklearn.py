@@ -6,6 +6,7 @@ import numpy as np
 from sklearn.decomposition import FastICA as fICA
 from nipype.utils.filemanip import split_filename
 import os
+from banana.utils.image import save_image, precision_dtype, PRECISIONS
 
 
 class FastICAInputSpec(BaseInterfaceInputSpec):
@@ -16,6 +17,8 @@ class FastICAInputSpec(BaseInterfaceInputSpec):
                               mandatory=True)
     ica_type = traits.Str(desc='Type of ICA to run. Possible types are '
                           'spatial (default) and temporal.', default='spatial')
+    precision = traits.Enum(*PRECISIONS, usedefault=True, desc=(
+        'The precision to compute and store the ICA decomposition in'))
 
 
 class FastICAOutputSpec(TraitedSpec):
@@ -36,7 +39,8 @@ class FastICA(BaseInterface):
         fname = self.inputs.volume
         img = nib.load(fname)
         comp = self.inputs.n_components
-        data = np.array(img.get_data())
+        dtype = precision_dtype(self.inputs.precision)
+        data = img.get_fdata(dtype=dtype)
 
         n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
         ts = data.reshape(n_voxels, data.shape[3])
@@ -61,8 +65,10 @@ class FastICA(BaseInterface):
             tc = ica.components_.T[:]
 
         ica_zscore = np.zeros((data.shape[0], data.shape[1],
-                               data.shape[2], self.inputs.n_components))
-        ica_tc = np.zeros((data.shape[3], self.inputs.n_components))
+                               data.shape[2], self.inputs.n_components),
+                              dtype=dtype)
+        ica_tc = np.zeros((data.shape[3], self.inputs.n_components),
+                          dtype=dtype)
         for i in range(self.inputs.n_components):
             dt = sm[:, i]-np.mean(sm[:, i])
             num = np.mean(dt**3)
@@ -89,12 +95,14 @@ class FastICA(BaseInterface):
 
         im2save = nib.Nifti1Image(ica_zscore, affine=img.affine)
         tc2save = nib.Nifti1Image(ica_tc, affine=np.eye(4))
-        nib.save(
+        save_image(
             im2save, '{0}_{1}_results_pc{2}_zscore.nii.gz'
-            .format(base, outname, str(self.inputs.n_components)))
-        nib.save(
+            .format(base, outname, str(self.inputs.n_components)),
+            precision=self.inputs.precision)
+        save_image(
             tc2save, '{0}_{1}_timecourse_pc{2}.nii.gz'
-            .format(base, outname, str(self.inputs.n_components)))
+            .format(base, outname, str(self.inputs.n_components)),
+            precision=self.inputs.precision)
         np.savetxt(
             '{0}_{1}_mixing_matrix_pc{2}.txt'.format(
                 base, outname, str(self.inputs.n_components)), S_)
@@ -7,9 +7,10 @@ Created on 1 Sep. 2017
 
 import os.path
 from nipype.interfaces.base import (
-    TraitedSpec, BaseInterface, File, isdefined)
+    TraitedSpec, BaseInterface, File, isdefined, traits)
 import nibabel as nib
 import numpy as np
+from banana.utils.image import save_image, precision_dtype, PRECISIONS
 
 
 class CoreUmapCalcInputSpec(TraitedSpec):
@@ -23,6 +24,8 @@ class CoreUmapCalcInputSpec(TraitedSpec):
     sute_fix_template = File(
         genfile=True,
         desc='sute fixed map in template space')
+    precision = traits.Enum(*PRECISIONS, usedefault=True, desc=(
+        'The precision to compute and store the umaps in'))
 
 
 class CoreUmapCalcOutputSpec(TraitedSpec):
@@ -45,9 +48,12 @@ class CoreUmapCalc(BaseInterface):
         bones = nib.load(self.inputs.bones__mask)
         ute1 = nib.load(self.inputs.ute1_reg)
         ute2 = nib.load(self.inputs.ute2_reg)
+        dtype = precision_dtype(self.inputs.precision)
+        air_data = air.get_fdata(dtype=dtype)
+        bones_data = bones.get_fdata(dtype=dtype)
 
-        r2star_map = 1000. * (np.log(np.array(ute1.get_data())) -
-                              np.log(np.array(ute2.get_data()))) / 2.39
+        r2star_map = 1000. * (np.log(ute1.get_fdata(dtype=dtype)) -
+                              np.log(ute2.get_fdata(dtype=dtype))) / 2.39
         nans = np.isnan(r2star_map)
         r2star_map[nans] = 0
 
@@ -73,26 +79,28 @@ class CoreUmapCalc(BaseInterface):
         u_soft_fixed = 0.1
         u_air = 0.
 
-        umap = 10000. * (u_air * np.array(air.get_data()) +
-                         u_bone * np.array(bones.get_data()) +
-                         (1 - np.array(bones.get_data())) *
-                         (1 - np.array(air.get_data())) * u_soft_fixed)
+        umap = 10000. * (u_air * air_data +
+                         u_bone * bones_data +
+                         (1 - bones_data) *
+                         (1 - air_data) * u_soft_fixed)
 
         nans = np.isnan(umap)
         umap[nans] = 0
         save_im = nib.Nifti1Image(umap, affine=ute1.affine)
-        nib.save(save_im, self._gen_filename('sute_cont_template'))
+        save_image(save_im, self._gen_filename('sute_cont_template'),
+                   precision=self.inputs.precision)
 
         u_bone2 = 0.151
-        umap2 = 10000. * (u_air * np.array(air.get_data()) +
-                          u_bone2 * np.array(bones.get_data()) +
-                          (1 - np.array(bones.get_data())) *
-                          (1 - np.array(air.get_data())) * u_soft_fixed)
+        umap2 = 10000. * (u_air * air_data +
+                          u_bone2 * bones_data +
+                          (1 - bones_data) *
+                          (1 - air_data) * u_soft_fixed)
 
         nans = np.isnan(umap2)
         umap2[nans] = 0
         save_im = nib.Nifti1Image(umap2, affine=ute1.affine)
-        nib.save(save_im, self._gen_filename('sute_fix_template'))
+        save_image(save_im, self._gen_filename('sute_fix_template'),
+                   precision=self.inputs.precision)
 
         return runtime
 
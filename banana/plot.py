@@ -48,7 +48,12 @@ class ImageDisplayMixin():
         # Loop through derivatives and generate image
         for i, (fileset, rkwargs) in enumerate(zip(filesets,
                                                    row_kwargs)):
-            array = fileset.get_array()
+            array = fileset.get_array(lazy=True)
+            if len(array.shape) > 3:
+                # Only display the first volume of 4-D images, which avoids
+                # reading the whole series into memory
+                array = array[:, :, :, 0]
+            array = np.array(array)
             header = fileset.get_header()
             if fileset.format in (nifti_format, nifti_gz_format):
                 vox = header['pixdim'][1:4]
@@ -103,7 +108,9 @@ class ImageDisplayMixin():
             # grid
             options = ['-tractography.load', tck.path, '-noannotations']
             if offset is not None:
-                array = bg.get_array()
+                array = bg.get_array(lazy=True)
+                if len(array.shape) > 3:
+                    array = array[:, :, :, 0]
                 centre = self.image_centre(array, offset)
                 options.extend(['-voxel', '{},{},{}'.format(*centre)])
             # Set options to remove cursor, capture hte image and exit
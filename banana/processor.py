@@ -0,0 +1,111 @@
+import math
+from logging import getLogger
+from arcana.exceptions import ArcanaJobSubmittedException
+from arcana.processor.base import Processor
+from arcana.processor import SlurmProc as ArcanaSlurmProc
+
+
+logger = getLogger('banana')
+
+
+class SlurmProc(ArcanaSlurmProc):
+    """
+    Extends Arcana's SLURM processor to request the wall time and memory of
+    each job from the resources recorded for the node in previous runs
+    (e.g. by 'banana derive --profile') instead of the values hard-coded in
+    the pipeline, falling back to the hard-coded values for nodes that
+    haven't been recorded
+
+    Parameters
+    ----------
+    work_dir : str
+        A directory in which to run the nipype workflows
+    history : RunHistory | None
+        The history of previous runs to estimate the resources from
+    time_margin : float
+        The factor the mean recorded wall time is multiplied by
+    mem_margin : float
+        The factor the maximum recorded peak memory is multiplied by
+    kwargs : dict
+        Keyword arguments passed to Arcana's SlurmProc
+    """
+
+    # Minutes added to the estimated wall time of each job to allow for the
+    # node to be loaded and its results saved
+    WALL_TIME_OVERHEAD = 5
+
+    # Minimum memory (GB) requested for each job
+    MIN_MEM_GB = 1.0
+
+    # Default factors the recorded wall time and peak memory are multiplied by
+    TIME_MARGIN = 1.5
+    MEM_MARGIN = 1.25
+
+    def __init__(self, work_dir, history=None, time_margin=TIME_MARGIN,
+                 mem_margin=MEM_MARGIN, **kwargs):
+        self._history = history
+        self._time_margin = time_margin
+        self._mem_margin = mem_margin
+        self._estimates = None
+        super().__init__(work_dir, **kwargs)
+
+    @property
+    def history(self):
+        return self._history
+
+    def run(self, *pipelines, **kwargs):
+        """
+        Submits the pipelines to the SLURM scheduler in a single workflow (see
+        arcana.processor.base.Processor.run). Arcana's SlurmProc only accepts
+        a single pipeline, so batches of pipelines (e.g. from derive_batch)
+        couldn't otherwise be submitted together
+        """
+        Processor.run(self, *pipelines, **kwargs)
+        raise ArcanaJobSubmittedException(
+            "Pipelines '{}' have been submitted to the SLURM scheduler for "
+            "processing. Please run the script again after the jobs have "
+            "completed successfully".format(
+                "', '".join(p.name for p in pipelines)))
+
+    def slurm_template(self, node):
+        estimate = self.estimate(node)
+        if estimate is not None:
+            wall_time, mem_gb = estimate
+            logger.debug("Requesting %s minutes and %s GB for '%s' from "
+                         "recorded runs", wall_time, mem_gb, node.name)
+            # The exec-graph copy of the node is only used to run this job
+            node._wall_time = wall_time
+            node._mem_gb = mem_gb
+        return super().slurm_template(node)
+
+    def estimate(self, node):
+        """
+        Estimates the wall time (in minutes) and memory (in GB) to request
+        for a node from the run history
+
+        Parameters
+        ----------
+        node : Node
+            The node to estimate the resources of
+
+        Returns
+        -------
+        estimate : tuple(float, float) | None
+            The wall time and memory to request, or None if the node hasn't
+            been recorded
+        """
+        if self._history is None:
+            return None
+        if self._estimates is None:
+            self._estimates = self._history.estimates()
+        pipeline = (node._hierarchy or '').split('.')[-1]
+        estimate = self._estimates.get((pipeline, node.name))
+        if estimate is None:
+            return None
+        wall_time = math.ceil(estimate.wall_time * self._time_margin
+                              + self.WALL_TIME_OVERHEAD)
+        if estimate.mem_gb is not None:
+            mem_gb = max(estimate.mem_gb * self._mem_margin, self.MIN_MEM_GB)
+        else:
+            mem_gb = node.mem_gb
+        return wall_time, mem_gb
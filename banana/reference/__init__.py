@@ -1,8 +1,7 @@
-import os
 import os.path as op
 from copy import copy
 import banana
-from banana.requirement import fsl_req
+from banana.requirement import fsl_req, fsl_dir
 from arcana.exceptions import ArcanaError
 from arcana import Fileset, FilesetSlice
 
@@ -122,13 +121,10 @@ class FslReferenceData(BaseReference):
         if self._dataset is not None:
             full_atlas_name += '_' + self._dataset
         fsl_ver = self.analysis.environment.satisfy(fsl_req.v('5.0.8'))[0]
-        if hasattr(self.analysis.environment, 'load'):
-            self.analysis.environment.load(fsl_ver)
-            fsl_dir = os.environ['FSLDIR']
-            self.analysis.environment.unload(fsl_ver)
-        else:
-            fsl_dir = os.environ['FSLDIR']  # Static environments
-        return op.join(fsl_dir, 'data', *self._sub_path,
+        # Avoid loading the FSL module just to read FSLDIR if it has been
+        # read previously
+        fsl_home = fsl_dir(fsl_ver, self.analysis.environment)
+        return op.join(fsl_home, 'data', *self._sub_path,
                        full_atlas_name + '.nii.gz')
 
     def translate(self, subcomp_spec):
@@ -0,0 +1,332 @@
+"""
+A registry of the Analysis classes available in a set of packages, built by
+statically scanning (i.e. parsing but not importing) the modules in the
+packages. Parsed modules are cached between runs and only re-parsed when
+their modification time or size changes, so the registry can be used to list
+and locate analysis classes without importing Arcana, Nipype or any of the
+other (unrelated) analysis modules.
+
+NB: this module is used by the command-line tool at start-up so it
+shouldn't import anything outside the standard library
+"""
+import os
+import os.path as op
+import ast
+import json
+import tempfile
+from importlib.util import find_spec
+from collections import namedtuple
+from logging import getLogger
+
+
+logger = getLogger('banana')
+
+REGISTRY_CACHE_ENV = 'BANANA_REGISTRY_CACHE'
+
+# Increment when the information extracted from each module changes to
+# invalidate existing caches
+REGISTRY_VERSION = 1
+
+# Names of the base classes that make a class an analysis class, in addition
+# to other analysis classes found in the scanned modules
+ANALYSIS_BASES = ('Analysis', 'MultiAnalysis')
+
+
+AnalysisClassInfo = namedtuple('AnalysisClassInfo', [
+    'module', 'name', 'desc', 'data_specs', 'param_specs', 'paths'])
+AnalysisClassInfo.__doc__ = """
+The information about an analysis class recorded in the registry
+
+Parameters
+----------
+module : str
+    The module the class is defined in
+name : str
+    The name of the class
+desc : str | None
+    The description of the class (None if it doesn't define its own)
+data_specs : list[str]
+    The names of the data specs added by the class
+param_specs : list[str]
+    The names of the parameter specs added by the class
+paths : list[str]
+    The modules/packages the class can be imported from (i.e. its defining
+    module and any packages that import it into their namespace)
+"""
+
+
+class AnalysisRegistry(object):
+    """
+    Scans the modules in a set of packages for analysis classes
+
+    Parameters
+    ----------
+    search_paths : list[str]
+        The packages to scan for analysis classes
+    cache_path : str | None
+        The path of the JSON file the parsed modules are cached in. Defaults
+        to the value of the BANANA_REGISTRY_CACHE environment variable or
+        'banana/analysis-registry.json' in the user's cache directory
+    """
+
+    def __init__(self, search_paths=('banana.analysis',), cache_path=None):
+        self.search_paths = list(search_paths)
+        if cache_path is None:
+            cache_path = os.environ.get(REGISTRY_CACHE_ENV, op.join(
+                os.environ.get('XDG_CACHE_HOME',
+                               op.join(op.expanduser('~'), '.cache')),
+                'banana', 'analysis-registry.json'))
+        self.cache_path = cache_path
+        self._classes = None
+
+    @property
+    def classes(self):
+        """
+        The analysis classes in the search paths
+
+        Returns
+        -------
+        classes : list[AnalysisClassInfo]
+            The recorded information about each analysis class
+        """
+        if self._classes is None:
+            self._classes = self._scan()
+        return self._classes
+
+    def find(self, class_str):
+        """
+        Finds the analysis classes matching a '.' delimited module + class
+        name string, without importing any modules
+
+        Parameters
+        ----------
+        class_str : str
+            The name of the class preceded by the module or package it can be
+            imported from, e.g. 'banana.analysis.mri.T1wAnalysis'
+
+        Returns
+        -------
+        matches : list[AnalysisClassInfo]
+            The matching classes
+        """
+        module_path, _, name = class_str.rpartition('.')
+        return [c for c in self.classes
+                if c.name == name and module_path in c.paths]
+
+    def _scan(self):
+        cache = self._load_cache()
+        modules = {}
+        for search_path in self.search_paths:
+            spec = find_spec(search_path)
+            if spec is None or not spec.submodule_search_locations:
+                logger.warning("Could not find package '%s' to scan for "
+                               "analysis classes", search_path)
+                continue
+            for pkg_dir in spec.submodule_search_locations:
+                modules.update(self._scan_package(search_path, pkg_dir,
+                                                  cache))
+        if any(cache.get(p) is not m for p, m in modules.items()):
+            # Keep the entries of other search paths that still exist
+            cache.update(modules)
+            self._save_cache({p: m for p, m in cache.items()
+                              if p in modules or op.exists(p)})
+        # Determine which classes are analysis classes by following their
+        # bases (by name) until one of ANALYSIS_BASES is reached
+        all_classes = [(m['module'], c) for m in modules.values()
+                       for c in m['classes']]
+        analysis_names = set(ANALYSIS_BASES)
+        changed = True
+        while changed:
+            changed = False
+            for _, cls in all_classes:
+                if (cls['name'] not in analysis_names
+                        and (analysis_names & set(cls['bases'])
+                             or (cls['metaclass'] or '').endswith(
+                                 'AnalysisMetaClass'))):
+                    analysis_names.add(cls['name'])
+                    changed = True
+        exports = {m['module']: m['exports'] for m in modules.values()}
+        classes = []
+        for module, cls in all_classes:
+            if cls['name'] not in analysis_names:
+                continue
+            paths = [module] + sorted(
+                pkg for pkg in exports
+                if self._origin(exports, pkg, cls['name']) == module
+                and pkg != module)
+            classes.append(AnalysisClassInfo(
+                module=module, name=cls['name'], desc=cls['desc'],
+                data_specs=cls['data_specs'],
+                param_specs=cls['param_specs'], paths=paths))
+        return classes
+
+    @classmethod
+    def _origin(cls, exports, module, name):
+        """
+        Follows the imports of a name from a module back to the module it is
+        defined in
+        """
+        visited = set()
+        while name in exports.get(module, {}) and module not in visited:
+            visited.add(module)
+            module = exports[module][name]
+        return module
+
+    def _scan_package(self, pkg_name, pkg_dir, cache):
+        """
+        Parses the modules in a package directory and its sub-packages,
+        reusing the cached entries of modules that haven't changed
+        """
+        modules = {}
+        for dpath, dnames, fnames in os.walk(pkg_dir):
+            if '__init__.py' not in fnames:
+                dnames[:] = []
+                continue
+            dnames[:] = sorted(d for d in dnames
+                               if not d.startswith(('.', '_')))
+            rel_dir = op.relpath(dpath, pkg_dir)
+            dir_module = pkg_name if rel_dir == '.' else '.'.join(
+                [pkg_name] + rel_dir.split(os.sep))
+            for fname in sorted(fnames):
+                if not fname.endswith('.py'):
+                    continue
+                path = op.join(dpath, fname)
+                stat = os.stat(path)
+                cached = cache.get(path)
+                if (cached is not None and cached['mtime'] == stat.st_mtime_ns
+                        and cached['size'] == stat.st_size):
+                    modules[path] = cached
+                    continue
+                is_pkg = fname == '__init__.py'
+                module = (dir_module if is_pkg
+                          else dir_module + '.' + fname[:-len('.py')])
+                try:
+                    info = parse_module(path, module, is_pkg)
+                except SyntaxError:
+                    logger.warning("Could not parse '%s' when scanning for "
+                                   "analysis classes", path)
+                    continue
+                info.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+                modules[path] = info
+        return modules
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if cache.get('version') != REGISTRY_VERSION:
+            return {}
+        return cache['modules']
+
+    def _save_cache(self, modules):
+        cache_dir = op.dirname(self.cache_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file and rename so that concurrent readers
+            # never see a partially written cache
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': REGISTRY_VERSION, 'modules': modules},
+                          f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            logger.debug("Could not write analysis registry cache to '%s'",
+                         self.cache_path)
+
+
+def parse_module(path, module, is_pkg=False):
+    """
+    Statically extracts the classes defined in a module and the names it
+    imports from other modules
+
+    Parameters
+    ----------
+    path : str
+        Path to the module file
+    module : str
+        The name of the module
+    is_pkg : bool
+        Whether the module is the __init__ of a package (required to resolve
+        relative imports)
+
+    Returns
+    -------
+    info : dict
+        The name of the module, the classes it defines ('classes') and the
+        names it imports mapped to the modules they are imported from
+        ('exports')
+    """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+    package = module if is_pkg else module.rpartition('.')[0]
+    classes = []
+    exports = {}
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            classes.append(_parse_class(node))
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = package.split('.')
+                if node.level > 1:
+                    base = base[:-(node.level - 1)]
+                from_module = '.'.join(base + ([node.module]
+                                               if node.module else []))
+            else:
+                from_module = node.module
+            for alias in node.names:
+                if alias.name != '*':
+                    exports[alias.asname or alias.name] = from_module
+    return {'module': module, 'classes': classes, 'exports': exports}
+
+
+def _parse_class(node):
+    bases = [_dotted_name(b).rpartition('.')[2] for b in node.bases]
+    metaclass = next((_dotted_name(k.value) for k in node.keywords
+                      if k.arg == 'metaclass'), None)
+    desc = None
+    data_specs = []
+    param_specs = []
+    for stmt in node.body:
+        if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                and isinstance(stmt.targets[0], ast.Name)):
+            continue
+        target = stmt.targets[0].id
+        if target == 'desc':
+            try:
+                desc = ast.literal_eval(stmt.value)
+            except ValueError:
+                pass
+        elif target == 'add_data_specs':
+            data_specs = _spec_names(stmt.value)
+        elif target == 'add_param_specs':
+            param_specs = _spec_names(stmt.value)
+    return {'name': node.name, 'bases': bases, 'metaclass': metaclass,
+            'desc': desc, 'data_specs': data_specs,
+            'param_specs': param_specs}
+
+
+def _spec_names(node):
+    """
+    Returns the names of the specs in a list of spec constructors (or a sum
+    of such lists)
+    """
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _spec_names(node.left) + _spec_names(node.right)
+    names = []
+    if isinstance(node, (ast.List, ast.Tuple)):
+        for elt in node.elts:
+            if (isinstance(elt, ast.Call) and elt.args
+                    and isinstance(elt.args[0], ast.Constant)
+                    and isinstance(elt.args[0].value, str)):
+                names.append(elt.args[0].value)
+    return names
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        return _dotted_name(node.value) + '.' + node.attr
+    return ''
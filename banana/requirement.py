@@ -3,6 +3,9 @@ import os
 import os.path as op
 import platform
 import re
+import json
+import shutil
+import tempfile
 import logging
 import xml.etree.ElementTree
 from arcana.environment.requirement import (  # pylint: disable=unused-import
@@ -12,11 +15,220 @@ from arcana.utils import run_matlab_cmd
 from arcana.exceptions import (
     ArcanaRequirementNotFoundError, ArcanaVersionNotDetectableError)
 
-# Command line requirements
 logger = logging.getLogger('banana')
 
+REQUIREMENT_CACHE_ENV = 'BANANA_REQUIREMENT_CACHE'
+
+# Increment when the format of the cache changes to invalidate existing
+# caches
+REQUIREMENT_CACHE_VERSION = 1
+
+# Environment variable set by environment modules (and Lmod) that lists the
+# loaded modules
+LOADED_MODULES_ENV = 'LOADEDMODULES'
+
+
+class RequirementCache(object):
+    """
+    A persistent cache of detected requirement versions, keyed by a
+    fingerprint of the installation they were detected from (e.g. the path
+    and modification time of an executable) and the loaded environment
+    modules, so that installations aren't probed (e.g. by launching MATLAB)
+    every time an environment is satisfied
+
+    Parameters
+    ----------
+    path : str | None
+        Path to the JSON file the cache is stored in. If None the cache is
+        only held in memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries[key] = value
+        if self.path is not None:
+            # Merge with entries saved by other processes in the meantime
+            entries = self._load()
+            entries[key] = value
+            self._save(entries)
+
+    def clear(self):
+        """
+        Invalidates all cached versions
+        """
+        self._entries = {}
+        if self.path is not None and op.exists(self.path):
+            os.remove(self.path)
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if cache.get('version') != REQUIREMENT_CACHE_VERSION:
+            return {}
+        return cache['entries']
+
+    def _save(self, entries):
+        cache_dir = op.dirname(self.path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': REQUIREMENT_CACHE_VERSION,
+                           'entries': entries}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.debug("Could not write requirement cache to '%s'",
+                         self.path)
+
+
+_requirement_cache = None
+
+
+def requirement_cache():
+    """
+    Returns the requirement cache of the process, stored at the path in the
+    BANANA_REQUIREMENT_CACHE environment variable or
+    'banana/requirements.json' in the user's cache directory. If the
+    environment variable is set to an empty string the cache is only held in
+    memory
+    """
+    global _requirement_cache
+    path = os.environ.get(REQUIREMENT_CACHE_ENV, op.join(
+        os.environ.get('XDG_CACHE_HOME',
+                       op.join(op.expanduser('~'), '.cache')),
+        'banana', 'requirements.json')) or None
+    if _requirement_cache is None or _requirement_cache.path != path:
+        _requirement_cache = RequirementCache(path)
+    return _requirement_cache
+
+
+def file_fingerprint(path):
+    """
+    Returns a string that changes when the file at the given path is
+    replaced or modified
+    """
+    path = op.realpath(path)
+    stat = os.stat(path)
+    return '{}:{}:{}'.format(path, stat.st_mtime_ns, stat.st_size)
+
+
+class CachedRequirementMixin():
+    """
+    Caches the versions detected by a requirement in the requirement cache,
+    keyed by the fingerprint returned by 'detection_key'
+    """
+
+    def detection_key(self):
+        """
+        Returns a key that identifies the installation the version would be
+        detected from without probing it, or None if the installation can't
+        be identified (in which case the version isn't cached)
+        """
+        raise NotImplementedError
+
+    def detect_version(self, **kwargs):
+        try:
+            key = self.detection_key()
+        except OSError:
+            key = None
+        if key is None:
+            return super().detect_version(**kwargs)
+        key = '|'.join((type(self).__name__, self.name, key,
+                        os.environ.get(LOADED_MODULES_ENV, '')))
+        cache = requirement_cache()
+        version_str = cache.get(key)
+        if version_str is None:
+            version_str = self.detect_version_str()
+            cache.set(key, version_str)
+        return self.version_cls(self, version_str, **kwargs)
+
+
+class CachedCliRequirement(CachedRequirementMixin, CliRequirement):
+    """
+    A command-line requirement whose detected version is cached against
+    the location and modification time of its test command
+    """
+
+    def detection_key(self):
+        cmd_path = shutil.which(self.test_cmd)
+        if cmd_path is None:
+            return None
+        return file_fingerprint(cmd_path)
+
+
+class CachedMatlabPackageRequirement(CachedRequirementMixin,
+                                     MatlabPackageRequirement):
+    """
+    A MATLAB package requirement whose detected version is cached against
+    the MATLAB executable and search path, avoiding launching MATLAB just to
+    read the version
+    """
+
+    def detection_key(self):
+        matlab_path = shutil.which('matlab')
+        if matlab_path is None:
+            return None
+        return '{}:{}'.format(file_fingerprint(matlab_path),
+                              os.environ.get('MATLABPATH', ''))
+
+
+def fsl_dir(version, environment):
+    """
+    Returns the FSL installation directory of a version of FSL, loading the
+    module for the version (and caching the directory) if the environment
+    uses modules
+
+    Parameters
+    ----------
+    version : Version
+        The version of FSL returned when satisfying the environment
+    environment : Environment
+        The environment the version was satisfied in
+    """
+    if not hasattr(environment, 'load'):
+        return os.environ['FSLDIR']  # Static environments
+    key = 'FSLDIR|{}|{}'.format(version.local_name, version.local_version)
+    cache = requirement_cache()
+    cached = cache.get(key)
+    if cached is not None and op.isdir(cached):
+        return cached
+    environment.load(version)
+    try:
+        fsl_home = os.environ['FSLDIR']
+    finally:
+        environment.unload(version)
+    cache.set(key, fsl_home)
+    return fsl_home
+
+
+# Command line requirements
+
+
+class FSLRequirement(CachedCliRequirement):
 
-class FSLRequirement(CliRequirement):
+    def detection_key(self):
+        try:
+            return file_fingerprint(op.join(os.environ['FSLDIR'], 'etc',
+                                            'fslversion'))
+        except KeyError:
+            return None
 
     def detect_version_str(self):
         """
@@ -33,7 +245,7 @@ class FSLRequirement(CliRequirement):
         return contents.strip()
 
 
-class C3dRequirement(CliRequirement):
+class C3dRequirement(CachedCliRequirement):
 
     def detect_version_str(self):
         """
@@ -61,7 +273,14 @@ class C3dRequirement(CliRequirement):
     # [bibtex][medline][doi:10.1016/j.neuroimage.2006.01.015]
 
 
-class FreesurferRequirement(CliRequirement):
+class FreesurferRequirement(CachedCliRequirement):
+
+    def detection_key(self):
+        try:
+            return file_fingerprint(op.join(os.environ['FREESURFER_HOME'],
+                                            'build-stamp.txt'))
+        except KeyError:
+            return None
 
     def detect_version_str(self):
         """
@@ -79,14 +298,14 @@ class FreesurferRequirement(CliRequirement):
         return re.match(r'freesurfer-.*-v(.*)', contents).group(1)
 
 
-class MrtrixRequirement(CliRequirement):
+class MrtrixRequirement(CachedCliRequirement):
 
     def detect_version_str(self):
         version_str = super().detect_version_str()
         return re.match(r'== mrinfo (.*) ==', version_str).group(1)
 
 
-class AfniRequirement(CliRequirement):
+class AfniRequirement(CachedCliRequirement):
 
     def detect_version_str(self):
         version_str = super().detect_version_str()
@@ -111,7 +330,7 @@ class StirRequirement(CliRequirement):
         return (1, 0)
 
 
-class AntsRequirement(CliRequirement):
+class AntsRequirement(CachedCliRequirement):
 
     def detect_version(self):
         version = super().detect_version()
@@ -124,9 +343,9 @@ class AntsRequirement(CliRequirement):
 
 mrtrix_req = MrtrixRequirement('mrtrix', test_cmd='mrinfo')
 ants_req = AntsRequirement('ants', test_cmd='antsRegistration')
-dcm2niix_req = CliRequirement('dcm2niix', test_cmd='dcm2niix')
+dcm2niix_req = CachedCliRequirement('dcm2niix', test_cmd='dcm2niix')
 freesurfer_req = FreesurferRequirement('freesurfer', test_cmd='recon-all')
-fix_req = CliRequirement('fix', test_cmd='fix', version_cls=FixVersion)
+fix_req = CachedCliRequirement('fix', test_cmd='fix', version_cls=FixVersion)
 afni_req = AfniRequirement('afni', test_cmd='afni')
 fsl_req = FSLRequirement('fsl', test_cmd='fslinfo')
 c3d_req = C3dRequirement('c3d', test_cmd='c3d')
@@ -135,7 +354,7 @@ stir_req = StirRequirement('stir', test_cmd='SSRB')
 # Matlab package requirements
 
 
-class SpmRequirement(MatlabPackageRequirement):
+class SpmRequirement(CachedMatlabPackageRequirement):
 
     def parse_help_text(self, help_text):
         """
@@ -160,7 +379,7 @@ class SpmRequirement(MatlabPackageRequirement):
         return version
 
 
-class StiRequirement(MatlabPackageRequirement):
+class StiRequirement(CachedMatlabPackageRequirement):
 
     def detect_version_str(self):
         """
@@ -0,0 +1,417 @@
+"""
+A persistent, incrementally updated index of the files in a BIDS dataset,
+which is used instead of building a full pybids layout every time the
+dataset is queried
+"""
+import os
+import os.path as op
+import json
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+
+logger = getLogger('banana')
+
+# Extensions of the files that are indexed (i.e. those that can be matched
+# to a BIDS format)
+INDEXED_EXTS = ('.nii.gz', '.nii', '.json', '.tsv', '.bvec', '.bval')
+
+# Top-level directories that are not part of the raw BIDS tree
+IGNORED_DIRS = ('derivatives', 'sourcedata', 'code', 'stimuli', 'models')
+
+# Directory names of BIDS datatypes (referred to as "modalities" by older
+# versions of the specification)
+DATATYPES = ('anat', 'func', 'dwi', 'fmap', 'perf', 'pet', 'beh', 'meg',
+             'eeg', 'ieeg')
+
+# Maps the keys of BIDS filename entities onto their full names
+ENTITY_NAMES = {
+    'sub': 'subject', 'ses': 'session', 'task': 'task',
+    'acq': 'acquisition', 'ce': 'ceagent', 'rec': 'reconstruction',
+    'dir': 'direction', 'run': 'run', 'mod': 'mod', 'echo': 'echo',
+    'flip': 'flip', 'inv': 'inversion', 'mt': 'mt', 'part': 'part',
+    'recording': 'recording', 'space': 'space', 'trc': 'tracer'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime INTEGER);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    mtime INTEGER,
+    size INTEGER,
+    subject TEXT,
+    session TEXT,
+    suffix TEXT,
+    extension TEXT,
+    datatype TEXT,
+    entities TEXT,
+    content TEXT);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, session);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+"""
+
+
+def parse_bids_path(path):
+    """
+    Parses the entities of a BIDS file from its name and directory
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+
+    Returns
+    -------
+    entities : dict[str, str]
+        The entities of the file (e.g. 'subject', 'session', 'task'), its
+        'suffix' (None if it doesn't have one), 'extension' and 'datatype'
+        (None if it isn't within a datatype directory)
+    """
+    fname = op.basename(path)
+    extension = next((e for e in INDEXED_EXTS if fname.endswith(e)),
+                     op.splitext(fname)[1])
+    stem = fname[:-len(extension)] if extension else fname
+    parts = stem.split('_')
+    entities = {}
+    if '-' not in parts[-1]:
+        entities['suffix'] = parts.pop()
+    else:
+        entities['suffix'] = None
+    for part in parts:
+        key, sep, value = part.partition('-')
+        if sep:
+            entities[ENTITY_NAMES.get(key, key)] = value
+    entities['extension'] = extension
+    dname = op.basename(op.dirname(path))
+    entities['datatype'] = dname if dname in DATATYPES else None
+    return entities
+
+
+class BidsIndex(object):
+    """
+    An index of the files in a BIDS dataset stored in a SQLite database,
+    recording the path, modification time, size and BIDS entities of each
+    file (and the contents of the JSON side-cars). The index is refreshed
+    incrementally: only the root directory and the directories whose
+    modification time has changed are listed again and only files whose
+    modification time or size has changed are re-parsed.
+
+    Parameters
+    ----------
+    root_dir : str
+        The root directory of the BIDS dataset
+    db_path : str
+        Path to the SQLite database to store the index in. If it can't be
+        written to (e.g. the dataset is read-only) the index is held in
+        memory instead
+    """
+
+    def __init__(self, root_dir, db_path):
+        self.root_dir = op.realpath(root_dir)
+        self.db_path = db_path
+        self._sidecar_memo = {}
+        try:
+            os.makedirs(op.dirname(db_path), exist_ok=True)
+            self._conn = sqlite3.connect(db_path, timeout=60)
+            self._conn.executescript(SCHEMA)
+        except (OSError, sqlite3.OperationalError):
+            logger.warning("Could not open BIDS index at '%s', indexing in "
+                           "memory instead", db_path)
+            self._conn = sqlite3.connect(':memory:')
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def refresh(self, subject_ids=None, num_threads=None):
+        """
+        Updates the index to match the files currently in the dataset. The
+        sub-trees of the top-level directories (i.e. subjects) are scanned
+        concurrently, as scanning is typically bound by the latency of the
+        file-system metadata calls (particularly on network file-systems)
+        rather than CPU.
+
+        Parameters
+        ----------
+        subject_ids : iterable[str] | None
+            If provided, only the directories of these subjects (and the
+            top-level files of the dataset) are rescanned, the index entries
+            of other subjects are left as they are
+        num_threads : int | None
+            The number of threads to scan the subject directories with.
+            Defaults to the ThreadPoolExecutor default
+        """
+        self._sidecar_memo = {}
+        known_dirs = {}
+        children = defaultdict(list)
+        for path, parent, mtime in self._conn.execute(
+                "SELECT path, parent, mtime FROM dirs"):
+            known_dirs[path] = mtime
+            children[parent].append(path)
+        known_files = defaultdict(dict)
+        for path, rel_dir, mtime, size in self._conn.execute(
+                "SELECT path, dir, mtime, size FROM files"):
+            known_files[rel_dir][path] = (mtime, size)
+        # The root directory is always listed again, as the directories of
+        # subjects skipped by a previous refresh filtered by subject ID aren't
+        # in the index, so they wouldn't be found from its children if its
+        # modification time was unchanged
+        known_dirs.pop('', None)
+
+        def scan(rel_dir, recurse=True):
+            return self._scan_tree(rel_dir, known_dirs, children, known_files,
+                                   recurse=recurse)
+
+        changes, subject_dirs = scan('', recurse=False)
+        if subject_ids is not None:
+            subject_dirs = [d for d in subject_dirs
+                            if not d.startswith('sub-')
+                            or d[len('sub-'):] in subject_ids]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(scan, subject_dirs))
+        # SQLite connections can't be shared between threads so the changes
+        # are applied once the scans have completed
+        with self._conn:
+            self._apply(changes)
+            for subject_changes, _ in results:
+                self._apply(subject_changes)
+
+    def subject_ids(self):
+        return set(s for (s,) in self._conn.execute(
+            "SELECT DISTINCT subject FROM files WHERE subject IS NOT NULL"))
+
+    def session_ids(self):
+        return set(s for (s,) in self._conn.execute(
+            "SELECT DISTINCT session FROM files WHERE session IS NOT NULL"))
+
+    def files(self, subject_ids=None, visit_ids=None):
+        """
+        Returns the indexed files, optionally filtered by subject and session
+        (files that aren't specific to a subject/session, i.e. in the upper
+        levels of the tree, are always returned)
+
+        Parameters
+        ----------
+        subject_ids : iterable[str] | None
+            The subject IDs to return the files for
+        visit_ids : iterable[str] | None
+            The session IDs to return the files for
+
+        Returns
+        -------
+        files : list[tuple(str, dict[str, str])]
+            The absolute paths and entities of the matching files
+        """
+        query = "SELECT path, entities FROM files"
+        conditions = []
+        params = []
+        for column, ids in (('subject', subject_ids), ('session', visit_ids)):
+            if ids is not None:
+                ids = list(ids)
+                conditions.append("({0} IS NULL OR {0} IN ({1}))".format(
+                    column, ', '.join('?' * len(ids))))
+                params.extend(ids)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY path"
+        return [(op.join(self.root_dir, p), json.loads(e))
+                for p, e in self._conn.execute(query, params)]
+
+    def metadata(self, path, entities=None):
+        """
+        Returns the metadata of a file, combined from the JSON side-cars that
+        apply to it (see sidecars)
+
+        Parameters
+        ----------
+        path : str
+            Absolute path to the file
+        entities : dict[str, str] | None
+            The entities of the file, parsed from the path if not provided
+        """
+        return self.merge_sidecars(self.sidecars(path, entities))
+
+    def sidecars(self, path, entities=None):
+        """
+        Returns the chain of JSON side-cars that apply to a file following the
+        BIDS inheritance principle, i.e. side-cars with the same suffix in the
+        same or parent directories whose entities are a subset of the file's
+
+        Parameters
+        ----------
+        path : str
+            Absolute path to the file
+        entities : dict[str, str] | None
+            The entities of the file, parsed from the path if not provided
+
+        Returns
+        -------
+        sidecars : tuple[str]
+            Paths of the side-cars relative to the root directory, ordered so
+            that the closest (i.e. the one taking precedence) is last
+        """
+        if entities is None:
+            entities = parse_bids_path(path)
+        rel_path = op.relpath(path, self.root_dir)
+        ancestors = ['']
+        for part in op.dirname(rel_path).split(os.sep):
+            if part:
+                ancestors.append(op.join(ancestors[-1], part))
+        chain = []
+        for dir_depth, rel_dir in enumerate(ancestors):
+            for sc_path, sc_entities in self._dir_sidecars(
+                    rel_dir, entities['suffix']):
+                if sc_path != rel_path and all(
+                        entities.get(k) == v for k, v in sc_entities.items()):
+                    chain.append((dir_depth, len(sc_entities), sc_path))
+        return tuple(p for _, _, p in sorted(chain))
+
+    def merge_sidecars(self, sidecars):
+        """
+        Combines the contents of a chain of side-cars (see sidecars), with
+        later side-cars taking precedence
+        """
+        if not sidecars:
+            return {}
+        contents = dict(self._conn.execute(
+            "SELECT path, content FROM files WHERE path IN ({})".format(
+                ', '.join('?' * len(sidecars))), sidecars))
+        metadata = {}
+        for sc_path in sidecars:
+            if contents.get(sc_path) is not None:
+                metadata.update(json.loads(contents[sc_path]))
+        return metadata
+
+    def _dir_sidecars(self, rel_dir, suffix):
+        """
+        Returns the paths and (filename) entities of the JSON side-cars with
+        the given suffix in a directory, memoised until the next refresh
+        """
+        key = (rel_dir, suffix)
+        try:
+            return self._sidecar_memo[key]
+        except KeyError:
+            pass
+        sidecars = []
+        for sc_path, sc_entities in self._conn.execute(
+                "SELECT path, entities FROM files WHERE dir = ? AND "
+                "extension = '.json' AND suffix = ?", (rel_dir, suffix)):
+            sc_entities = json.loads(sc_entities)
+            sidecars.append((sc_path, {
+                k: v for k, v in sc_entities.items()
+                if k not in ('suffix', 'extension', 'datatype')}))
+        self._sidecar_memo[key] = sidecars
+        return sidecars
+
+    def _scan_tree(self, rel_dir, known_dirs, children, known_files,
+                   recurse=True):
+        """
+        Scans a directory (and its sub-directories if recurse is True) for
+        changes since it was last indexed. Only directories whose
+        modification time has changed are listed again and only files whose
+        modification time or size have changed are re-parsed. No changes are
+        made to the database so it is safe to call from multiple threads.
+
+        Returns
+        -------
+        changes : dict[str, list]
+            The rows of the directories and files to insert or replace
+            ('dirs' and 'files') and the paths of the directories and files
+            to remove ('removed_dirs' and 'removed_files')
+        subdirs : list[str]
+            The sub-directories of the top directory
+        """
+        changes = {'dirs': [], 'files': [], 'removed_dirs': [],
+                   'removed_files': []}
+        top_subdirs = None
+        to_visit = [rel_dir]
+        while to_visit:
+            rel_dir = to_visit.pop()
+            abs_dir = op.join(self.root_dir, rel_dir)
+            try:
+                mtime = os.stat(abs_dir).st_mtime_ns
+            except FileNotFoundError:
+                changes['removed_dirs'].append(rel_dir)
+                continue
+            dir_files = known_files.get(rel_dir, {})
+            if known_dirs.get(rel_dir) == mtime:
+                subdirs = children.get(rel_dir, [])
+                # JSON side-cars can be edited in place without changing the
+                # modification time of the directory
+                fnames = [op.basename(p) for p in dir_files
+                          if p.endswith('.json')]
+            else:
+                subdirs = []
+                fnames = []
+                for entry in os.scandir(abs_dir):
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        if not (rel_dir == '' and entry.name in IGNORED_DIRS):
+                            subdirs.append(op.join(rel_dir, entry.name))
+                    elif entry.name.endswith(INDEXED_EXTS):
+                        fnames.append(entry.name)
+                # Remove sub-directories and files that no longer exist
+                changes['removed_dirs'].extend(
+                    d for d in children.get(rel_dir, []) if d not in subdirs)
+                changes['removed_files'].extend(
+                    p for p in dir_files if op.basename(p) not in fnames)
+                changes['dirs'].append(
+                    (rel_dir, None if rel_dir == '' else op.dirname(rel_dir),
+                     mtime))
+            for fname in fnames:
+                rel_path = op.join(rel_dir, fname)
+                try:
+                    stat = os.stat(op.join(self.root_dir, rel_path))
+                except FileNotFoundError:
+                    changes['removed_files'].append(rel_path)
+                    continue
+                if dir_files.get(rel_path) != (stat.st_mtime_ns,
+                                               stat.st_size):
+                    changes['files'].append(self._file_row(
+                        rel_dir, rel_path, stat))
+            if top_subdirs is None:
+                top_subdirs = subdirs
+            if recurse:
+                to_visit.extend(subdirs)
+        return changes, top_subdirs
+
+    def _file_row(self, rel_dir, rel_path, stat):
+        entities = parse_bids_path(rel_path)
+        content = None
+        if entities['extension'] == '.json':
+            try:
+                with open(op.join(self.root_dir, rel_path)) as f:
+                    content = json.dumps(json.load(f))
+            except ValueError:
+                logger.warning("Could not parse JSON side-car '%s'",
+                               rel_path)
+        return (rel_path, rel_dir, stat.st_mtime_ns, stat.st_size,
+                entities.get('subject'), entities.get('session'),
+                entities['suffix'], entities['extension'],
+                entities['datatype'], json.dumps(entities), content)
+
+    def _apply(self, changes):
+        for rel_dir in changes['removed_dirs']:
+            prefix = op.join(rel_dir, '')
+            self._conn.execute(
+                "DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+                (rel_dir, len(prefix), prefix))
+            self._conn.execute(
+                "DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?",
+                (rel_dir, len(prefix), prefix))
+        self._conn.executemany("DELETE FROM files WHERE path = ?",
+                               [(p,) for p in changes['removed_files']])
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO dirs (path, parent, mtime) "
+            "VALUES (?, ?, ?)", changes['dirs'])
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO files (path, dir, mtime, size, subject, "
+            "session, suffix, extension, datatype, entities, content) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", changes['files'])
@@ -0,0 +1,255 @@
+"""
+Content-addressed caches that are shared between analyses (and processes)
+via directories on disk
+"""
+import os
+import os.path as op
+import errno
+import hashlib
+import json
+import shutil
+import tempfile
+from logging import getLogger
+
+
+logger = getLogger('banana')
+
+HASH_CHUNK_SIZE = 2 ** 20
+
+DEFAULT_CONVERSION_CACHE_SIZE = 20.0  # GB
+
+CONVERSION_CACHE_ENV = 'BANANA_CONVERSION_CACHE'
+
+CONVERSION_CACHE_SIZE_ENV = 'BANANA_CONVERSION_CACHE_SIZE'
+
+# Digests of files that have already been hashed in this process, keyed by
+# path, size and modification time
+_digest_memo = {}
+
+
+def content_digest(path):
+    """
+    Returns a SHA-256 digest of the contents of a file, or of the relative
+    paths and contents of all files within a directory
+
+    Parameters
+    ----------
+    path : str
+        Path to the file or directory to digest
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the contents
+    """
+    path = op.realpath(path)
+    if op.isdir(path):
+        sha = hashlib.sha256()
+        for dpath, dnames, fnames in os.walk(path):
+            dnames.sort()
+            for fname in sorted(fnames):
+                fpath = op.join(dpath, fname)
+                sha.update(op.relpath(fpath, path).encode('utf-8'))
+                sha.update(_file_digest(fpath).encode('utf-8'))
+        digest = sha.hexdigest()
+    else:
+        digest = _file_digest(path)
+    return digest
+
+
+def _file_digest(path):
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    try:
+        return _digest_memo[memo_key]
+    except KeyError:
+        pass
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = _digest_memo[memo_key] = sha.hexdigest()
+    return digest
+
+
+def link_or_copy(src, dest):
+    """
+    Hard-links a file (or the files within a directory) to a new location,
+    falling back to copying if the locations are on different devices
+    """
+    if op.isdir(src):
+        shutil.copytree(src, dest, copy_function=link_or_copy)
+    else:
+        try:
+            os.link(src, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(src, dest)
+    return dest
+
+
+class ConversionCache(object):
+    """
+    A size-bounded, least-recently-used cache of converted filesets, which is
+    keyed on a digest of the contents of the input, the converter and its
+    options. Entries are stored in sub-directories of the cache directory and
+    hard-linked into place on cache hits
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory to store the cached outputs in
+    max_size : float
+        The maximum total size of the cache in GB, beyond which the least
+        recently used entries are evicted
+    """
+
+    INFO_FNAME = '__info__.json'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_CONVERSION_CACHE_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+    @classmethod
+    def from_env(cls):
+        """
+        Returns the cache in the directory set by the BANANA_CONVERSION_CACHE
+        environment variable (and bounded by BANANA_CONVERSION_CACHE_SIZE in
+        GB if set) or None if it isn't set
+        """
+        try:
+            cache_dir = os.environ[CONVERSION_CACHE_ENV]
+        except KeyError:
+            return None
+        max_size = float(os.environ.get(CONVERSION_CACHE_SIZE_ENV,
+                                        DEFAULT_CONVERSION_CACHE_SIZE))
+        return cls(cache_dir, max_size=max_size)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def key(self, in_path, converter_name, version, options):
+        """
+        Returns the key of the entry corresponding to converting the given
+        input with a converter
+
+        Parameters
+        ----------
+        in_path : str
+            Path to the input file or directory of the conversion
+        converter_name : str
+            The fully-qualified name of the converter class
+        version : str
+            The version of the converter (and the tools it uses)
+        options : dict[str, *]
+            Options passed to the converter, which are serialised to JSON
+        """
+        sha = hashlib.sha256()
+        sha.update(content_digest(in_path).encode('utf-8'))
+        sha.update(converter_name.encode('utf-8'))
+        sha.update(str(version).encode('utf-8'))
+        sha.update(json.dumps(options, sort_keys=True,
+                              default=str).encode('utf-8'))
+        return sha.hexdigest()
+
+    def fetch(self, key, dest_dir):
+        """
+        Links the outputs of a cached conversion into a destination directory
+
+        Parameters
+        ----------
+        key : str
+            The key of the cache entry
+        dest_dir : str
+            The directory to link the outputs into
+
+        Returns
+        -------
+        outputs : dict[str, str] | None
+            The paths to the linked outputs keyed by output name, or None if
+            there is no entry for the key
+        """
+        entry_dir = op.join(self.cache_dir, key)
+        try:
+            with open(op.join(entry_dir, self.INFO_FNAME)) as f:
+                fnames = json.load(f)
+        except (IOError, ValueError):
+            return None
+        outputs = {}
+        for name, fname in fnames.items():
+            dest = op.join(dest_dir, fname)
+            if op.lexists(dest):
+                if op.isdir(dest):
+                    shutil.rmtree(dest)
+                else:
+                    os.remove(dest)
+            outputs[name] = link_or_copy(op.join(entry_dir, name, fname),
+                                         dest)
+        # Mark the entry as recently used
+        os.utime(entry_dir)
+        logger.info("Reused cached conversion '%s' for outputs %s", key,
+                    list(outputs.values()))
+        return outputs
+
+    def store(self, key, outputs):
+        """
+        Stores the outputs of a conversion in the cache and evicts the least
+        recently used entries if the cache has grown beyond its maximum size
+
+        Parameters
+        ----------
+        key : str
+            The key of the cache entry
+        outputs : dict[str, str]
+            The paths to the outputs of the conversion keyed by output name
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_dir = op.join(self.cache_dir, key)
+        if op.exists(entry_dir):
+            return
+        # Write the entry into a temporary directory and then rename it, so
+        # concurrent conversions of the same input don't see partial entries
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.' + key)
+        try:
+            fnames = {}
+            for name, path in outputs.items():
+                os.mkdir(op.join(tmp_dir, name))
+                fnames[name] = op.basename(path)
+                link_or_copy(path, op.join(tmp_dir, name, fnames[name]))
+            with open(op.join(tmp_dir, self.INFO_FNAME), 'w') as f:
+                json.dump(fnames, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process has stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not op.exists(entry_dir):
+                raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its
+        maximum size
+        """
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'):
+                continue
+            entry_dir = op.join(self.cache_dir, key)
+            size = sum(op.getsize(op.join(d, f))
+                       for d, _, fnames in os.walk(entry_dir) for f in fnames)
+            entries.append((op.getmtime(entry_dir), size, entry_dir))
+            total_size += size
+        max_bytes = self.max_size * 1e9
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,881 @@
+"""
+Helpers for reading the headers of DICOM series efficiently, i.e. without
+repeatedly listing the series directory and re-reading the same files, and
+for writing images into DICOM series based on template headers
+"""
+import os
+import copy
+import os.path as op
+import json
+import hashlib
+import tempfile
+import warnings
+from itertools import groupby
+from operator import itemgetter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+import numpy as np
+import pydicom
+from pydicom.datadict import tag_for_keyword
+from pydicom.filereader import read_partial
+from pydicom.sequence import Sequence
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from banana.exceptions import BananaUsageError
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import nibabel.nicom.csareader as csareader
+
+
+logger = getLogger('banana')
+
+DICOM_INDEX_CACHE_ENV = 'BANANA_DICOM_INDEX_CACHE'
+
+# Header fields that are expected to vary between the slices of a series
+# and are therefore recorded for every file in the index
+VARYING_KEYWORDS = ('InstanceNumber', 'AcquisitionTime', 'EchoTime',
+                    'ImagePositionPatient')
+
+# Value representations that are not stored in the index (they are either
+# binary or nested), requests for these fields fall back to reading the file
+UNINDEXED_VRS = ('SQ', 'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN')
+
+# Header fields read for each file by scan_series. They are all stored near
+# the start of the header (before the end of group 0x0020), so the reading
+# of each file is stopped after them
+SCAN_KEYWORDS = ('AcquisitionTime', 'EchoTime', 'InstanceNumber')
+SCAN_STOP_TAG = max(tag_for_keyword(k) for k in SCAN_KEYWORDS)
+
+# Values larger than this (bytes) are not loaded when scanning headers
+SCAN_DEFER_SIZE = 1024
+
+# The Legacy Converted Enhanced SOP classes keyed by modality, which are for
+# multi-frame images converted from single-frame ones. The (true) Enhanced
+# MR/CT/PET SOP classes require functional groups and acquisition fields
+# that single-frame headers don't provide
+ENHANCED_SOP_CLASSES = {
+    'MR': '1.2.840.10008.5.1.4.1.1.4.4',
+    'CT': '1.2.840.10008.5.1.4.1.1.2.2',
+    'PT': '1.2.840.10008.5.1.4.1.1.128.1'}
+
+# Fields of the template headers that differ between the slices and are
+# moved to the per-frame functional groups of enhanced DICOMs
+PER_FRAME_KEYWORDS = ('ImagePositionPatient', 'SliceLocation',
+                      'InstanceNumber', 'SOPInstanceUID')
+
+# Delimiters of the text block of the Siemens protocol ("ASCCONV") stored in
+# the CSA series header
+ASCCONV_BEGIN = '### ASCCONV BEGIN'
+ASCCONV_END = '### ASCCONV END'
+
+# Names of the items of the CSA series header the protocol is stored in
+# (depending on the software version)
+CSA_PROTOCOL_TAGS = ('MrPhoenixProtocol', 'MrProtocol')
+
+# Maps the sign of the phase encoding direction in the CSA image header to
+# the sign of the phase encoding angle
+PEDP_TO_SIGN = {0: '-1', 1: '+1'}
+
+
+def tag_key(tag):
+    """
+    Converts a DICOM tag given as a keyword (e.g. 'EchoTime'), 2-tuple of
+    hex strings (e.g. ('0018', '0081')) or integer into the 8-character hex
+    string used to key fields in the index (e.g. '00180081')
+    """
+    if isinstance(tag, str):
+        if len(tag) == 8 and all(c in '0123456789abcdefABCDEF' for c in tag):
+            return tag.upper()
+        int_tag = tag_for_keyword(tag)
+        if int_tag is None:
+            raise BananaUsageError(
+                "Unrecognised DICOM keyword '{}'".format(tag))
+        return '{:08X}'.format(int_tag)
+    elif isinstance(tag, int):
+        return '{:08X}'.format(tag)
+    else:
+        return ''.join(tag).upper()
+
+
+class DicomSeriesIndex(object):
+    """
+    An index of the headers in a DICOM series directory, built by reading
+    each file once (without its pixel data). It records the list of files
+    (sorted by instance number), the values of fields that typically vary
+    between slices for each file (see VARYING_KEYWORDS) and a dictionary of
+    the fields that are shared by all files in the series.
+
+    Indices are cached in memory and, if the BANANA_DICOM_INDEX_CACHE
+    environment variable is set, saved to JSON files in that directory so
+    they can be reused by other processes. Cached indices are invalidated
+    when the modification time of the series directory or the total size of
+    its files change.
+
+    Parameters
+    ----------
+    path : str
+        Path to the series directory
+    files : list[str]
+        The file names in the series, sorted by instance number
+    varying : dict[str, list]
+        The values of the fields in VARYING_KEYWORDS for each file
+    shared : dict[str, *]
+        The values of the fields that are the same for all files, keyed by
+        8-character hex tag
+    mtime : int
+        The modification time of the directory when the index was built (ns)
+    size : int
+        The total size of the files in the series when the index was built
+    """
+
+    # In-memory cache of indices keyed by the real path of the series
+    _memo = {}
+
+    def __init__(self, path, files, varying, shared, mtime, size):
+        self.path = path
+        self.files = files
+        self.varying = varying
+        self.shared = shared
+        self.mtime = mtime
+        self.size = size
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def paths(self):
+        return [op.join(self.path, f) for f in self.files]
+
+    def get(self, tag, default=None):
+        """
+        Returns the value of a field shared by all files in the series
+
+        Parameters
+        ----------
+        tag : str | tuple(str, str) | int
+            The keyword, 2-tuple of hex strings or integer of the field
+        default : *
+            The value to return if the field isn't shared by all files (or
+            is not indexed)
+        """
+        return self.shared.get(tag_key(tag), default)
+
+    def values(self, keyword):
+        """
+        Returns the values of a field in VARYING_KEYWORDS for each file in
+        the series (in instance order)
+        """
+        return self.varying[keyword]
+
+    def header(self, index=0):
+        """
+        Reads the full header (without pixel data) of a file in the series
+        """
+        return pydicom.dcmread(op.join(self.path, self.files[index]),
+                               stop_before_pixels=True)
+
+    def slice_order(self, split=None):
+        """
+        Sorts the files of the series by their geometry, i.e. by volume, echo
+        and then position along the slice normal, falling back to instance
+        number where the geometry tags are missing.
+
+        Parameters
+        ----------
+        split : str | None
+            How to group the slices, either by 'echo' or by 'volume' (in
+            which case each echo of a multi-echo acquisition is a separate
+            volume), or None for no grouping
+
+        Returns
+        -------
+        order : list[list[int]]
+            Indices into the files of the series for each group of slices,
+            each group sorted by slice position (a single group if split is
+            None)
+        """
+        if split not in (None, 'echo', 'volume'):
+            raise BananaUsageError(
+                "Unrecognised value for split, '{}', can be either 'echo', "
+                "'volume' or None".format(split))
+        positions = self.values('ImagePositionPatient')
+        orientation = self.get('ImageOrientationPatient')
+        if orientation is None and any(p is not None for p in positions):
+            orientation = self.header().get('ImageOrientationPatient')
+        if orientation is None or any(p is None for p in positions):
+            # Files are already sorted by instance number
+            slice_pos = list(range(len(self)))
+        else:
+            normal = np.cross(orientation[:3], orientation[3:])
+            slice_pos = [round(float(np.dot(normal, p)), 4)
+                         for p in positions]
+        echo_times = [e if e is not None else 0.0
+                      for e in self.values('EchoTime')]
+        echo_inds = {e: i for i, e in enumerate(sorted(set(echo_times)))}
+        # Slices that share an echo and position belong to successive
+        # volumes in the (instance) order they were acquired in
+        vol_inds = []
+        counts = {}
+        for echo, pos in zip(echo_times, slice_pos):
+            key = (echo, pos)
+            vol_inds.append(counts.get(key, 0))
+            counts[key] = vol_inds[-1] + 1
+        keys = [(vol_inds[i], echo_inds[echo_times[i]], slice_pos[i], i)
+                for i in range(len(self))]
+        if split == 'echo':
+            keys = [(k[1], k[0]) + k[2:] for k in keys]
+        order = [k[-1] for k in sorted(keys)]
+        if split is None:
+            return [order]
+        if split == 'echo':
+            group_of = [echo_inds[echo_times[i]] for i in order]
+        else:
+            group_of = [(vol_inds[i], echo_inds[echo_times[i]])
+                        for i in order]
+        groups = [[i for i, _ in g] for _, g in groupby(
+            zip(order, group_of), key=itemgetter(1))]
+        if len(set(len(g) for g in groups)) != 1:
+            raise BananaUsageError(
+                "Cannot split series in '{}' by {} as the groups contain "
+                "different numbers of slices ({})".format(
+                    self.path, split, [len(g) for g in groups]))
+        return groups
+
+    def load_array(self, split=None, num_threads=None):
+        """
+        Loads the pixel data of the series into a single array, sorted by
+        slice geometry (see slice_order). The array is allocated up front
+        and the slices are decoded in parallel directly into it.
+
+        Parameters
+        ----------
+        split : str | None
+            Whether to split the series into a 4-D array by 'echo' or
+            'volume' (see slice_order)
+        num_threads : int | None
+            The number of threads to decode the slices with. Defaults to
+            the ThreadPoolExecutor default
+
+        Returns
+        -------
+        array : np.ndarray
+            The stacked slices, with shape (slices, rows, columns) or
+            (groups, slices, rows, columns) if split is provided
+        """
+        groups = self.slice_order(split=split)
+        order = [i for g in groups for i in g]
+        if not order:
+            raise BananaUsageError(
+                "No DICOM files found in '{}'".format(self.path))
+        paths = self.paths
+        first = pydicom.dcmread(paths[order[0]]).pixel_array
+        array = np.empty((len(order),) + first.shape, dtype=first.dtype)
+        array[0] = first
+
+        def decode(i):
+            array[i] = pydicom.dcmread(paths[order[i]]).pixel_array
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            # Consume the results so any exceptions are raised here
+            list(executor.map(decode, range(1, len(order))))
+        if split is not None:
+            array = array.reshape((len(groups), len(groups[0])) +
+                                  first.shape)
+        return array
+
+    @classmethod
+    def load(cls, path, ext='.dcm'):
+        """
+        Loads the index of the series in the given directory, building it if
+        it isn't cached or the cached version is out of date
+
+        Parameters
+        ----------
+        path : str
+            Path to the series directory
+        ext : str
+            The extension of the DICOM files in the directory
+        """
+        path = op.realpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        # Files rewritten in place don't change the modification time of the
+        # directory, so the total size of the files is also checked
+        fnames = [f for f in os.listdir(path) if f.endswith(ext)]
+        size = sum(op.getsize(op.join(path, f)) for f in fnames)
+        try:
+            index = cls._memo[path]
+        except KeyError:
+            pass
+        else:
+            if (index.mtime, index.size) == (mtime, size):
+                return index
+        cache_path = cls._cache_path(path)
+        index = None
+        if cache_path is not None and op.exists(cache_path):
+            try:
+                index = cls._read(path, cache_path)
+            except (IOError, ValueError, KeyError):
+                logger.warning("Ignoring corrupt DICOM index cache '%s'",
+                               cache_path)
+            else:
+                if index.mtime != mtime or index.size != size:
+                    index = None
+        if index is None:
+            index = cls.build(path, fnames, mtime=mtime, size=size)
+            if cache_path is not None:
+                index._write(cache_path)
+        cls._memo[path] = index
+        return index
+
+    @classmethod
+    def build(cls, path, fnames, mtime=None, size=None):
+        """
+        Builds the index by reading the header of each file in the series
+
+        Parameters
+        ----------
+        path : str
+            Path to the series directory
+        fnames : list[str]
+            The names of the DICOM files within the directory
+        """
+        if mtime is None:
+            mtime = os.stat(path).st_mtime_ns
+        if size is None:
+            size = sum(op.getsize(op.join(path, f)) for f in fnames)
+        headers = [pydicom.dcmread(op.join(path, f), stop_before_pixels=True)
+                   for f in fnames]
+        order = sorted(range(len(fnames)), key=lambda i: (
+            _instance_number(headers[i]), fnames[i]))
+        files = [fnames[i] for i in order]
+        headers = [headers[i] for i in order]
+        varying = {k: [_json_value(h[k]) if k in h else None
+                       for h in headers]
+                   for k in VARYING_KEYWORDS}
+        shared = {}
+        if headers:
+            for elem in headers[0]:
+                value = _json_value(elem)
+                if value is None:
+                    continue
+                if all(elem.tag in h and _json_value(h[elem.tag]) == value
+                       for h in headers[1:]):
+                    shared['{:08X}'.format(int(elem.tag))] = value
+        return cls(path, files, varying, shared, mtime, size)
+
+    @classmethod
+    def _cache_path(cls, path):
+        try:
+            cache_dir = os.environ[DICOM_INDEX_CACHE_ENV]
+        except KeyError:
+            return None
+        return op.join(cache_dir, hashlib.sha256(
+            path.encode('utf-8')).hexdigest() + '.json')
+
+    @classmethod
+    def _read(cls, path, cache_path):
+        with open(cache_path) as f:
+            dct = json.load(f)
+        return cls(path, dct['files'], dct['varying'], dct['shared'],
+                   dct['mtime'], dct['size'])
+
+    def _write(self, cache_path):
+        cache_dir = op.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file and rename so that concurrent readers
+        # never see partially written indices
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'path': self.path, 'files': self.files,
+                       'varying': self.varying, 'shared': self.shared,
+                       'mtime': self.mtime, 'size': self.size}, f)
+        os.replace(tmp_path, cache_path)
+
+
+SeriesMetadata = namedtuple('SeriesMetadata', [
+    'paths', 'instance_numbers', 'echo_times', 'acquisition_times'])
+SeriesMetadata.__doc__ = """
+The fields of each file in a DICOM series that vary between files, in
+instance order
+
+Parameters
+----------
+paths : list[str]
+    The paths of the files
+instance_numbers : list[int | None]
+    The instance number of each file
+echo_times : list[float | None]
+    The echo time of each file (ms)
+acquisition_times : list[str | None]
+    The acquisition time of each file
+"""
+
+
+def scan_series(paths, num_threads=None):
+    """
+    Reads the instance numbers, echo times and acquisition times of the
+    files in a DICOM series. Only the start of each header (up to the last
+    of these fields) is read, skipping the remaining (e.g. private) fields
+    and the pixel data, and the files are read concurrently.
+
+    Parameters
+    ----------
+    paths : list[str]
+        Paths of the files in the series
+    num_threads : int | None
+        The number of threads to read the files with. Defaults to the
+        ThreadPoolExecutor default
+
+    Returns
+    -------
+    metadata : SeriesMetadata
+        The fields of each file, sorted by instance number (and then path)
+    """
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        values = list(executor.map(_scan_file, paths))
+    order = sorted(range(len(paths)), key=lambda i: (
+        values[i][0] if values[i][0] is not None else 0, paths[i]))
+    return SeriesMetadata(
+        paths=[paths[i] for i in order],
+        instance_numbers=[values[i][0] for i in order],
+        echo_times=[values[i][1] for i in order],
+        acquisition_times=[values[i][2] for i in order])
+
+
+def distinct(values):
+    """
+    Returns the distinct values of a field of a series (see scan_series) in
+    the order they first appear, ignoring files that don't have the field
+    """
+    seen = []
+    for value in values:
+        if value is not None and value not in seen:
+            seen.append(value)
+    return seen
+
+
+def _stop_after_scanned(tag, vr, length):  # @UnusedVariable
+    return tag > SCAN_STOP_TAG
+
+
+def _scan_file(path):
+    with open(path, 'rb') as f:
+        header = read_partial(f, stop_when=_stop_after_scanned,
+                              defer_size=SCAN_DEFER_SIZE)
+    values = []
+    for keyword, dtype in (('InstanceNumber', int), ('EchoTime', float),
+                           ('AcquisitionTime', str)):
+        value = header.get(keyword)
+        values.append(dtype(value) if value not in (None, '') else None)
+    return tuple(values)
+
+
+def parse_ascconv(text):
+    """
+    Parses the "ASCCONV" block of a Siemens protocol into a dictionary
+
+    Parameters
+    ----------
+    text : str
+        The text of the protocol (only the lines between the ASCCONV
+        delimiters are parsed if they are present)
+
+    Returns
+    -------
+    protocol : dict[str, int | float | str]
+        The values of the protocol keyed by their full parameter name (e.g.
+        'alTR[0]', 'sSliceArray.asSlice[0].dInPlaneRot'). Hexadecimal and
+        decimal integers are converted to int, other numbers to float and
+        quoted values to str
+    """
+    start = text.find(ASCCONV_BEGIN)
+    if start >= 0:
+        start = text.find('\n', start) + 1
+        end = text.find(ASCCONV_END, start)
+        text = text[start:(end if end >= 0 else len(text))]
+    protocol = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition('=')
+        key = key.strip()
+        if not sep or not key or key.startswith('#'):
+            continue
+        value = value.strip()
+        if value.startswith('"'):
+            protocol[key] = value.strip('"')
+            continue
+        # Drop trailing comments
+        value = value.split('#', 1)[0].strip()
+        try:
+            protocol[key] = int(value, 0)
+        except ValueError:
+            try:
+                protocol[key] = float(value)
+            except ValueError:
+                protocol[key] = value
+    return protocol
+
+
+def siemens_protocol(path, header=None):
+    """
+    Reads the Siemens protocol ("ASCCONV" block) of a series from the CSA
+    series header of one of its files. As the protocol is the same for all
+    files in a series, the parsed protocol is cached in memory for each
+    series (identified by its SeriesInstanceUID), so that it is shared by
+    the files of the series even if they are in a directory with other
+    series. Files without a SeriesInstanceUID are cached individually until
+    they are modified.
+
+    Parameters
+    ----------
+    path : str
+        Path to a DICOM file in the series
+    header : pydicom.Dataset | None
+        The header of the file if it has already been read
+
+    Returns
+    -------
+    protocol : dict[str, int | float | str]
+        The parsed protocol (see parse_ascconv), empty if the file doesn't
+        contain a Siemens protocol
+    """
+    if header is None:
+        header = pydicom.dcmread(path, stop_before_pixels=True)
+    series_uid = header.get('SeriesInstanceUID')
+    if series_uid:
+        key = str(series_uid)
+        mtime = None
+    else:
+        key = op.realpath(path)
+        mtime = os.stat(key).st_mtime_ns
+    try:
+        cached_mtime, protocol = _protocol_memo[key]
+    except KeyError:
+        pass
+    else:
+        if cached_mtime == mtime:
+            return protocol
+    text = _protocol_text(header)
+    if text is None:
+        logger.debug("No Siemens protocol found in the header of '%s'",
+                     path)
+        protocol = {}
+    else:
+        protocol = parse_ascconv(text)
+    _protocol_memo[key] = (mtime, protocol)
+    return protocol
+
+
+def siemens_phase_encoding(header, protocol):
+    """
+    Determines the phase encoding direction and angle of a Siemens
+    acquisition, from the in-plane rotation in its protocol or (preferably)
+    from the CSA image header
+
+    Parameters
+    ----------
+    header : pydicom.Dataset
+        The header of a file in the series
+    protocol : dict
+        The protocol of the series (see siemens_protocol)
+
+    Returns
+    -------
+    pe_angle : float | str | None
+        The phase encoding angle, or its sign ('+1' or '-1') if it was read
+        from the CSA image header
+    ped : str | None
+        The phase encoding direction ('ROW' or 'COL')
+    """
+    pe_angle = ped = None
+    rotation = protocol.get('sSliceArray.asSlice[0].dInPlaneRot')
+    if isinstance(rotation, (int, float)):
+        if 1 < abs(rotation) < 3:
+            pe_angle = float(rotation)
+            ped = 'ROW'
+        elif abs(rotation) < 1 or abs(rotation) > 3:
+            pe_angle = -1 if abs(rotation) > 3 else 1
+            ped = 'COL'
+    try:
+        inplane_pe_dir = header[0x00181312].value
+        csa = csareader.get_csa_header(header, 'image')
+        pedp = csa['tags']['PhaseEncodingDirectionPositive']['items'][0]
+    except (KeyError, TypeError, IndexError):
+        pass  # image does not have ped info in the header
+    else:
+        pe_angle, ped = PEDP_TO_SIGN[pedp], inplane_pe_dir
+    return pe_angle, ped
+
+
+def _protocol_text(header):
+    """
+    Returns the text of the protocol stored in the CSA series header, or
+    in another private element (e.g. for enhanced DICOMs) if there is no CSA
+    series header
+    """
+    try:
+        csa = csareader.get_csa_header(header, 'series')
+    except csareader.CSAReadError:
+        csa = None
+    if csa is not None:
+        for name in CSA_PROTOCOL_TAGS:
+            try:
+                return csa['tags'][name]['items'][0]
+            except (KeyError, IndexError):
+                continue
+    marker = ASCCONV_BEGIN.encode('ascii')
+    for elem in header:
+        if elem.tag.is_private and isinstance(elem.value, bytes):
+            if marker in elem.value:
+                return elem.value.decode('utf-8', errors='replace')
+    return None
+
+
+# In-memory cache of the parsed protocol of each series
+_protocol_memo = {}
+
+
+def load_templates(paths, num_threads=None):
+    """
+    Reads the headers (without pixel data) of the files of a DICOM series
+    to use as templates when writing a new image into DICOM (see
+    write_dicom_slices). The headers are read concurrently and cached in
+    memory until the files are modified, so they are only parsed once when
+    several images are written with the same templates (e.g. each frame of
+    a motion-corrected series)
+
+    Parameters
+    ----------
+    paths : list[str]
+        The paths of the template files, one for each slice
+    num_threads : int | None
+        The number of threads to read the files with
+
+    Returns
+    -------
+    templates : list[pydicom.Dataset]
+        The template headers. They are shared between calls so shouldn't be
+        modified
+    """
+    def load(path):
+        path = op.realpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        try:
+            cached_mtime, header = _template_memo[path]
+        except KeyError:
+            pass
+        else:
+            if cached_mtime == mtime:
+                return header
+        header = pydicom.dcmread(path, stop_before_pixels=True)
+        _template_memo[path] = (mtime, header)
+        return header
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(load, paths))
+
+
+def slice_frames(array, template):
+    """
+    Casts an image to the pixel data type of a template DICOM header and
+    reorders it into contiguous frames (slice, row, column), in a single
+    vectorised step for the whole volume
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The image data with axes (column, row, slice), i.e. as loaded from
+        a NIfTI converted from the template series
+    template : pydicom.Dataset
+        The header of a file in the template series
+
+    Returns
+    -------
+    frames : np.ndarray
+        The pixel data of each slice with axes (slice, row, column)
+    """
+    array = np.asarray(array)
+    if array.ndim != 3:
+        raise BananaUsageError(
+            "Can only write 3-D images into DICOM slices, not {}-D"
+            .format(array.ndim))
+    if array.shape[:2] != (template.Columns, template.Rows):
+        raise BananaUsageError(
+            "In-plane dimensions of image {} don't match those of the "
+            "template DICOM ({} columns x {} rows)".format(
+                array.shape[:2], template.Columns, template.Rows))
+    dtype = '<{}{}'.format(
+        'i' if template.get('PixelRepresentation', 0) else 'u',
+        template.get('BitsAllocated', 16) // 8)
+    return np.ascontiguousarray(array.transpose(2, 1, 0), dtype=dtype)
+
+
+def write_dicom_slices(array, templates, out_dir, basename,
+                       num_threads=None):
+    """
+    Writes an image into a series of single-frame DICOM files, one for each
+    slice, with headers copied from the template files of a series (e.g. the
+    series the image was originally converted from). The files are written
+    concurrently.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The image data with axes (column, row, slice)
+    templates : list[pydicom.Dataset]
+        The template header of each slice (see load_templates)
+    out_dir : str
+        The directory to write the files to
+    basename : str
+        The prefix of the file names, which are suffixed by '_vol<slice>'
+    num_threads : int | None
+        The number of threads to write the files with
+
+    Returns
+    -------
+    paths : list[str]
+        The paths of the written files
+    """
+    if len(templates) != array.shape[2]:
+        raise BananaUsageError(
+            "Different number of template DICOM files ({}) to image slices "
+            "({})".format(len(templates), array.shape[2]))
+    frames = slice_frames(array, templates[0])
+    paths = [op.join(out_dir, '{}_vol{}.dcm'.format(basename,
+                                                    str(i).zfill(4)))
+             for i in range(len(templates))]
+
+    def write(i):
+        header = _with_pixel_data(templates[i], frames[i].tobytes())
+        header.save_as(paths[i])
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Consume the results so any exceptions are raised here
+        list(executor.map(write, range(len(templates))))
+    return paths
+
+
+def write_enhanced_dicom(array, templates, path):
+    """
+    Writes an image into a single enhanced (multi-frame) DICOM file of the
+    Legacy Converted Enhanced SOP class of its modality, with the shared
+    fields copied from the first template header and the slice positions of
+    each template stored in the per-frame functional groups
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The image data with axes (column, row, slice)
+    templates : list[pydicom.Dataset]
+        The template header of each slice (see load_templates)
+    path : str
+        The path of the file to write
+    """
+    if len(templates) != array.shape[2]:
+        raise BananaUsageError(
+            "Different number of template DICOM files ({}) to image slices "
+            "({})".format(len(templates), array.shape[2]))
+    template = templates[0]
+    frames = slice_frames(array, template)
+    header = _with_pixel_data(template, frames.tobytes())
+    for keyword in PER_FRAME_KEYWORDS:
+        if keyword in header:
+            delattr(header, keyword)
+    header.NumberOfFrames = len(templates)
+    header.InstanceNumber = 1
+    header.SOPInstanceUID = generate_uid()
+    header.file_meta.MediaStorageSOPInstanceUID = header.SOPInstanceUID
+    try:
+        header.SOPClassUID = ENHANCED_SOP_CLASSES[template.Modality]
+    except (AttributeError, KeyError):
+        logger.warning(
+            "No enhanced SOP class for modality of template DICOMs, keeping "
+            "SOP class %s", template.get('SOPClassUID'))
+    else:
+        header.file_meta.MediaStorageSOPClassUID = header.SOPClassUID
+    shared = Dataset()
+    if 'PixelSpacing' in template:
+        measures = Dataset()
+        measures.PixelSpacing = template.PixelSpacing
+        if 'SliceThickness' in template:
+            measures.SliceThickness = template.SliceThickness
+        shared.PixelMeasuresSequence = Sequence([measures])
+    if 'ImageOrientationPatient' in template:
+        orientation = Dataset()
+        orientation.ImageOrientationPatient = (
+            template.ImageOrientationPatient)
+        shared.PlaneOrientationSequence = Sequence([orientation])
+    header.SharedFunctionalGroupsSequence = Sequence([shared])
+    per_frame = []
+    for i, slice_template in enumerate(templates):
+        frame = Dataset()
+        content = Dataset()
+        content.InStackPositionNumber = i + 1
+        frame.FrameContentSequence = Sequence([content])
+        if 'ImagePositionPatient' in slice_template:
+            position = Dataset()
+            position.ImagePositionPatient = (
+                slice_template.ImagePositionPatient)
+            frame.PlanePositionSequence = Sequence([position])
+        per_frame.append(frame)
+    header.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+    header.save_as(path)
+
+
+def _with_pixel_data(template, pixel_data):
+    """
+    Returns a copy of a template header with the given pixel data, stored
+    uncompressed
+    """
+    header = copy.deepcopy(template)
+    header.add_new(0x7FE00010,
+                   'OW' if template.get('BitsAllocated', 16) > 8 else 'OB',
+                   pixel_data)
+    file_meta = getattr(header, 'file_meta', None)
+    if file_meta is not None and 'TransferSyntaxUID' in file_meta:
+        if file_meta.TransferSyntaxUID.is_compressed:
+            file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    return header
+
+
+# In-memory cache of the headers of template DICOMs
+_template_memo = {}
+
+
+def _instance_number(header):
+    try:
+        return int(header.InstanceNumber)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def _json_value(elem):
+    """
+    Converts the value of a DICOM data element into a JSON-serialisable
+    value, or returns None if it shouldn't be stored in the index
+    """
+    if elem.VR in UNINDEXED_VRS:
+        return None
+    value = elem.value
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        value = [_json_scalar(v) for v in value]
+        if any(v is None for v in value):
+            return None
+    else:
+        value = _json_scalar(value)
+    return value
+
+
+def _json_scalar(value):
+    if isinstance(value, (bytes, bytearray)) or value is None:
+        return None
+    elif isinstance(value, int):
+        return int(value)
+    elif isinstance(value, float):
+        return float(value)
+    elif isinstance(value, str):
+        return str(value)
+    elif isinstance(value, pydicom.valuerep.PersonName):
+        return str(value)
+    return None
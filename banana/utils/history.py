@@ -0,0 +1,221 @@
+"""
+A record of the resources used by the nodes of previous runs, which is used
+to estimate the cost of future runs
+"""
+import os
+import os.path as op
+import json
+from collections import namedtuple, defaultdict
+from logging import getLogger
+
+
+logger = getLogger('banana')
+
+RUN_HISTORY_ENV = 'BANANA_RUN_HISTORY'
+
+# Prefix of the files Nipype saves the results of each node in
+RESULT_PREFIX = 'result_'
+
+
+NodeRecord = namedtuple('NodeRecord', [
+    'pipeline', 'node', 'interface', 'duration', 'mem_peak_gb',
+    'cpu_percent', 'n_procs', 'source'])
+NodeRecord.__doc__ = """
+The resources used by a single execution of a node
+
+Parameters
+----------
+pipeline : str
+    The name of the pipeline the node belongs to
+node : str
+    The name of the node
+interface : str
+    The name of the interface class of the node
+duration : float
+    The wall time taken to run the node in seconds
+mem_peak_gb : float | None
+    The peak memory used by the node (if recorded)
+cpu_percent : float | None
+    The peak CPU usage of the node (if recorded)
+n_procs : int | None
+    The number of processors the node was allocated
+source : str
+    Where the record was read from (used to avoid duplicate records)
+"""
+
+
+NodeEstimate = namedtuple('NodeEstimate', [
+    'wall_time', 'mem_gb', 'num_records'])
+NodeEstimate.__doc__ = """
+The estimated resources required to run a node
+
+Parameters
+----------
+wall_time : float
+    The mean wall time of the recorded runs in minutes
+mem_gb : float | None
+    The maximum peak memory of the recorded runs (None if not recorded)
+num_records : int
+    The number of records the estimate is based on
+"""
+
+
+class RunHistory(object):
+    """
+    The resources used by previously executed nodes, stored as JSON lines
+    in a single file that is appended to after each run
+
+    Parameters
+    ----------
+    path : str
+        Path to the history file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._records = None
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = []
+            try:
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            self._records.append(
+                                NodeRecord(**json.loads(line)))
+                        except (ValueError, TypeError):
+                            # Skip lines truncated by interrupted writes
+                            continue
+            except IOError:
+                pass
+        return self._records
+
+    def add(self, records):
+        """
+        Appends records to the history, skipping those from sources that have
+        already been recorded
+
+        Parameters
+        ----------
+        records : iterable[NodeRecord]
+            The records to add
+
+        Returns
+        -------
+        num_added : int
+            The number of records that were added
+        """
+        sources = set(r.source for r in self.records)
+        new = [r for r in records if r.source not in sources]
+        if new:
+            os.makedirs(op.dirname(op.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(r._asdict()) + '\n'
+                                for r in new))
+            self._records.extend(new)
+        return len(new)
+
+    def ingest_work_dir(self, work_dir):
+        """
+        Adds records for the nodes executed in a Nipype working directory
+        from the result files Nipype saves for each node
+
+        Parameters
+        ----------
+        work_dir : str
+            The working directory of the processor
+
+        Returns
+        -------
+        num_added : int
+            The number of records that were added
+        """
+        return self.add(work_dir_records(
+            work_dir, skip=set(r.source for r in self.records)))
+
+    def estimate(self, pipeline, node):
+        """
+        Estimates the resources required by a node from previous runs
+
+        Parameters
+        ----------
+        pipeline : str
+            The name of the pipeline the node belongs to
+        node : str
+            The name of the node
+
+        Returns
+        -------
+        estimate : NodeEstimate | None
+            The estimate, or None if the node hasn't been recorded
+        """
+        return self.estimates().get((pipeline, node))
+
+    def estimates(self):
+        """
+        Estimates for all recorded nodes keyed by pipeline and node name
+        """
+        grouped = defaultdict(list)
+        for record in self.records:
+            grouped[(record.pipeline, record.node)].append(record)
+        estimates = {}
+        for key, records in grouped.items():
+            mems = [r.mem_peak_gb for r in records
+                    if r.mem_peak_gb is not None]
+            estimates[key] = NodeEstimate(
+                wall_time=(sum(r.duration for r in records)
+                           / len(records) / 60.0),
+                mem_gb=(max(mems) if mems else None),
+                num_records=len(records))
+        return estimates
+
+
+def work_dir_records(work_dir, skip=()):
+    """
+    Reads the resources used by the nodes executed in a Nipype working
+    directory from the result files Nipype saves for each node. The
+    pipeline each node belongs to is determined from the directory layout
+    '<work_dir>/<workflow>/<pipeline>/.../<node>/result_<node>.pklz' used by
+    Arcana processors.
+
+    Parameters
+    ----------
+    work_dir : str
+        The working directory of the processor
+    skip : set[str]
+        Result files to skip (i.e. that have already been recorded)
+
+    Yields
+    ------
+    record : NodeRecord
+        A record for each node that ran successfully
+    """
+    from nipype.utils.filemanip import loadpkl
+    for dpath, _, fnames in os.walk(work_dir):
+        for fname in fnames:
+            if not (fname.startswith(RESULT_PREFIX)
+                    and fname.endswith('.pklz')):
+                continue
+            path = op.join(dpath, fname)
+            parts = op.relpath(dpath, work_dir).split(os.sep)
+            if len(parts) < 3:
+                continue
+            source = '{}:{}'.format(path, os.stat(path).st_mtime_ns)
+            if source in skip:
+                continue
+            try:
+                result = loadpkl(path)
+                runtime = result.runtime
+                duration = runtime.duration
+            except Exception:  # pylint: disable=broad-except
+                logger.debug("Could not read node result from '%s'", path)
+                continue
+            yield NodeRecord(
+                pipeline=parts[1], node=parts[-1],
+                interface=getattr(runtime, 'interface', None),
+                duration=duration,
+                mem_peak_gb=getattr(runtime, 'mem_peak_gb', None),
+                cpu_percent=getattr(runtime, 'cpu_percent', None),
+                n_procs=None, source=source)
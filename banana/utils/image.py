@@ -0,0 +1,876 @@
+"""
+Helper functions for reading and writing image files within the Python
+process, so that the voxel data can be streamed a block at a time without
+having to load the whole image into memory or call out to external tools
+"""
+import os
+import os.path as op
+import io
+import json
+import zlib
+import struct
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+import numpy as np
+import nibabel
+from nibabel.openers import ImageOpener
+from nibabel.fileslice import fileslice
+from nibabel.nifti1 import Nifti1Header, Nifti1PairHeader
+from banana.exceptions import BananaUsageError
+
+
+MRTRIX_MAGIC_LINE = 'mrtrix image'
+
+# Maps MRtrix datatypes (without endianness suffix) onto numpy dtypes
+MRTRIX_DATATYPES = {
+    'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2',
+    'Int32': 'i4', 'UInt32': 'u4', 'Int64': 'i8', 'UInt64': 'u8',
+    'Float32': 'f4', 'Float64': 'f8', 'CFloat32': 'c8', 'CFloat64': 'c16'}
+
+NIFTI_EXTS = ('.nii', '.nii.gz', '.img')
+
+MRTRIX_EXTS = ('.mif', '.mih')
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Environment variables used to configure how NIfTI images are written by
+# interfaces, so that the settings are picked up by nodes run in separate
+# processes/jobs. A compression level of 0 writes uncompressed (stored)
+# deflate blocks, which are still valid '.nii.gz' files
+COMPRESSION_LEVEL_ENV = 'BANANA_COMPRESSION_LEVEL'
+COMPRESSION_THREADS_ENV = 'BANANA_COMPRESSION_THREADS'
+
+# Precision policies for the images computed and written by interfaces:
+#   double - compute and write in float64
+#   single - compute and write in float32
+#   scaled - compute in float32 and write as int16 with scl_slope/inter
+# With 'single' and 'scaled', integer-valued images (e.g. masks) are written in
+# the smallest integer datatype that can hold them
+PRECISIONS = ('double', 'single', 'scaled')
+
+# The size of the blocks of uncompressed data that are compressed
+# independently (matches the default of pigz)
+GZIP_BLOCK_SIZE = 2 ** 17
+
+# The size of the deflate window, the tail of each block used to prime the
+# compression of the next
+GZIP_DICT_SIZE = 2 ** 15
+
+# The maximum number of voxels read from each image at a time when comparing
+# them (i.e. ~64 MB per image of float64 values)
+DEFAULT_BLOCK_VOXELS = 2 ** 23
+
+
+class MrtrixArrayProxy(object):
+    """
+    A lazily-loaded view of the voxel data of a MRtrix image, which maps the
+    data section of the file into memory and applies the intensity scaling
+    (if present) to only the slices that are accessed.
+
+    Parameters
+    ----------
+    array : np.memmap
+        The memory-mapped array of the stored values, already transposed and
+        flipped into the axis order of the image
+    offset : float
+        The intensity offset of the stored values
+    scale : float
+        The intensity scale of the stored values
+    """
+
+    def __init__(self, array, offset=0.0, scale=1.0):
+        self._array = array
+        self._offset = float(offset)
+        self._scale = float(scale)
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def ndim(self):
+        return self._array.ndim
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @property
+    def is_scaled(self):
+        return self._offset != 0.0 or self._scale != 1.0
+
+    @property
+    def dtype(self):
+        if self.is_scaled:
+            return np.result_type(self._array.dtype, np.float32)
+        return self._array.dtype
+
+    def get_unscaled(self):
+        "Returns the (memory-mapped) stored values without scaling"
+        return self._array
+
+    def __getitem__(self, index):
+        return self._scale_values(self._array[index])
+
+    def __array__(self, dtype=None, copy=None):
+        array = self._scale_values(self._array)
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def _scale_values(self, values):
+        if self.is_scaled:
+            values = self._offset + self._scale * values.astype(self.dtype)
+        return values
+
+
+def read_mrtrix_header(path):
+    """
+    Reads the header of a MRtrix image (.mif or .mih), stopping at the 'END'
+    line so that none of the voxel data is read from disk
+
+    Parameters
+    ----------
+    path : str
+        Path to the image file
+
+    Returns
+    -------
+    hdr : dict[str, *]
+        The header fields. 'dim', 'vox', 'scaling' and 'transform' fields
+        are converted to arrays and fields that are repeated (e.g.
+        'command_history') are collated into lists
+    """
+    lines = []
+    with open(path, 'rb') as f:
+        magic = f.readline().decode('utf-8').strip()
+        if magic != MRTRIX_MAGIC_LINE:
+            raise BananaUsageError(
+                "'{}' is not a MRtrix image file (first line was '{}')"
+                .format(path, magic))
+        for line in f:
+            line = line.decode('utf-8').strip()
+            if line == 'END':
+                break
+            lines.append(line)
+        else:
+            raise BananaUsageError(
+                "Did not find 'END' of header in MRtrix image file '{}'"
+                .format(path))
+    hdr = {}
+    for line in lines:
+        key, value = (s.strip() for s in line.split(':', maxsplit=1))
+        if key in hdr:
+            if not isinstance(hdr[key], list):
+                hdr[key] = [hdr[key]]
+            hdr[key].append(value)
+        else:
+            hdr[key] = value
+    for key, value in list(hdr.items()):
+        if key == 'transform':
+            hdr[key] = np.array([r.split(',') for r in value], dtype=float)
+        elif key == 'dim':
+            hdr[key] = np.array(value.split(','), dtype=int)
+        elif key in ('vox', 'scaling'):
+            hdr[key] = np.array(value.split(','), dtype=float)
+        elif key == 'layout':
+            hdr[key] = [v.strip() for v in value.split(',')]
+        elif isinstance(value, str):
+            hdr[key] = _convert_header_value(value)
+    return hdr
+
+
+def map_mrtrix_data(path, hdr=None):
+    """
+    Memory-maps the data section of a MRtrix image, honouring the datatype,
+    endianness, layout and intensity scaling declared in its header
+
+    Parameters
+    ----------
+    path : str
+        Path to the image (header) file
+    hdr : dict[str, *] | None
+        The header of the image as returned by read_mrtrix_header. Read from
+        the file if not provided
+
+    Returns
+    -------
+    proxy : MrtrixArrayProxy
+        A lazily-loaded view of the voxel data in the axis order of the image
+    """
+    if hdr is None:
+        hdr = read_mrtrix_header(path)
+    file_entry = hdr['file']
+    if isinstance(file_entry, list):
+        raise BananaUsageError(
+            "MRtrix images split over multiple data files are not "
+            "supported ('{}')".format(path))
+    fname, *offset = file_entry.split()
+    offset = int(offset[0]) if offset else 0
+    if fname == '.':
+        data_path = path
+    else:
+        data_path = op.join(op.dirname(path), fname)
+    datatype = hdr['datatype']
+    if datatype.endswith('LE'):
+        byte_order, datatype = '<', datatype[:-2]
+    elif datatype.endswith('BE'):
+        byte_order, datatype = '>', datatype[:-2]
+    else:
+        byte_order = '='
+    try:
+        dtype = np.dtype(byte_order + MRTRIX_DATATYPES[datatype])
+    except KeyError:
+        raise BananaUsageError(
+            "Unsupported datatype '{}' in MRtrix image file '{}'"
+            .format(hdr['datatype'], path))
+    dim = hdr['dim']
+    layout = hdr['layout']
+    # The absolute value in each layout entry gives the rank of the axis
+    # in memory (0 = fastest varying), and the sign its direction
+    ranks = [abs(int(l)) for l in layout]
+    disk_axes = sorted(range(len(dim)), key=lambda a: ranks[a], reverse=True)
+    array = np.memmap(data_path, dtype=dtype, mode='r', offset=offset,
+                      shape=tuple(dim[a] for a in disk_axes), order='C')
+    array = array.transpose([disk_axes.index(a) for a in range(len(dim))])
+    flips = tuple(slice(None, None, -1) if l.startswith('-') else slice(None)
+                  for l in layout)
+    return MrtrixArrayProxy(array[flips], *hdr.get('scaling', (0.0, 1.0)))
+
+
+def mrtrix_datatype(dtype):
+    """
+    Returns the MRtrix datatype string (e.g. 'Float32LE') corresponding to a
+    numpy dtype
+    """
+    dtype = np.dtype(dtype)
+    for datatype, code in MRTRIX_DATATYPES.items():
+        if (np.dtype(code).kind == dtype.kind
+                and np.dtype(code).itemsize == dtype.itemsize):
+            break
+    else:
+        raise BananaUsageError(
+            "Cannot store '{}' data in MRtrix image".format(dtype))
+    if dtype.itemsize > 1:
+        datatype += 'BE' if dtype.str.startswith('>') else 'LE'
+    return datatype
+
+
+def array_blocks(shape, max_voxels=DEFAULT_BLOCK_VOXELS):
+    """
+    Splits an array of the given shape into blocks of at most 'max_voxels'
+    voxels, which are aligned with its slowest-varying (i.e. last for NIfTI)
+    axes so that each block can be read from disk contiguously
+
+    Parameters
+    ----------
+    shape : tuple(int)
+        The shape of the array to split into blocks
+    max_voxels : int
+        The maximum number of voxels in each block (unless a single row of
+        the fastest-varying axis is larger)
+
+    Yields
+    ------
+    index : tuple(slice | int)
+        The index of each successive block within the array
+    """
+    shape = tuple(shape)
+    # Find the number of leading axes that can be read whole in each block
+    num_whole = 0
+    block_size = 1
+    while (num_whole < len(shape) and
+           block_size * shape[num_whole] <= max_voxels):
+        block_size *= shape[num_whole]
+        num_whole += 1
+    if num_whole == len(shape):
+        yield tuple(slice(None) for _ in shape)
+        return
+    whole = tuple(slice(None) for _ in range(num_whole))
+    step = max(max_voxels // block_size, 1)
+    chunks = [slice(i, min(i + step, shape[num_whole]))
+              for i in range(0, shape[num_whole], step)]
+    for outer in product(*(range(d) for d in shape[:num_whole:-1])):
+        for chunk in chunks:
+            yield whole + (chunk,) + outer[::-1]
+
+
+class ArrayDiff(object):
+    """
+    Summary statistics of the voxel-wise differences between two arrays, as
+    accumulated by compare_arrays
+
+    Parameters
+    ----------
+    num_voxels : int
+        The number of voxels compared
+    sum_sq : float
+        The sum of the squared differences between the voxels (excluding
+        voxels where only one of the arrays is NaN)
+    max_abs : float
+        The maximum absolute difference between the voxels
+    nan_mismatches : int
+        The number of voxels that are NaN in only one of the arrays
+    shape_mismatch : bool
+        Whether the shapes of the arrays could not be broadcast together
+    complete : bool
+        Whether all voxels were compared (i.e. the comparison was not
+        short-circuited)
+    """
+
+    def __init__(self, num_voxels=0, sum_sq=0.0, max_abs=0.0,
+                 nan_mismatches=0, shape_mismatch=False, complete=True):
+        self.num_voxels = num_voxels
+        self.sum_sq = sum_sq
+        self.max_abs = max_abs
+        self.nan_mismatches = nan_mismatches
+        self.shape_mismatch = shape_mismatch
+        self.complete = complete
+
+    @property
+    def rms(self):
+        "The root-mean-square difference per voxel"
+        if self.shape_mismatch:
+            return float('inf')
+        if not self.num_voxels:
+            return 0.0
+        return float(np.sqrt(self.sum_sq / self.num_voxels))
+
+    @property
+    def equal(self):
+        return (not self.shape_mismatch and self.max_abs == 0.0 and
+                not self.nan_mismatches)
+
+    def __repr__(self):
+        return ("{}(num_voxels={}, rms={}, max_abs={}, nan_mismatches={}, "
+                "shape_mismatch={}, complete={})".format(
+                    type(self).__name__, self.num_voxels, self.rms,
+                    self.max_abs, self.nan_mismatches, self.shape_mismatch,
+                    self.complete))
+
+
+def compare_arrays(array, other_array, exact=False,
+                   max_voxels=DEFAULT_BLOCK_VOXELS):
+    """
+    Compares two (possibly lazily loaded) arrays a block at a time (see
+    array_blocks), so that only a bounded number of voxels are held in memory
+    at once
+
+    Parameters
+    ----------
+    array : np.ndarray | nibabel.arrayproxy.ArrayProxy | MrtrixArrayProxy
+        One of the arrays to compare
+    other_array : np.ndarray | nibabel.arrayproxy.ArrayProxy | MrtrixArrayProxy
+        The other array to compare
+    exact : bool
+        Whether to stop at the first block that isn't exactly equal (NaNs
+        are considered equal to each other)
+    max_voxels : int
+        The maximum number of voxels to read from each array at a time
+
+    Returns
+    -------
+    diff : ArrayDiff
+        Summary statistics of the differences between the arrays
+    """
+    if tuple(array.shape) != tuple(other_array.shape):
+        # Fall back to loading the arrays in full to broadcast them together
+        try:
+            array, other_array = np.broadcast_arrays(
+                np.asanyarray(array), np.asanyarray(other_array))
+        except ValueError:
+            return ArrayDiff(shape_mismatch=True, complete=False)
+    diff = ArrayDiff()
+    for index in array_blocks(array.shape, max_voxels=max_voxels):
+        block = np.asanyarray(array[index])
+        other_block = np.asanyarray(other_array[index])
+        diff.num_voxels += block.size
+        if exact and np.array_equal(block, other_block, equal_nan=(
+                block.dtype.kind in 'fc' or other_block.dtype.kind in 'fc')):
+            continue
+        dtype = np.result_type(block.dtype, other_block.dtype, np.float64)
+        block_diff = np.ravel(block.astype(dtype) - other_block.astype(dtype))
+        isnan = np.isnan(block_diff)
+        if isnan.any():
+            diff.nan_mismatches += int(np.count_nonzero(
+                np.isnan(block) != np.isnan(other_block)))
+            block_diff = block_diff[~isnan]
+        if block_diff.size:
+            abs_diff = np.abs(block_diff)
+            diff.sum_sq += float(np.dot(abs_diff, abs_diff))
+            diff.max_abs = max(diff.max_abs, float(abs_diff.max()))
+        if exact and not diff.equal:
+            diff.complete = False
+            break
+    return diff
+
+
+def array_digest(array, max_voxels=DEFAULT_BLOCK_VOXELS):
+    """
+    Returns a SHA-256 digest of the shape, datatype and values of a (possibly
+    lazily loaded) array, which is read a block at a time (see array_blocks)
+
+    Parameters
+    ----------
+    array : np.ndarray | nibabel.arrayproxy.ArrayProxy | MrtrixArrayProxy
+        The array to digest
+    max_voxels : int
+        The maximum number of voxels to read from the array at a time
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the array
+    """
+    sha = hashlib.sha256()
+    dtype = None
+    for index in array_blocks(array.shape, max_voxels=max_voxels):
+        block = np.asanyarray(array[index])
+        if dtype is None:
+            dtype = block.dtype.newbyteorder('<')
+            sha.update('{}:{}'.format(tuple(array.shape),
+                                      dtype.str).encode('utf-8'))
+        sha.update(np.ascontiguousarray(block, dtype=dtype).tobytes())
+    return sha.hexdigest()
+
+
+def header_digest(hdr, keys):
+    """
+    Returns a SHA-256 digest of the values of the given header fields, which
+    are normalised (e.g. numpy arrays converted to lists) so that the digest
+    doesn't depend on how they are stored
+
+    Parameters
+    ----------
+    hdr : dict-like
+        The image header
+    keys : iterable
+        The keys of the header fields to include in the digest
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the header fields
+    """
+    normalised = sorted((str(k), _normalise_header_value(hdr[k]))
+                        for k in keys)
+    return hashlib.sha256(json.dumps(normalised, default=str).encode(
+        'utf-8')).hexdigest()
+
+
+def precision_dtype(precision):
+    """
+    Returns the floating point datatype to compute images in for the given
+    precision policy (see PRECISIONS)
+    """
+    if precision not in PRECISIONS:
+        raise BananaUsageError(
+            "Unrecognised precision '{}', can be one of '{}'".format(
+                precision, "', '".join(PRECISIONS)))
+    return np.float64 if precision == 'double' else np.float32
+
+
+def minimal_dtype(array, precision):
+    """
+    Returns the smallest datatype that an array can be stored in without
+    losing more than the given precision policy allows. 'double' arrays keep
+    their datatype, otherwise integer-valued arrays are stored in the
+    smallest integer type that can hold their range, 'single' arrays in
+    float32 and 'scaled' arrays in int16 (with scl_slope/inter set when
+    written by nibabel)
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The array to store
+    precision : str
+        The precision policy (see PRECISIONS)
+
+    Returns
+    -------
+    dtype : np.dtype
+        The datatype to store the array in
+    """
+    array = np.asanyarray(array)
+    if (precision_dtype(precision) == np.float64 or
+            array.dtype.kind not in 'iuf' or not array.size):
+        return array.dtype
+    if array.dtype.kind in 'iu':
+        is_int = True
+    else:
+        is_int = (np.isfinite(array).all() and
+                  not np.any(np.mod(array, 1)))
+    if is_int:
+        min_val, max_val = array.min(), array.max()
+        for dtype in (np.uint8, np.int16, np.uint16, np.int32):
+            info = np.iinfo(dtype)
+            if info.min <= min_val and max_val <= info.max:
+                return np.dtype(dtype)
+    if array.dtype.kind != 'f':
+        return array.dtype
+    elif precision == 'single':
+        return np.dtype(np.float32)
+    return np.dtype(np.int16)
+
+
+class ParallelGzipFile(io.RawIOBase):
+    """
+    A write-only file object that gzips the data written to it in
+    independent blocks on a pool of threads, in the same manner as pigz.
+    Each block is primed with the tail of the previous block and terminated
+    with a sync flush, so the output is a single standard gzip member that
+    can be read by gzip/nibabel (and is almost as small as serial output)
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to write
+    compression_level : int
+        The zlib compression level (0-9) to compress the blocks with
+    num_threads : int | None
+        The number of threads to compress the blocks on. Defaults to the
+        number of CPUs
+    block_size : int
+        The size of the uncompressed blocks
+    """
+
+    def __init__(self, path, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 num_threads=None, block_size=GZIP_BLOCK_SIZE):
+        super().__init__()
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        self._level = compression_level
+        self._block_size = block_size
+        self._max_pending = 2 * num_threads
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._prev_tail = b''
+        self._crc = 0
+        self._size = 0
+        self._file = open(path, 'wb')
+        # Gzip header with no file name or timestamp, so that the output
+        # only depends on the data. The extra flags mark the best/fastest
+        # compression levels as in gzip
+        xfl = 2 if compression_level == 9 else (
+            4 if compression_level == 1 else 0)
+        self._file.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00' +
+                         bytes([xfl, 255]))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Only "seeks" to the current position are supported, which are
+        # performed when nibabel writes the image data after the header
+        if whence == io.SEEK_CUR:
+            offset += self._size
+        if whence == io.SEEK_END or offset != self._size:
+            raise io.UnsupportedOperation(
+                "Cannot seek in write-only gzip file")
+        return self._size
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._file.write(struct.pack('<II', self._crc & 0xffffffff,
+                                         self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+            super().close()
+
+    def _submit(self, block, last):
+        self._pending.append(self._executor.submit(
+            _deflate_block, block, self._level, self._prev_tail, last))
+        self._prev_tail = block[-GZIP_DICT_SIZE:]
+        # Write out completed blocks in order, bounding the number of blocks
+        # held in memory
+        while self._pending and (len(self._pending) > self._max_pending or
+                                 self._pending[0].done()):
+            self._file.write(self._pending.popleft().result())
+
+
+def _deflate_block(block, level, zdict, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def open_compressed(path, compression_level=None, num_threads=None):
+    """
+    Opens a file for writing, which is compressed with a ParallelGzipFile if
+    its path ends in '.gz'. The compression level and number of threads
+    default to the values of the BANANA_COMPRESSION_LEVEL and
+    BANANA_COMPRESSION_THREADS environment variables if set
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to write
+    compression_level : int | None
+        The compression level (0-9) to use
+    num_threads : int | None
+        The number of threads to compress with
+    """
+    if not path.endswith('.gz'):
+        return open(path, 'wb')
+    if compression_level is None:
+        compression_level = int(os.environ.get(COMPRESSION_LEVEL_ENV,
+                                               DEFAULT_COMPRESSION_LEVEL))
+    if num_threads is None and COMPRESSION_THREADS_ENV in os.environ:
+        num_threads = int(os.environ[COMPRESSION_THREADS_ENV])
+    return ParallelGzipFile(path, compression_level=compression_level,
+                            num_threads=num_threads)
+
+
+def save_image(image, path, compression_level=None, num_threads=None,
+               precision=None):
+    """
+    Saves a nibabel image, as per nibabel.save, compressing '.nii.gz' files
+    in parallel at a selectable compression level (see open_compressed) and
+    optionally storing the data in the smallest datatype allowed by a
+    precision policy (see minimal_dtype)
+
+    Parameters
+    ----------
+    image : nibabel.Nifti1Image
+        The image to save
+    path : str
+        Path to save the image to
+    compression_level : int | None
+        The compression level (0-9) to use. Defaults to the value of the
+        BANANA_COMPRESSION_LEVEL environment variable if set
+    num_threads : int | None
+        The number of threads to compress with. Defaults to the value of the
+        BANANA_COMPRESSION_THREADS environment variable if set, otherwise
+        the number of CPUs
+    precision : str | None
+        The precision policy to store the data with (see PRECISIONS), if
+        None or 'double' the datatype of the image header is used
+    """
+    if precision is not None and precision_dtype(precision) != np.float64:
+        image.set_data_dtype(minimal_dtype(image.dataobj, precision))
+    if not path.endswith('.nii.gz'):
+        nibabel.save(image, path)
+        return
+    if not isinstance(image, nibabel.Nifti1Image):
+        image = nibabel.Nifti1Image.from_image(image)
+    with open_compressed(path, compression_level=compression_level,
+                         num_threads=num_threads) as f:
+        image.to_file_map({'image': nibabel.FileHolder(fileobj=f)})
+
+
+def convert_image(in_path, out_path, compression_level=None):
+    """
+    Converts an image between the NIfTI (.nii/.nii.gz), NIfTI/Analyze pair
+    (.img/.hdr) and MRtrix (.mif) formats in a single pass, streaming the
+    stored (i.e. unscaled) voxel values one slab at a time so that peak
+    memory usage is bounded by the size of a single slab
+
+    Parameters
+    ----------
+    in_path : str
+        Path to the image to convert
+    out_path : str
+        Path to write the converted image to. The format is determined by
+        its extension
+    compression_level : int | None
+        The gzip compression level (0-9) to use when writing '.nii.gz' files.
+        Defaults to the value of the BANANA_COMPRESSION_LEVEL environment
+        variable if set
+    """
+    shape, dtype, affine, zooms, inter, slope, nifti_hdr, slabs = (
+        _open_image(in_path))
+    if out_path.endswith(MRTRIX_EXTS):
+        if out_path.endswith('.mih'):
+            raise BananaUsageError(
+                "Writing MRtrix header/data pairs ('{}') is not supported"
+                .format(out_path))
+        _write_mrtrix(out_path, shape, dtype, affine, zooms, inter, slope,
+                      slabs)
+    elif out_path.endswith(NIFTI_EXTS):
+        _write_nifti(out_path, shape, dtype, affine, zooms, inter, slope,
+                     nifti_hdr, slabs, compression_level=compression_level)
+    else:
+        raise BananaUsageError(
+            "Unrecognised extension of image to write '{}'".format(out_path))
+
+
+def _open_image(path):
+    """
+    Opens an image and returns its geometry along with a generator of its
+    stored (unscaled) values, one slab along the last axis at a time
+    """
+    if path.endswith(MRTRIX_EXTS):
+        hdr = read_mrtrix_header(path)
+        proxy = map_mrtrix_data(path, hdr)
+        array = proxy.get_unscaled()
+        zooms = np.asarray(hdr['vox'], dtype=float)
+        transform = np.asarray(hdr['transform'], dtype=float)
+        affine = np.eye(4)
+        affine[:3, :3] = transform[:, :3] * zooms[:3]
+        affine[:3, 3] = transform[:, 3]
+
+        def slabs():
+            for i in range(array.shape[-1]):
+                yield array[..., i]
+
+        return (array.shape, array.dtype, affine, zooms, proxy.offset,
+                proxy.scale, None, slabs())
+    image = nibabel.load(path)
+    proxy = image.dataobj
+    hdr = image.header
+    order = getattr(proxy, 'order', 'F')
+
+    def slabs():
+        with ImageOpener(proxy.file_like) as fileobj:
+            for i in range(proxy.shape[-1]):
+                sliceobj = (slice(None),) * (len(proxy.shape) - 1) + (i,)
+                yield fileslice(fileobj, sliceobj, proxy.shape, proxy.dtype,
+                                offset=proxy.offset, order=order)
+
+    # The scaling is reset in the header of loaded images and stored in the
+    # array proxy instead
+    return (proxy.shape, proxy.dtype, image.affine, hdr.get_zooms(),
+            float(proxy.inter), float(proxy.slope),
+            hdr if isinstance(hdr, Nifti1Header) else None, slabs())
+
+
+def _write_nifti(path, shape, dtype, affine, zooms, inter, slope, nifti_hdr,
+                 slabs, compression_level=None):
+    is_pair = path.endswith('.img')
+    hdr_klass = Nifti1PairHeader if is_pair else Nifti1Header
+    if nifti_hdr is not None:
+        # Keep all fields (and extensions) of the original NIfTI header
+        hdr = hdr_klass(nifti_hdr.binaryblock, nifti_hdr.endianness,
+                        extensions=nifti_hdr.extensions)
+        hdr['magic'] = hdr.pair_magic if is_pair else hdr.single_magic
+    else:
+        hdr = hdr_klass()
+        hdr.set_data_shape(shape)
+        hdr.set_data_dtype(dtype)
+        hdr.set_zooms(zooms[:len(shape)])
+        hdr.set_qform(affine, code='scanner')
+        hdr.set_sform(affine, code='scanner')
+        hdr.set_xyzt_units('mm', 'sec')
+    hdr.set_slope_inter(slope, inter)
+    hdr.set_data_offset(0)  # Set to minimum valid offset by 'write_to'
+    if is_pair:
+        with open(path[:-len('.img')] + '.hdr', 'wb') as f:
+            hdr.write_to(f)
+        img_file = open(path, 'wb')
+    else:
+        img_file = open_compressed(path,
+                                   compression_level=compression_level)
+    out_dtype = hdr.get_data_dtype()
+    with img_file:
+        if not is_pair:
+            hdr.write_to(img_file)
+            img_file.write(b'\x00' * (int(hdr['vox_offset']) - img_file.tell()))
+        for slab in slabs:
+            img_file.write(np.asarray(slab, dtype=out_dtype).tobytes(order='F'))
+
+
+def _write_mrtrix(path, shape, dtype, affine, zooms, inter, slope, slabs):
+    zooms = np.asarray(zooms, dtype=float)
+    transform = np.array(affine[:3, :], dtype=float)
+    transform[:, :3] /= zooms[:3]
+    dtype = np.dtype(dtype).newbyteorder('<')
+    lines = [
+        MRTRIX_MAGIC_LINE,
+        'dim: ' + ','.join(str(d) for d in shape),
+        'vox: ' + ','.join(repr(float(z)) for z in zooms[:len(shape)]),
+        'layout: ' + ','.join('+{}'.format(i) for i in range(len(shape))),
+        'datatype: ' + mrtrix_datatype(dtype)]
+    lines.extend('transform: ' + ','.join(repr(float(v)) for v in row)
+                 for row in transform)
+    if inter != 0.0 or slope != 1.0:
+        lines.append('scaling: {!r},{!r}'.format(float(inter), float(slope)))
+    hdr_text = '\n'.join(lines) + '\n'
+    # The data offset is included in the header so need to iterate until the
+    # length of the offset string is stable, then pad to a 16-byte boundary
+    offset = len(hdr_text)
+    while True:
+        trailer = 'file: . {}\nEND\n'.format(offset)
+        new_offset = len(hdr_text) + len(trailer)
+        new_offset += -new_offset % 16
+        if new_offset == offset:
+            break
+        offset = new_offset
+    header = (hdr_text + trailer).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(b'\x00' * (offset - len(header)))
+        for slab in slabs:
+            f.write(np.asarray(slab, dtype=dtype).tobytes(order='F'))
+
+
+def _convert_header_value(value):
+    if ',' in value:
+        try:
+            value = np.array(value.split(','), dtype=int)
+        except ValueError:
+            try:
+                value = np.array(value.split(','), dtype=float)
+            except ValueError:
+                pass
+    else:
+        try:
+            value = int(value)
+        except ValueError:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+    return value
+
+
+def _normalise_header_value(value):
+    # Unwrap DICOM data elements
+    value = getattr(value, 'value', value)
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind in 'SV':
+            return value.tobytes().hex()
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return _normalise_header_value(value.item())
+    elif isinstance(value, (bytes, bytearray)):
+        return bytes(value).hex()
+    elif isinstance(value, (list, tuple)):
+        return [_normalise_header_value(v) for v in value]
+    elif isinstance(value, dict):
+        return sorted((str(k), _normalise_header_value(v))
+                      for k, v in value.items())
+    elif isinstance(value, (int, float, str)) or value is None:
+        return value
+    return str(value)
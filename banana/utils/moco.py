@@ -5,6 +5,7 @@ import shutil
 import errno
 import subprocess as sp
 from banana.interfaces.dicom import DicomHeaderInfoExtraction
+from banana.utils.dicom import siemens_protocol, siemens_phase_encoding
 import numpy as np
 import re
 import datetime as dt
@@ -224,17 +225,11 @@ def guess_scan_type(scans, input_dir):
             dcm_files = sorted(glob.glob(input_dir+'/'+scan+'/*.IMA'))
         if not dcm_files:
             continue
-        dicom = dcm_files[0]
-        hd = pydicom.read_file(dicom)
-        with open(dcm_files[0], 'rb') as f:
-            for line in f:
-                try:
-                    line = line[:-1].decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                if 'tSequenceFileName' in line:
-                    sequence_name = line.strip().split('\\')[-1].split('"')[0]
-                    break
+        hd = pydicom.dcmread(dcm_files[0], stop_before_pixels=True)
+        protocol = siemens_protocol(dcm_files[0], header=hd)
+        if 'tSequenceFileName' in protocol:
+            sequence_name = str(protocol['tSequenceFileName']).split(
+                '\\')[-1]
 
         if sequence_name is not None:
             if (('tfl' in sequence_name or
@@ -352,19 +347,18 @@ def dwi_type_assignment(input_dir, dwi_images):
             if 'Dimensions:' in line:
                 dim = line.split('Dimensions:')[-1].strip().split('x')
                 break
-        hd_extraction = DicomHeaderInfoExtraction()
-        hd_extraction.inputs.dicom_folder = input_dir+'/'+dwi
-        dcm_info = hd_extraction.run()
-
-        if dcm_info.outputs.pe_angle and dcm_info.outputs.ped:
+        # Only the phase encoding is required so the header of the first
+        # file is read directly instead of running DicomHeaderInfoExtraction
+        first_dcm = sorted(glob.glob(input_dir + '/' + dwi + '/*'))[0]
+        hd = pydicom.dcmread(first_dcm, stop_before_pixels=True)
+        pe_angle, ped = siemens_phase_encoding(
+            hd, siemens_protocol(first_dcm, header=hd))
+
+        if pe_angle is not None and ped:
             if len(dim) == 4:
-                main_dwi.append(
-                    [dwi, np.trunc(float(dcm_info.outputs.pe_angle)),
-                     dcm_info.outputs.ped])
+                main_dwi.append([dwi, np.trunc(float(pe_angle)), ped])
             else:
-                b0.append([
-                    dwi, np.trunc(float(dcm_info.outputs.pe_angle)),
-                    dcm_info.outputs.ped])
+                b0.append([dwi, np.trunc(float(pe_angle)), ped])
         else:
             print('Could not find phase encoding information from the'
                   'dwi images header. Distortion correction will not '
@@ -0,0 +1,225 @@
+"""
+Helpers for reading the acquisition metadata (e.g. start time and duration)
+of PET list-mode data from the headers stored alongside it
+"""
+import os
+import os.path as op
+import re
+import json
+import hashlib
+import tempfile
+import datetime as dt
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+import pydicom
+from banana.utils.dicom import DICOM_INDEX_CACHE_ENV
+
+
+logger = getLogger('banana')
+
+LIST_MODE_EXT = '.bf'
+
+# Extension of the (DICOM) header that accompanies each list-mode file
+LIST_MODE_HEADER_EXT = '.dcm'
+
+# Matches the duration in the interfile header embedded in the DICOM header
+# of Siemens list-mode data, e.g. 'image duration (sec):=3600'
+IMAGE_DURATION_RE = re.compile(rb'image duration[^:\r\n]*:=\s*([0-9.]+)')
+
+# Incremented when the fields of ListModeInfo change to invalidate the
+# cached info
+LIST_MODE_INFO_VERSION = 1
+
+TIME_FORMAT = '%H%M%S.%f'
+
+
+ListModeInfo = namedtuple('ListModeInfo', [
+    'path', 'size', 'header', 'start_time', 'duration', 'end_time'])
+ListModeInfo.__doc__ = """
+The acquisition metadata of a PET list-mode file
+
+Parameters
+----------
+path : str
+    Path to the list-mode file
+size : int
+    The size of the list-mode file in bytes
+header : str | None
+    Path to the header of the list-mode file (None if it wasn't found)
+start_time : str | None
+    The acquisition start time ('HHMMSS.ffffff')
+duration : int | None
+    The duration of the acquisition in seconds
+end_time : str | None
+    The acquisition end time ('HHMMSS.ffffff')
+"""
+
+
+def list_mode_acquisitions(pet_data_dir, num_threads=None):
+    """
+    Reads the acquisition metadata of the list-mode files in a directory
+    (and its non-hidden sub-directories). The directory is walked once to
+    locate the list-mode files and their headers, which are then read
+    concurrently.
+
+    The metadata read from each header is cached in memory and, if the
+    BANANA_DICOM_INDEX_CACHE environment variable is set, in JSON files in
+    that directory so that it is reused by other processes. Cached metadata
+    is invalidated when the modification time or size of the header change.
+
+    Parameters
+    ----------
+    pet_data_dir : str
+        Path to the directory containing the list-mode data
+    num_threads : int | None
+        The number of threads to read the headers with. Defaults to the
+        ThreadPoolExecutor default
+
+    Returns
+    -------
+    acquisitions : list[ListModeInfo]
+        The metadata of each list-mode file, largest file first
+    """
+    list_mode_files = []
+    headers = {}
+    for root, dirs, files in os.walk(pet_data_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for fname in files:
+            if fname.startswith('.'):
+                continue
+            stem, ext = op.splitext(fname)
+            path = op.join(root, fname)
+            if ext == LIST_MODE_EXT:
+                list_mode_files.append((path, op.getsize(path)))
+            elif ext == LIST_MODE_HEADER_EXT:
+                headers[op.join(root, stem)] = path
+    list_mode_files.sort(key=lambda f: (-f[1], f[0]))
+
+    def read(list_mode_file):
+        path, size = list_mode_file
+        header = headers.get(op.splitext(path)[0])
+        if header is None:
+            logger.warning("No header found for list-mode file '%s'", path)
+            return ListModeInfo(path, size, None, None, None, None)
+        start_time, duration = read_list_mode_header(header)
+        return ListModeInfo(path, size, header, start_time, duration,
+                            end_time(start_time, duration))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(read, list_mode_files))
+
+
+def read_list_mode_header(path):
+    """
+    Reads the acquisition start time and duration from the DICOM header of
+    a list-mode file, using the cached values if they are up to date
+
+    Parameters
+    ----------
+    path : str
+        Path to the header
+
+    Returns
+    -------
+    start_time : str | None
+        The acquisition start time, None if it isn't in the header
+    duration : int | None
+        The acquisition duration in seconds, None if it isn't in the header
+    """
+    path = op.realpath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    try:
+        cached_key, values = _header_memo[path]
+    except KeyError:
+        pass
+    else:
+        if cached_key == key:
+            return values
+    cache_path = _cache_path(path)
+    values = None
+    if cache_path is not None and op.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if (cached['version'] == LIST_MODE_INFO_VERSION
+                    and tuple(cached['key']) == key):
+                values = (cached['start_time'], cached['duration'])
+        except (IOError, ValueError, KeyError):
+            logger.warning("Ignoring corrupt list-mode header cache '%s'",
+                           cache_path)
+    if values is None:
+        values = _read_header(path)
+        if cache_path is not None:
+            _write_cache(cache_path, {
+                'version': LIST_MODE_INFO_VERSION, 'key': key,
+                'start_time': values[0], 'duration': values[1]})
+    _header_memo[path] = (key, values)
+    return values
+
+
+def end_time(start_time, duration):
+    """
+    Calculates the end time of an acquisition from its start time and
+    duration ('HHMMSS.ffffff'), None if either is None
+    """
+    if start_time is None or not duration:
+        return None
+    return (parse_time(start_time) + dt.timedelta(seconds=duration)).strftime(
+        TIME_FORMAT)
+
+
+def parse_time(time_str):
+    """
+    Parses a DICOM time ('HHMMSS' with optional fractional seconds)
+    """
+    if '.' not in time_str:
+        time_str += '.0'
+    return dt.datetime.strptime(time_str, TIME_FORMAT)
+
+
+def _read_header(path):
+    header = pydicom.dcmread(path, stop_before_pixels=True)
+    start_time = header.get('AcquisitionTime')
+    start_time = str(start_time) if start_time else None
+    duration = None
+    # The interfile header is stored in a private element of the DICOM
+    # header
+    for elem in header:
+        if elem.tag.is_private and isinstance(elem.value, bytes):
+            match = IMAGE_DURATION_RE.search(elem.value)
+            if match is not None:
+                duration = int(float(match.group(1)))
+                break
+    else:
+        # Fall back to searching the whole file
+        with open(path, 'rb') as f:
+            match = IMAGE_DURATION_RE.search(f.read())
+        if match is not None:
+            duration = int(float(match.group(1)))
+    return start_time, duration
+
+
+def _cache_path(path):
+    try:
+        cache_dir = os.environ[DICOM_INDEX_CACHE_ENV]
+    except KeyError:
+        return None
+    return op.join(cache_dir, 'list-mode-' + hashlib.sha256(
+        path.encode('utf-8')).hexdigest() + '.json')
+
+
+def _write_cache(cache_path, values):
+    cache_dir = op.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file and rename so that concurrent readers never
+    # see partially written values
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(values, f)
+    os.replace(tmp_path, cache_path)
+
+
+# In-memory cache of the values read from each list-mode header
+_header_memo = {}
@@ -0,0 +1,191 @@
+"""
+Dry-run planning of derivations, which determines the nodes that would be
+executed to derive a set of specs (taking into account the derivatives
+already present in the dataset and their provenance) and estimates their
+cost without running them
+"""
+from collections import namedtuple
+from logging import getLogger
+
+
+logger = getLogger('banana')
+
+
+NodePlan = namedtuple('NodePlan', [
+    'pipeline', 'name', 'interface', 'iterables', 'wall_time', 'mem_gb',
+    'n_procs', 'from_history'])
+NodePlan.__doc__ = """
+A node that would be executed by a derivation
+
+Parameters
+----------
+pipeline : str
+    The name of the pipeline the node belongs to
+name : str
+    The name of the node
+interface : str
+    The name of the interface class of the node
+iterables : str
+    The values of the iterables (e.g. subject and visit IDs) the node is
+    executed for
+wall_time : float
+    The estimated wall time in minutes
+mem_gb : float
+    The estimated peak memory in GB
+n_procs : int
+    The number of processors allocated to the node
+from_history : bool
+    Whether the estimates are from recorded runs of the node (instead of
+    the values declared in the pipeline)
+"""
+
+
+PipelinePlan = namedtuple('PipelinePlan', [
+    'name', 'to_process', 'num_sessions', 'nodes'])
+PipelinePlan.__doc__ = """
+A pipeline required by a derivation
+
+Parameters
+----------
+name : str
+    The name of the pipeline
+to_process : int
+    The number of subject/visit pairs the pipeline would be run for, 0 if
+    its outputs are already present in the dataset and match the current
+    provenance
+num_sessions : int
+    The number of subject/visit pairs in the dataset
+nodes : list[NodePlan]
+    The nodes that would be executed
+"""
+
+
+class PlanPlugin(object):
+    """
+    A Nipype execution plugin that records the execution graph of a workflow
+    instead of running it
+    """
+
+    plugin_args = {}
+
+    def __init__(self):
+        self.graph = None
+
+    def run(self, graph, config, updatehash=False):  # @UnusedVariable
+        self.graph = graph
+
+
+def plan_derivation(analysis, names, history=None, **kwargs):
+    """
+    Determines the pipelines and nodes that would be executed to derive the
+    given specs of an analysis, by building the workflow in the same way as
+    Analysis.derive but substituting a plugin that doesn't run it
+
+    Parameters
+    ----------
+    analysis : Analysis
+        The analysis to derive the specs from
+    names : list[str]
+        The names of the specs to derive
+    history : RunHistory | None
+        The history of previous runs to estimate the wall time and memory of
+        each node from. If None (or a node hasn't been recorded) the values
+        declared in the pipeline are used
+    kwargs : dict
+        Keyword arguments passed to the processor's 'run' method (e.g.
+        'subject_ids', 'visit_ids')
+
+    Returns
+    -------
+    plan : list[PipelinePlan]
+        The pipelines required to derive the specs in order of execution
+    """
+    from arcana.processor.base import Processor
+    from banana.analysis.base import _batch_pipelines
+    processor = analysis.processor
+    plugin = PlanPlugin()
+    pipelines = _batch_pipelines(analysis, names)
+    if not pipelines:
+        return []
+    # Walk the pipelines from the requested ones to their prerequisites
+    # before they are run, as the analysis' cache of pipelines is cleared
+    # after each run
+    required = []
+    visited = set()
+    to_visit = [p for p, _ in pipelines]
+    while to_visit:
+        pipeline = to_visit.pop(0)
+        if pipeline.name in visited:
+            continue
+        visited.add(pipeline.name)
+        required.append(pipeline)
+        to_visit.extend(analysis.pipeline(g) for g in pipeline.prerequisites)
+    orig_plugin = processor._plugin
+    processor._plugin = plugin
+    try:
+        # The base class' method is called explicitly as processors that
+        # submit the workflow (e.g. SlurmProc) raise an exception once it
+        # has been run
+        Processor.run(processor, *(p for p, _ in pipelines),
+                      required_outputs=[r for _, r in pipelines],
+                      clean_work_dir=False, **kwargs)
+    finally:
+        processor._plugin = orig_plugin
+    estimates = history.estimates() if history is not None else {}
+    nodes = {}
+    if plugin.graph is not None:
+        for node in plugin.graph.nodes():
+            # The hierarchy of nodes in Arcana workflows is
+            # '<workflow>.<pipeline>'
+            pipeline_name = node._hierarchy.split('.')[-1]
+            estimate = estimates.get((pipeline_name, node.name))
+            if estimate is not None:
+                wall_time = estimate.wall_time
+                mem_gb = (estimate.mem_gb if estimate.mem_gb is not None
+                          else node.mem_gb)
+            else:
+                wall_time = getattr(node, 'wall_time', None)
+                if wall_time is None:
+                    wall_time = processor.default_wall_time
+                mem_gb = node.mem_gb
+            nodes.setdefault(pipeline_name, []).append(NodePlan(
+                pipeline=pipeline_name, name=node.name,
+                interface=type(node.interface).__name__,
+                iterables=','.join(node.parameterization),
+                wall_time=wall_time, mem_gb=mem_gb, n_procs=node.n_procs,
+                from_history=estimate is not None))
+    plan = []
+    for pipeline in reversed(required):
+        # The sessions to process are recorded on each pipeline by the
+        # processor when it is connected to the workflow
+        to_process_array = getattr(pipeline, 'to_process_array', None)
+        plan.append(PipelinePlan(
+            name=pipeline.name,
+            to_process=(int(to_process_array.sum())
+                        if to_process_array is not None else 0),
+            num_sessions=(to_process_array.size
+                          if to_process_array is not None else 0),
+            nodes=nodes.get(pipeline.name, [])))
+    return plan
+
+
+def plan_summary(plan):
+    """
+    Sums the estimated cost of a plan
+
+    Parameters
+    ----------
+    plan : list[PipelinePlan]
+        The plan returned by plan_derivation
+
+    Returns
+    -------
+    cpu_hours : float
+        The total CPU-hours of the nodes to be executed
+    peak_mem_gb : float
+        The peak memory required by any single node
+    """
+    nodes = [n for p in plan for n in p.nodes]
+    cpu_hours = sum(n.wall_time * (n.n_procs or 1) for n in nodes) / 60.0
+    peak_mem_gb = max((n.mem_gb for n in nodes), default=0.0)
+    return cpu_hours, peak_mem_gb
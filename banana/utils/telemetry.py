@@ -0,0 +1,299 @@
+"""
+Opt-in profiling of the resources used by each node of a derivation. The
+nodes are created by profiled versions of Arcana's environments, which wrap
+the execution of each node and append a record of the resources it used to
+a JSON-lines file for the run. As the records are written by the process
+that runs the node they are collected for all processors, including nodes
+submitted to SLURM (as long as the file is on a shared file-system).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from collections import OrderedDict
+from logging import getLogger
+from arcana.environment.base import Node, JoinNode, MapNode
+from arcana.environment.static import StaticEnv
+from arcana.environment.modules import (
+    ModulesEnv, ModulesNode, ModulesJoinNode, ModulesMapNode)
+from banana.utils.history import NodeRecord
+
+
+logger = getLogger('banana')
+
+# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# ru_inblock/ru_oublock are counted in 512 byte blocks
+IO_BLOCK_SIZE = 512
+
+# CPU utilisation (as a fraction of the processors allocated to a node)
+# above which the node is considered CPU-bound and below which it is
+# considered I/O or otherwise bound
+CPU_BOUND_THRESHOLD = 0.7
+
+
+def _usage():
+    return (time.time(), resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+class ProfiledNodeMixin():
+    """
+    Records the wall time, CPU time (of the node's process and of the
+    subprocesses it waited for), peak resident memory and block I/O used to
+    run a node in the profile of the environment.
+
+    Note that the peak memory is the peak over the lifetime of the process
+    (and its subprocesses), so it is an upper bound for nodes run in worker
+    processes that are reused between nodes (i.e. by the 'multi' processor)
+    """
+
+    def _run_command(self, *args, **kwargs):
+        start = _usage()
+        status = 'failed'
+        try:
+            result = super()._run_command(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            try:
+                self._record_usage(start, _usage(), status)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Could not record resources used by '%s' "
+                               "node: %s", self.name, e)
+
+    def _record_usage(self, start, end, status):
+        start_time, start_self, start_children = start
+        end_time, end_self, end_children = end
+        pipeline = getattr(self, '_profile_pipeline', None)
+        if pipeline is None:
+            # The hierarchy of nodes in Arcana workflows is
+            # '<workflow>.<pipeline>'
+            pipeline = (self._hierarchy or '').split('.')[-1]
+        record = OrderedDict([
+            ('pipeline', pipeline),
+            ('node', getattr(self, '_profile_node', self.name)),
+            ('interface', type(self.interface).__name__),
+            ('iterables', ','.join(self.parameterization or ())),
+            ('host', socket.gethostname()),
+            ('pid', os.getpid()),
+            ('start', start_time),
+            ('wall_time', end_time - start_time),
+            ('cpu_time', ((end_self.ru_utime + end_self.ru_stime)
+                          - (start_self.ru_utime + start_self.ru_stime))),
+            ('subprocess_time',
+             ((end_children.ru_utime + end_children.ru_stime)
+              - (start_children.ru_utime + start_children.ru_stime))),
+            ('peak_rss_gb', (max(end_self.ru_maxrss, end_children.ru_maxrss)
+                             * MAXRSS_UNIT / 1024 ** 3)),
+            ('read_bytes', IO_BLOCK_SIZE * (
+                (end_self.ru_inblock + end_children.ru_inblock)
+                - (start_self.ru_inblock + start_children.ru_inblock))),
+            ('write_bytes', IO_BLOCK_SIZE * (
+                (end_self.ru_oublock + end_children.ru_oublock)
+                - (start_self.ru_oublock + start_children.ru_oublock))),
+            ('n_procs', self.n_procs),
+            ('status', status)])
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        # Append with a single write so that records from concurrent
+        # processes aren't interleaved
+        fd = os.open(self.environment.profile_path,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+class ProfiledMapNodeMixin():
+    """
+    The sub-nodes of map nodes are profiled individually (rather than the
+    map node as a whole) under the name of the map node
+    """
+
+    def _make_nodes(self, cwd=None):
+        for i, node in super()._make_nodes(cwd=cwd):
+            node._profile_pipeline = (self._hierarchy or '').split('.')[-1]
+            node._profile_node = self.name
+            yield i, node
+
+
+class ProfiledNode(ProfiledNodeMixin, Node):
+    pass
+
+
+class ProfiledJoinNode(ProfiledNodeMixin, JoinNode):
+    pass
+
+
+class ProfiledMapNode(ProfiledMapNodeMixin, MapNode):
+
+    node_cls = ProfiledNode
+
+
+class ProfiledModulesNode(ProfiledNodeMixin, ModulesNode):
+    pass
+
+
+class ProfiledModulesJoinNode(ProfiledNodeMixin, ModulesJoinNode):
+    pass
+
+
+class ProfiledModulesMapNode(ProfiledMapNodeMixin, ModulesMapNode):
+
+    node_cls = ProfiledModulesNode
+
+
+class ProfiledEnvMixin():
+    """
+    Creates nodes that record the resources they use in a profile
+
+    Parameters
+    ----------
+    profile_path : str
+        Path to the JSON-lines file the records are appended to
+    """
+
+    def __init__(self, profile_path, *args, **kwargs):
+        self.profile_path = os.path.abspath(profile_path)
+        super().__init__(*args, **kwargs)
+
+
+class ProfiledStaticEnv(ProfiledEnvMixin, StaticEnv):
+
+    node_types = {'base': ProfiledNode, 'map': ProfiledMapNode,
+                  'join': ProfiledJoinNode}
+
+
+class ProfiledModulesEnv(ProfiledEnvMixin, ModulesEnv):
+
+    node_types = {'base': ProfiledModulesNode, 'map': ProfiledModulesMapNode,
+                  'join': ProfiledModulesJoinNode}
+
+
+def read_profile(path):
+    """
+    Reads the records of a profile, skipping truncated lines
+
+    Parameters
+    ----------
+    path : str
+        Path to the profile
+
+    Returns
+    -------
+    records : list[dict]
+        The record of each node run
+    """
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return records
+
+
+def summarise_profile(records):
+    """
+    Summarises the resources used by each pipeline in a profile
+
+    Parameters
+    ----------
+    records : list[dict]
+        The records of the profile
+
+    Returns
+    -------
+    summary : OrderedDict[str, dict]
+        The number of nodes run, total wall, CPU and subprocess time, peak
+        memory, bytes read and written and CPU utilisation of each pipeline
+        in the order they were first run
+    """
+    summary = OrderedDict()
+    for record in sorted(records, key=lambda r: r['start']):
+        pipeline = summary.setdefault(record['pipeline'], OrderedDict([
+            ('nodes', 0), ('failed', 0), ('wall_time', 0.0),
+            ('cpu_time', 0.0), ('subprocess_time', 0.0),
+            ('peak_rss_gb', 0.0), ('read_bytes', 0), ('write_bytes', 0),
+            ('cpu_bound', 0)]))
+        pipeline['nodes'] += 1
+        pipeline['failed'] += record['status'] != 'ok'
+        for key in ('wall_time', 'cpu_time', 'subprocess_time',
+                    'read_bytes', 'write_bytes'):
+            pipeline[key] += record[key]
+        pipeline['peak_rss_gb'] = max(pipeline['peak_rss_gb'],
+                                      record['peak_rss_gb'])
+        pipeline['cpu_bound'] += (cpu_utilisation(record)
+                                  >= CPU_BOUND_THRESHOLD)
+    for pipeline in summary.values():
+        pipeline['cpu_utilisation'] = cpu_utilisation(pipeline)
+    return summary
+
+
+def cpu_utilisation(record):
+    """
+    The CPU time of a node (or pipeline) and its subprocesses as a fraction
+    of its wall time (and allocated processors)
+    """
+    if not record['wall_time']:
+        return 0.0
+    return ((record['cpu_time'] + record['subprocess_time'])
+            / (record['wall_time'] * (record.get('n_procs') or 1)))
+
+
+def format_profile_summary(summary):
+    """
+    Formats a profile summary as a table for display
+    """
+    name_width = max([len(p) for p in summary] + [len('Pipeline')])
+    row = ('{:<' + str(name_width) + '}  {:>6}  {:>10}  {:>10}  {:>6}  '
+           '{:>9}  {:>9}  {:>9}')
+    lines = [row.format('Pipeline', 'Nodes', 'Wall (s)', 'CPU (s)', 'CPU %',
+                        'Mem (GB)', 'Read (MB)', 'Write (MB)')]
+    for name, pipeline in summary.items():
+        lines.append(row.format(
+            name, pipeline['nodes'],
+            '{:.1f}'.format(pipeline['wall_time']),
+            '{:.1f}'.format(pipeline['cpu_time']
+                            + pipeline['subprocess_time']),
+            '{:.0f}'.format(100 * pipeline['cpu_utilisation']),
+            '{:.2f}'.format(pipeline['peak_rss_gb']),
+            '{:.1f}'.format(pipeline['read_bytes'] / 1e6),
+            '{:.1f}'.format(pipeline['write_bytes'] / 1e6)))
+    return '\n'.join(lines)
+
+
+def history_records(records, source):
+    """
+    Converts the records of a profile into records for the run history that
+    is used to estimate the resources required by future runs
+
+    Parameters
+    ----------
+    records : list[dict]
+        The records of the profile
+    source : str
+        The path of the profile (used to identify the records)
+
+    Returns
+    -------
+    history_records : list[NodeRecord]
+        The records of the successfully run nodes
+    """
+    return [
+        NodeRecord(
+            pipeline=r['pipeline'], node=r['node'], interface=r['interface'],
+            duration=r['wall_time'], mem_peak_gb=r['peak_rss_gb'],
+            cpu_percent=100 * cpu_utilisation(r) * (r['n_procs'] or 1),
+            n_procs=r['n_procs'],
+            source='{}#{}:{}:{}'.format(source, r['host'], r['pid'],
+                                        r['start']))
+        for r in records if r['status'] == 'ok']
@@ -283,6 +283,13 @@ class PipelineTester(TestCase):
             for ref, test in zip(self.ref_analysis.derive(spec_name),
                                  output_analysis.derive(spec_name)):
                 if ref.is_fileset:
+                    if (spec_name not in test_criteria
+                            and test.format == ref.format
+                            and hasattr(ref, 'fingerprint')
+                            and test.fingerprint() == ref.fingerprint()):
+                        # The reference fingerprint is cached alongside the
+                        # reference data so only the test output is read
+                        continue
                     try:
                         self.assertTrue(
                             test.contents_equal(
@@ -301,8 +308,8 @@ class PipelineTester(TestCase):
                                 print("Reference header:\n{}".format(
                                     pformat(ref.get_header())))
                             else:
-                                print("Image RMS diff: {}"
-                                      .format(test.rms_diff(ref)))
+                                print("Image diff: {}"
+                                      .format(test.image_diff(ref)))
                                 test.contents_equal(ref)
                         raise
                 else:
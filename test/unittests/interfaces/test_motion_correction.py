@@ -0,0 +1,55 @@
+import os
+import os.path as op
+import tempfile
+from unittest import TestCase
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from banana.interfaces.motion_correction import CreateMocoSeries
+
+
+class TestCreateMocoSeries(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SeriesInstanceUID = generate_uid()
+        ds.AcquisitionTime = '000000.000000'
+        ds.add_new((0x19, 0x1025), 'FD', [0.0, 0.0, 0.0])
+        ds.add_new((0x19, 0x1026), 'FD', [0.0, 0.0, 0.0])
+        self.template = op.join(self.tmp_dir, 'template.IMA')
+        pydicom.dcmwrite(self.template, ds, enforce_file_format=True)
+        self.motion_par = op.join(self.tmp_dir, 'motion_par.txt')
+        np.savetxt(self.motion_par, [[0.0, 0.0, 0.0, 1.0, 2.0, 3.0],
+                                     [np.pi, 0.0, 0.0, 0.0, 0.0, 0.0]])
+        self.start_times = op.join(self.tmp_dir, 'start_times.txt')
+        with open(self.start_times, 'w') as f:
+            f.write('101010.000000\n101510.000000\n102010.000000\n')
+
+    def test_create(self):
+        out_dir = op.join(self.tmp_dir, 'moco')
+        result = CreateMocoSeries(
+            moco_template=self.template, motion_par=self.motion_par,
+            start_times=self.start_times, out_dir=out_dir,
+            num_threads=2).run()
+        self.assertEqual(result.outputs.modified_moco, out_dir)
+        self.assertEqual(sorted(os.listdir(out_dir)),
+                         ['000000.IMA', '000001.IMA'])
+        first, second = [pydicom.dcmread(op.join(out_dir, f))
+                         for f in sorted(os.listdir(out_dir))]
+        self.assertEqual(list(first[0x19, 0x1025].value), [-2.0, 1.0, -3.0])
+        self.assertEqual(list(second[0x19, 0x1026].value), [0.0, 180.0, 0.0])
+        self.assertEqual(second.AcquisitionTime, '101510.000000')
+        self.assertEqual(second.InstanceNumber, 2)
+        self.assertEqual(first.SeriesInstanceUID, second.SeriesInstanceUID)
+        self.assertEqual(first.SeriesDescription, 'MoCoSeries')
+        # The template isn't modified
+        self.assertEqual(
+            list(pydicom.dcmread(self.template)[0x19, 0x1025].value),
+            [0.0, 0.0, 0.0])
@@ -0,0 +1,141 @@
+import os
+import os.path as op
+import json
+import tempfile
+from unittest import TestCase
+from banana.utils.bids_index import BidsIndex, parse_bids_path
+from banana.bids_ import BidsDataset
+from banana.file_format import nifti_gz_x_format
+
+
+def write_bids_tree(root_dir, subject_ids=('01', '02'), session_ids=('a',)):
+    with open(op.join(root_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'test', 'BIDSVersion': '1.4.0'}, f)
+    with open(op.join(root_dir, 'task-rest_bold.json'), 'w') as f:
+        json.dump({'RepetitionTime': 2.0, 'TaskName': 'rest'}, f)
+    for subj_id in subject_ids:
+        for sess_id in session_ids:
+            prefix = 'sub-{}_ses-{}'.format(subj_id, sess_id)
+            sess_dir = op.join(root_dir, 'sub-' + subj_id, 'ses-' + sess_id)
+            for datatype, suffix in (('anat', 'T1w'), ('func', 'bold')):
+                os.makedirs(op.join(sess_dir, datatype), exist_ok=True)
+                stem = prefix + ('_task-rest_' if datatype == 'func' else '_')
+                with open(op.join(sess_dir, datatype,
+                                  stem + suffix + '.nii.gz'), 'wb') as f:
+                    f.write(b'\0' * 8)
+            with open(op.join(sess_dir, 'func',
+                              prefix + '_task-rest_bold.json'), 'w') as f:
+                json.dump({'RepetitionTime': 2.5}, f)
+    os.makedirs(op.join(root_dir, 'derivatives', 'pipeline'), exist_ok=True)
+    open(op.join(root_dir, 'derivatives', 'pipeline', 'out.nii.gz'),
+         'w').close()
+
+
+class TestBidsIndex(TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        write_bids_tree(self.root_dir)
+        self.db_path = op.join(self.root_dir, 'derivatives', '__metadata__',
+                               'bids_index.sqlite')
+
+    def test_parse(self):
+        entities = parse_bids_path(
+            'sub-01/ses-a/func/sub-01_ses-a_task-rest_run-1_bold.nii.gz')
+        self.assertEqual(entities['subject'], '01')
+        self.assertEqual(entities['session'], 'a')
+        self.assertEqual(entities['task'], 'rest')
+        self.assertEqual(entities['run'], '1')
+        self.assertEqual(entities['suffix'], 'bold')
+        self.assertEqual(entities['extension'], '.nii.gz')
+        self.assertEqual(entities['datatype'], 'func')
+
+    def test_index(self):
+        index = BidsIndex(self.root_dir, self.db_path)
+        index.refresh()
+        self.assertEqual(index.subject_ids(), {'01', '02'})
+        self.assertEqual(index.session_ids(), {'a'})
+        paths = [op.relpath(p, self.root_dir) for p, _ in index.files()]
+        self.assertNotIn(op.join('derivatives', 'pipeline', 'out.nii.gz'),
+                         paths)
+        self.assertEqual(len(paths), 8)
+        # Top-level files are returned along with those of the subject
+        paths = [op.relpath(p, self.root_dir)
+                 for p, _ in index.files(subject_ids=['02'])]
+        self.assertEqual(len(paths), 5)
+        self.assertIn('task-rest_bold.json', paths)
+        self.assertFalse(any(p.startswith('sub-01') for p in paths))
+        # Side-cars are combined with the closest taking precedence
+        bold_path = op.join(self.root_dir, 'sub-01', 'ses-a', 'func',
+                            'sub-01_ses-a_task-rest_bold.nii.gz')
+        self.assertEqual(index.metadata(bold_path),
+                         {'RepetitionTime': 2.5, 'TaskName': 'rest'})
+        index.close()
+
+    def test_incremental(self):
+        index = BidsIndex(self.root_dir, self.db_path)
+        index.refresh()
+        index.close()
+        write_bids_tree(self.root_dir, subject_ids=('03',))
+        sidecar = op.join(self.root_dir, 'task-rest_bold.json')
+        with open(sidecar, 'w') as f:
+            json.dump({'RepetitionTime': 3.0, 'TaskName': 'rest2'}, f)
+        os.remove(op.join(self.root_dir, 'sub-01', 'ses-a', 'anat',
+                          'sub-01_ses-a_T1w.nii.gz'))
+        # A fresh index reloads the persisted state and only rescans the
+        # directories that have changed
+        index = BidsIndex(self.root_dir, self.db_path)
+        index.refresh()
+        self.assertEqual(index.subject_ids(), {'01', '02', '03'})
+        paths = [op.relpath(p, self.root_dir)
+                 for p, _ in index.files(subject_ids=['01'])]
+        self.assertEqual(len(paths), 4)
+        self.assertEqual(
+            index.metadata(op.join(self.root_dir, 'sub-02', 'ses-a', 'func',
+                                   'sub-02_ses-a_task-rest_bold.nii.gz')),
+            {'RepetitionTime': 2.5, 'TaskName': 'rest2'})
+        index.close()
+
+    def test_subject_scan(self):
+        index = BidsIndex(self.root_dir, self.db_path)
+        index.refresh(num_threads=2)
+        write_bids_tree(self.root_dir, subject_ids=('03',))
+        os.remove(op.join(self.root_dir, 'sub-01', 'ses-a', 'anat',
+                          'sub-01_ses-a_T1w.nii.gz'))
+        # Only the directories of the requested subjects are rescanned
+        index.refresh(subject_ids=['03'], num_threads=2)
+        self.assertEqual(index.subject_ids(), {'01', '02', '03'})
+        self.assertEqual(len(index.files(subject_ids=['01'])), 5)
+        index.refresh(num_threads=2)
+        self.assertEqual(len(index.files(subject_ids=['01'])), 4)
+        index.close()
+
+    def test_filtered_then_full_scan(self):
+        index = BidsIndex(self.root_dir, self.db_path)
+        index.refresh(subject_ids=['01'])
+        self.assertEqual(index.subject_ids(), {'01'})
+        # The subjects skipped by the filtered refresh are indexed by a full
+        # one even though the root directory hasn't changed since
+        index.refresh()
+        self.assertEqual(index.subject_ids(), {'01', '02'})
+        index.close()
+
+
+class TestBidsRepoSidecars(TestCase):
+
+    def test_lazy_sidecars(self):
+        root_dir = tempfile.mkdtemp()
+        write_bids_tree(root_dir)
+        dataset = BidsDataset(root_dir)
+        filesets, _, _ = dataset.repository.find_data(dataset)
+        bold = [f for f in filesets
+                if f.type == 'bold' and f.format == nifti_gz_x_format]
+        self.assertEqual(len(bold), 2)
+        # Both subjects share the same content-addressed side-car, which
+        # isn't written until it is accessed
+        json_path = bold[0]._aux_files['json']
+        self.assertEqual(bold[1]._aux_files['json'], json_path)
+        self.assertFalse(op.exists(json_path))
+        with open(bold[0].aux_file('json')) as f:
+            self.assertEqual(json.load(f),
+                             {'RepetitionTime': 2.5, 'TaskName': 'rest'})
@@ -0,0 +1,84 @@
+import os
+import os.path as op
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, patch
+import numpy as np
+import nibabel
+from banana.interfaces.converters import NativeImageConvert, CachedConversion
+from banana.utils.cache import ConversionCache
+
+
+class TestConversionCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_path = op.join(self.tmp_dir, 'input.txt')
+        with open(self.in_path, 'w') as f:
+            f.write('input')
+
+    def _convert(self, name, size=10):
+        out_path = op.join(self.tmp_dir, name)
+        with open(out_path, 'w') as f:
+            f.write('x' * size)
+        return {'out_file': out_path}
+
+    def test_store_and_fetch(self):
+        cache = ConversionCache(op.join(self.tmp_dir, 'cache'))
+        key = cache.key(self.in_path, 'a.Converter', '1', {'opt': 1})
+        self.assertNotEqual(
+            key, cache.key(self.in_path, 'a.Converter', '1', {'opt': 2}))
+        self.assertIsNone(cache.fetch(key, self.tmp_dir))
+        cache.store(key, self._convert('converted.txt'))
+        dest_dir = op.join(self.tmp_dir, 'dest')
+        os.mkdir(dest_dir)
+        outputs = cache.fetch(key, dest_dir)
+        self.assertEqual(outputs,
+                         {'out_file': op.join(dest_dir, 'converted.txt')})
+        with open(outputs['out_file']) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+
+    def test_eviction(self):
+        # Room for two entries (including their info files) but not three
+        cache = ConversionCache(op.join(self.tmp_dir, 'cache'),
+                                max_size=250e-9)
+        keys = []
+        for i in range(3):
+            keys.append(cache.key(self.in_path, 'a.Converter', '1',
+                                  {'index': i}))
+            cache.store(keys[-1], self._convert('out{}.txt'.format(i),
+                                                size=100))
+            # Ensure modification times are distinguishable
+            os.utime(op.join(cache.cache_dir, keys[-1]), (i, i))
+        self.assertIsNone(cache.fetch(keys[0], self.tmp_dir))
+        self.assertIsNotNone(cache.fetch(keys[1], self.tmp_dir))
+        self.assertIsNotNone(cache.fetch(keys[2], self.tmp_dir))
+
+
+class TestCachedConversion(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_path = op.join(self.tmp_dir, 'in.nii')
+        nibabel.save(nibabel.Nifti1Image(np.zeros((4, 4, 4), dtype='i2'),
+                                         np.eye(4)), self.in_path)
+        self.cache = ConversionCache(op.join(self.tmp_dir, 'cache'))
+
+    def test_detected_versions(self):
+        req_range = Mock()
+        req_range.name = 'tool'
+        req_range.requirement.detect_version.return_value = '1.0.1'
+        interface = NativeImageConvert(out_ext='.nii.gz')
+        conversion = CachedConversion(
+            interface, self.cache, in_field='in_file',
+            converter_name='a.Converter', version='1',
+            requirements=[req_range])
+        conversion.inputs.in_file = self.in_path
+        with patch.object(interface, 'run', wraps=interface.run) as run:
+            for i, version in enumerate(('1.0.1', '1.0.1', '1.0.2')):
+                req_range.requirement.detect_version.return_value = version
+                cwd = op.join(self.tmp_dir, str(i))
+                os.mkdir(cwd)
+                conversion.run(cwd=cwd)
+            # The conversion is rerun once the tool has been updated in place
+            self.assertEqual(run.call_count, 2)
@@ -1,7 +1,16 @@
+import os
+import os.path as op
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+import numpy as np
+import nibabel
 from arcana.data import InputFilesetSpec, FilesetSpec, FilesetFilter
 from banana.file_format import (
     dicom_format, nifti_format, text_format, directory_format,
-    zip_format)
+    zip_format, nifti_gz_format, mrtrix_image_format, analyze_format)
+from banana.interfaces.converters import NativeImageConvert
+from banana.utils.image import convert_image, COMPRESSION_LEVEL_ENV
 from arcana.analysis.base import Analysis, AnalysisMetaClass
 from arcana.utils.testing import BaseTestCase
 from nipype.interfaces.utility import IdentityInterface
@@ -93,3 +102,56 @@ class TestFormatConversions(BaseTestCase):
             next(iter(analysis.data('directory_from_zip', derive=True))))
         self.assertFilesetCreated(
             next(iter(analysis.data('zip_from_directory', derive=True))))
+
+
+class TestNativeImageConverter(TestCase):
+
+    def test_converter_selected(self):
+        converter = nifti_gz_format.converter_from(mrtrix_image_format,
+                                                   compression_level=1)
+        self.assertIsInstance(converter.interface, NativeImageConvert)
+        self.assertEqual(converter.interface.inputs.compression_level, 1)
+
+    def test_compression_level_env(self):
+        tmp_dir = tempfile.mkdtemp()
+        in_path = op.join(tmp_dir, 'in.nii')
+        nibabel.save(nibabel.Nifti1Image(np.zeros((20, 20, 20), dtype='i2'),
+                                         np.eye(4)), in_path)
+        converter = nifti_gz_format.converter_from(nifti_format)
+        sizes = []
+        for level in ('0', '9'):
+            out_path = op.join(tmp_dir, 'out{}.nii.gz'.format(level))
+            with patch.dict(os.environ, {COMPRESSION_LEVEL_ENV: level}):
+                converter.interface.run(in_file=in_path, out_file=out_path)
+            sizes.append(op.getsize(out_path))
+        # Level 0 stores the data uncompressed
+        self.assertGreater(sizes[0], 20 * 20 * 20 * 2)
+        self.assertLess(sizes[1], sizes[0])
+        # Level 0 can also be set explicitly
+        interface = nifti_gz_format.converter_from(
+            nifti_format, compression_level=0).interface
+        self.assertEqual(interface.inputs.compression_level, 0)
+
+    def test_round_trip(self):
+        tmp_dir = tempfile.mkdtemp()
+        affine = np.array([[-2.0, 0.0, 0.0, 10.0],
+                           [0.0, 2.0, 0.0, -5.0],
+                           [0.0, 0.0, 2.5, 3.0],
+                           [0.0, 0.0, 0.0, 1.0]])
+        array = np.arange(5 * 6 * 7 * 2, dtype='i2').reshape(5, 6, 7, 2)
+        image = nibabel.Nifti1Image(array, affine)
+        image.header.set_slope_inter(0.5, 3.0)
+        in_path = op.join(tmp_dir, 'in.nii')
+        nibabel.save(image, in_path)
+        expected = np.asanyarray(nibabel.load(in_path).dataobj)
+        path = in_path
+        for file_format in (nifti_gz_format, mrtrix_image_format,
+                            analyze_format, nifti_format):
+            out_path = op.join(tmp_dir, file_format.name + file_format.ext)
+            convert_image(path, out_path)
+            path = out_path
+        converted = nibabel.load(path)
+        self.assertEqual(converted.get_data_dtype(), np.dtype('i2'))
+        self.assertTrue(np.allclose(converted.affine, affine))
+        self.assertTrue(np.array_equal(np.asanyarray(converted.dataobj),
+                                       expected))
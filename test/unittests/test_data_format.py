@@ -1,13 +1,18 @@
+import os.path as op
+import tempfile
 from unittest import TestCase
+import numpy as np
+import nibabel
 from nipype.interfaces.utility import IdentityInterface
 from arcana.utils.testing import BaseTestCase
 from banana.interfaces.mrtrix import MRConvert
 from arcana.exceptions import ArcanaModulesNotInstalledException
 from banana.file_format import (dicom_format, mrtrix_image_format,
-                                nifti_gz_format)
+                                nifti_gz_format, nifti_format)
 from banana.utils.testing import TEST_ENV
 from arcana.analysis.base import Analysis, AnalysisMetaClass
-from arcana.data import FilesetFilter, FilesetSpec, InputFilesetSpec
+from arcana.data import (
+    FilesetFilter, FilesetSpec, InputFilesetSpec, Fileset)
 
 
 class DummyAnalysis(Analysis, metaclass=AnalysisMetaClass):
@@ -39,6 +44,86 @@ class TestConverterAvailability(TestCase):
         self.assertIsInstance(converter.interface, MRConvert)
 
 
+class TestNiftiLazyArray(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.array = np.arange(5 * 6 * 7 * 3, dtype='f4').reshape(5, 6, 7, 3)
+
+    def _fileset(self, name, file_format, array):
+        path = op.join(self.tmp_dir, name + file_format.extension)
+        nibabel.save(nibabel.Nifti1Image(array, np.eye(4)), path)
+        return Fileset(name, file_format, path=path)
+
+    def test_lazy_array(self):
+        for file_format in (nifti_format, nifti_gz_format):
+            fileset = self._fileset('lazy', file_format, self.array)
+            proxy = fileset.get_array(lazy=True)
+            self.assertNotIsInstance(proxy, np.ndarray)
+            self.assertEqual(proxy.shape, self.array.shape)
+            self.assertTrue(np.array_equal(proxy[:, :, :, 1],
+                                           self.array[:, :, :, 1]))
+            self.assertTrue(np.array_equal(fileset.get_array(), self.array))
+
+    def test_slab_comparison(self):
+        fileset = self._fileset('a', nifti_gz_format, self.array)
+        same = self._fileset('b', nifti_gz_format, self.array.copy())
+        modified = self.array.copy()
+        modified[0, 0, 0, 2] += 3.0
+        other = self._fileset('c', nifti_gz_format, modified)
+        self.assertTrue(fileset.contents_equal(same))
+        self.assertFalse(fileset.contents_equal(other))
+        self.assertAlmostEqual(fileset.rms_diff(other),
+                               3.0 / np.sqrt(self.array.size))
+        diff = fileset.image_diff(other)
+        self.assertEqual(diff.max_abs, 3.0)
+        self.assertEqual(diff.num_voxels, self.array.size)
+
+    def test_fingerprint(self):
+        fileset = self._fileset('a', nifti_gz_format, self.array)
+        same = self._fileset('b', nifti_gz_format, self.array.copy())
+        self.assertIsNone(fileset.cached_fingerprint())
+        fingerprint = fileset.fingerprint()
+        self.assertEqual(fileset.cached_fingerprint(), fingerprint)
+        self.assertTrue(op.exists(op.join(self.tmp_dir,
+                                          '.a.nii.gz.fingerprint.json')))
+        self.assertEqual(same.fingerprint(), fingerprint)
+        self.assertTrue(fileset.contents_equal(same))
+        # Cached fingerprints are invalidated when the image changes
+        modified = self.array.copy()
+        modified[1, 2, 3, 0] = -1.0
+        self._fileset('a', nifti_gz_format, modified)
+        self.assertIsNone(fileset.cached_fingerprint())
+        self.assertNotEqual(fileset.fingerprint(), fingerprint)
+
+
+class TestMrtrixImageReader(TestCase):
+
+    def test_strided_scaled_array(self):
+        array = np.arange(4 * 5 * 6, dtype='>i2').reshape(4, 5, 6)
+        # Axis 0 is stored second-fastest and reversed, axis 1 fastest and
+        # axis 2 slowest
+        stored = np.ascontiguousarray(array[::-1].transpose(2, 0, 1))
+        hdr = ("mrtrix image\ndim: 4,5,6\nvox: 1.5,1.5,2\n"
+               "layout: -1,+0,+2\ndatatype: Int16BE\nscaling: 1,0.5\n"
+               "transform: 1,0,0,0\ntransform: 0,1,0,0\n"
+               "transform: 0,0,1,0\n")
+        offset = len(hdr) + len('file: . 0000\nEND\n')
+        hdr += 'file: . {:04d}\nEND\n'.format(offset)
+        path = op.join(tempfile.mkdtemp(), 'strided.mif')
+        with open(path, 'wb') as f:
+            f.write(hdr.encode('utf-8'))
+            f.write(stored.tobytes())
+        fileset = Fileset('strided', mrtrix_image_format, path=path)
+        self.assertEqual(list(fileset.get_dims()), [4, 5, 6])
+        self.assertEqual(list(fileset.get_vox_sizes()), [1.5, 1.5, 2.0])
+        self.assertEqual(fileset.get_header()['transform'].shape, (3, 4))
+        expected = 1.0 + 0.5 * array
+        self.assertTrue(np.array_equal(fileset.get_array(), expected))
+        self.assertTrue(np.array_equal(
+            fileset.get_array(lazy=True)[:, 2, :], expected[:, 2, :]))
+
+
 class TestDicom2Niix(BaseTestCase):
 
     def test_dcm2niix(self):
@@ -0,0 +1,264 @@
+import os
+import os.path as op
+import struct
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from arcana.data import Fileset
+from banana.file_format import dicom_format
+from banana.interfaces.dicom import DicomHeaderInfoExtraction
+from banana.interfaces.bold import FieldMapTimeInfo
+from banana.interfaces.converters import Nii2Dicom
+from banana.utils.dicom import (
+    DicomSeriesIndex, DICOM_INDEX_CACHE_ENV, parse_ascconv, siemens_protocol,
+    scan_series, distinct)
+
+
+PROTOCOL = """### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData ###
+ulVersion                                = 0x14b44b6
+tSequenceFileName                        = ""%SiemensSeq%\\ep2d_diff""
+alTR[0]                                  = 8800000
+sDiffusion.lDiffDirections               = 64
+sSliceArray.asSlice[0].dInPlaneRot       = 3.14159265  # comment
+lTotalScanTimeSec                        = 600
+### ASCCONV END ###"""
+
+
+def csa2_header(tags):
+    """
+    Packs a dictionary of string-valued tags into a CSA2 header
+    """
+    csa = b'SV10\x04\x03\x02\x01' + struct.pack('<2I', len(tags), 77)
+    for name, value in tags.items():
+        value = value.encode('utf-8') + b'\x00'
+        csa += struct.pack('<64si4s3i', name.encode('utf-8'), 1, b'ST',
+                           0, 1, 77)
+        csa += struct.pack('<4i', len(value), len(value), 77, len(value))
+        csa += value + b'\x00' * (-len(value) % 4)
+    return csa
+
+
+def write_dicom_series(series_dir, num_slices=4, rows=3, columns=5,
+                       series_number=7, echo_times=(4.5,), protocol=None):
+    os.makedirs(series_dir, exist_ok=True)
+    series_uid = generate_uid()
+    for i in range(num_slices * len(echo_times)):
+        echo, slice_ind = divmod(i, num_slices)
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = series_number
+        ds.Modality = 'MR'
+        ds.InstanceNumber = i + 1
+        ds.AcquisitionTime = '101010.{:06}'.format(i)
+        ds.EchoTime = echo_times[echo]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.ImagePositionPatient = [0.0, 0.0, 2.0 * slice_ind]
+        ds.PixelSpacing = [1.25, 1.5]
+        ds.SliceThickness = 2.0
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.PixelData = np.full((rows, columns), i,
+                               dtype='<u2').tobytes()
+        if protocol is not None:
+            block = ds.private_block(0x0029, 'SIEMENS CSA HEADER',
+                                     create=True)
+            block.add_new(0x20, 'OB',
+                          csa2_header({'MrPhoenixProtocol': protocol}))
+        # Name the files so that alphabetical order doesn't match the
+        # instance order
+        pydicom.dcmwrite(op.join(series_dir, '{}.dcm'.format(
+            num_slices * len(echo_times) - i)), ds, enforce_file_format=True)
+    return series_dir
+
+
+class TestDicomSeriesIndex(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.series_dir = write_dicom_series(op.join(self.tmp_dir, 'series'))
+        os.environ[DICOM_INDEX_CACHE_ENV] = op.join(self.tmp_dir, 'index')
+        DicomSeriesIndex._memo.clear()
+
+    def tearDown(self):
+        os.environ.pop(DICOM_INDEX_CACHE_ENV, None)
+
+    def test_index(self):
+        index = DicomSeriesIndex.load(self.series_dir)
+        self.assertEqual(index.files, ['4.dcm', '3.dcm', '2.dcm', '1.dcm'])
+        self.assertEqual(index.get('SeriesNumber'), 7)
+        self.assertEqual(index.get(('0018', '0081')), 4.5)
+        self.assertEqual(index.get('PixelSpacing'), [1.25, 1.5])
+        # Fields that vary between slices aren't shared
+        self.assertIsNone(index.get('InstanceNumber'))
+        self.assertEqual([p[2] for p in index.values('ImagePositionPatient')],
+                         [0.0, 2.0, 4.0, 6.0])
+        # The persisted index is reused by a fresh process
+        DicomSeriesIndex._memo.clear()
+        reloaded = DicomSeriesIndex.load(self.series_dir)
+        self.assertIsNot(reloaded, index)
+        self.assertEqual(reloaded.shared, index.shared)
+        # and invalidated when the files are rewritten in place, which
+        # doesn't change the modification time of the directory
+        mtime = os.stat(self.series_dir).st_mtime_ns
+        write_dicom_series(self.series_dir, rows=4)
+        self.assertEqual(os.stat(self.series_dir).st_mtime_ns, mtime)
+        self.assertEqual(DicomSeriesIndex.load(self.series_dir).get('Rows'),
+                         4)
+        # or files are removed
+        os.remove(op.join(self.series_dir, '1.dcm'))
+        self.assertEqual(len(DicomSeriesIndex.load(self.series_dir)), 3)
+
+    def test_dicom_format(self):
+        fileset = Fileset('series', dicom_format, path=self.series_dir)
+        self.assertEqual(list(fileset.get_dims()), [3, 5, 4])
+        self.assertEqual(list(fileset.get_vox_sizes()), [1.25, 1.5, 2.0])
+        self.assertEqual(dicom_format.extract_id(fileset), 7)
+        self.assertEqual(
+            fileset.dicom_values([('0020', '0011'), ('0020', '0013')]),
+            [7, 1])
+        self.assertEqual(fileset.get_header(2).InstanceNumber, 3)
+        self.assertEqual(fileset.get_array()[:, 0, 0].tolist(), [0, 1, 2, 3])
+
+    def test_multi_echo_array(self):
+        series_dir = write_dicom_series(op.join(self.tmp_dir, 'multi_echo'),
+                                        num_slices=3, echo_times=(9.0, 4.5))
+        fileset = Fileset('multi_echo', dicom_format, path=series_dir)
+        # Sorted by echo time and then slice position
+        self.assertEqual(fileset.get_array(num_threads=2)[:, 0, 0].tolist(),
+                         [3, 4, 5, 0, 1, 2])
+        array = fileset.get_array(split='echo')
+        self.assertEqual(array.shape, (2, 3, 3, 5))
+        self.assertEqual(array[:, :, 0, 0].tolist(), [[3, 4, 5], [0, 1, 2]])
+        self.assertEqual(fileset.get_array(split='volume').shape,
+                         (2, 3, 3, 5))
+
+    def test_scan_series(self):
+        series_dir = write_dicom_series(op.join(self.tmp_dir, 'multi_echo'),
+                                        num_slices=3, echo_times=(9.0, 4.5))
+        paths = [op.join(series_dir, f) for f in sorted(os.listdir(
+            series_dir))]
+        metadata = scan_series(paths, num_threads=2)
+        self.assertEqual(metadata.instance_numbers, [1, 2, 3, 4, 5, 6])
+        self.assertEqual([op.basename(p) for p in metadata.paths],
+                         ['6.dcm', '5.dcm', '4.dcm', '3.dcm', '2.dcm',
+                          '1.dcm'])
+        self.assertEqual(distinct(metadata.echo_times), [9.0, 4.5])
+        self.assertEqual(metadata.acquisition_times[1], '101010.000001')
+        result = FieldMapTimeInfo(fm_mag=series_dir).run()
+        self.assertEqual(result.outputs.delta_te, 4.5)
+
+
+class TestSiemensProtocol(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.series_dir = write_dicom_series(op.join(self.tmp_dir, 'dwi'),
+                                             protocol=PROTOCOL)
+
+    def test_parse(self):
+        protocol = parse_ascconv(PROTOCOL)
+        self.assertEqual(protocol['ulVersion'], 0x14b44b6)
+        self.assertEqual(protocol['tSequenceFileName'],
+                         '%SiemensSeq%\\ep2d_diff')
+        self.assertEqual(protocol['alTR[0]'], 8800000)
+        self.assertAlmostEqual(
+            protocol['sSliceArray.asSlice[0].dInPlaneRot'], 3.14159265)
+        self.assertNotIn('### ASCCONV BEGIN object', protocol)
+
+    def test_series_protocol(self):
+        path = op.join(self.series_dir, '1.dcm')
+        protocol = siemens_protocol(path)
+        self.assertEqual(protocol['sDiffusion.lDiffDirections'], 64)
+        # The protocol is cached for the series
+        self.assertIs(siemens_protocol(op.join(self.series_dir, '2.dcm')),
+                      protocol)
+        no_protocol_dir = write_dicom_series(op.join(self.tmp_dir, 'plain'))
+        self.assertEqual(
+            siemens_protocol(op.join(no_protocol_dir, '1.dcm')), {})
+
+    def test_shared_directory(self):
+        # Series exported into the same directory have their own protocols
+        other_dir = write_dicom_series(
+            op.join(self.tmp_dir, 'other'), num_slices=1,
+            protocol=PROTOCOL.replace('= 64', '= 30'))
+        other_path = op.join(self.series_dir, 'other.IMA')
+        os.rename(op.join(other_dir, '1.dcm'), other_path)
+        self.assertEqual(siemens_protocol(op.join(self.series_dir, '1.dcm'))[
+            'sDiffusion.lDiffDirections'], 64)
+        self.assertEqual(
+            siemens_protocol(other_path)['sDiffusion.lDiffDirections'], 30)
+
+    def test_header_info_extraction(self):
+        result = DicomHeaderInfoExtraction(
+            dicom_folder=self.series_dir, multivol=True).run()
+        self.assertAlmostEqual(result.outputs.tr, 0.0088)
+        self.assertEqual(result.outputs.total_duration, 600.0)
+        self.assertAlmostEqual(result.outputs.real_duration, 64 * 8.8)
+        self.assertEqual(result.outputs.ped, 'COL')
+        self.assertEqual(result.outputs.pe_angle, '-1')
+        self.assertEqual(result.outputs.echo_times, [0.0045])
+
+
+class TestNii2Dicom(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.series_dir = write_dicom_series(op.join(self.tmp_dir, 'umap'))
+        self.ref_files = [op.join(self.series_dir, '{}.dcm'.format(i))
+                          for i in range(4, 0, -1)]
+        # (columns, rows, slices)
+        self.data = np.arange(5 * 3 * 4, dtype='float32').reshape((5, 3, 4))
+        self.nii_path = op.join(self.tmp_dir, 'umap.nii.gz')
+        nib.save(nib.Nifti1Image(self.data, np.eye(4)), self.nii_path)
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+
+    def test_slices(self):
+        result = Nii2Dicom(in_file=self.nii_path,
+                           reference_dicom=self.ref_files,
+                           num_threads=2).run()
+        out_files = sorted(os.listdir(result.outputs.out_file))
+        self.assertEqual(len(out_files), 4)
+        for i, fname in enumerate(out_files):
+            dcm = pydicom.dcmread(op.join(result.outputs.out_file, fname))
+            self.assertEqual(dcm.InstanceNumber, i + 1)
+            self.assertEqual(dcm.pixel_array.tolist(),
+                             self.data[:, :, i].T.astype('uint16').tolist())
+
+    def test_multiframe(self):
+        result = Nii2Dicom(in_file=self.nii_path,
+                           reference_dicom=self.ref_files,
+                           multiframe=True).run()
+        out_files = os.listdir(result.outputs.out_file)
+        self.assertEqual(out_files, ['umap.dcm'])
+        dcm = pydicom.dcmread(op.join(result.outputs.out_file, out_files[0]))
+        self.assertEqual(dcm.NumberOfFrames, 4)
+        # Legacy Converted Enhanced MR Image Storage
+        self.assertEqual(dcm.SOPClassUID, '1.2.840.10008.5.1.4.1.1.4.4')
+        self.assertEqual(
+            [f.PlanePositionSequence[0].ImagePositionPatient[2]
+             for f in dcm.PerFrameFunctionalGroupsSequence],
+            [0.0, 2.0, 4.0, 6.0])
+        self.assertEqual(
+            dcm.pixel_array.tolist(),
+            self.data.transpose(2, 1, 0).astype('uint16').tolist())
@@ -0,0 +1,223 @@
+import sys
+import os.path as op
+import json
+import shlex
+import tempfile
+import subprocess as sp
+from unittest import TestCase
+from unittest.mock import patch
+from banana.entrypoint import DeriveCmd, DeriveBatchCmd, shard_subjects
+
+
+class TestEntrypointImport(TestCase):
+
+    # Maximum time (in seconds) allowed to import the command-line tool and
+    # print the help for a sub-command, which is generous compared to the
+    # typical ~0.05 s but an order of magnitude less than importing Arcana
+    IMPORT_TIME_BUDGET = 0.5
+
+    # Packages that shouldn't be imported unless a command requires them
+    HEAVY_PACKAGES = ('arcana', 'nipype', 'bids', 'numpy', 'nibabel',
+                      'pydicom', 'setuptools')
+
+    SCRIPT = """
+import sys, io, json, time
+from contextlib import redirect_stdout
+start = time.perf_counter()
+from banana.entrypoint import MainCmd
+with redirect_stdout(io.StringIO()):
+    MainCmd.run(['help', 'derive'])
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed,
+                  'modules': sorted(set(m.split('.')[0]
+                                        for m in sys.modules))}))
+"""
+
+    def test_import_time(self):
+        output = sp.check_output([sys.executable, '-c', self.SCRIPT])
+        result = json.loads(output.decode().strip().split('\n')[-1])
+        imported = [p for p in self.HEAVY_PACKAGES
+                    if p in result['modules']]
+        self.assertFalse(imported,
+                         "Heavy packages imported by 'banana help': {}"
+                         .format(imported))
+        self.assertLess(result['elapsed'], self.IMPORT_TIME_BUDGET)
+
+    def test_lazy_namespace(self):
+        output = sp.check_output([sys.executable, '-c', (
+            "import sys, banana; assert 'arcana' not in sys.modules; "
+            "from banana import Analysis, BidsDataset; "
+            "print(Analysis.__module__, BidsDataset.__module__)")])
+        self.assertEqual(output.decode().split(),
+                         ['banana.analysis.base', 'banana.bids_'])
+
+
+class TestDeriveBatchManifest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def write_manifest(self, manifest):
+        path = op.join(self.tmp_dir, 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+        return path
+
+    def test_load(self):
+        path = self.write_manifest({'analyses': [
+            {'class': 'mri.T1wAnalysis', 'name': 't1',
+             'derivatives': 'brain',
+             'parameters': {'bet_method': 'optibet'}},
+            {'class': 'mri.T2starAnalysis', 'name': 't2star',
+             'derivatives': ['swi', 'qsm']}]})
+        manifest = DeriveBatchCmd.load_manifest(path)
+        self.assertEqual([a['name'] for a in manifest], ['t1', 't2star'])
+        self.assertEqual(manifest[0]['derivatives'], ['brain'])
+
+    def test_invalid(self):
+        from banana.exceptions import BananaUsageError
+        for manifest in ({'analyses': []},
+                         {'analyses': [{'class': 'mri.T1wAnalysis',
+                                        'name': 't1'}]},
+                         {'analyses': [{'class': 'mri.T1wAnalysis',
+                                        'name': 't1', 'derivatives': ['a'],
+                                        'unknown': 1}]},
+                         [{'class': 'mri.T1wAnalysis', 'name': 't1',
+                           'derivatives': ['a']}] * 2):
+            with self.assertRaises(BananaUsageError):
+                DeriveBatchCmd.load_manifest(self.write_manifest(manifest))
+
+
+class FakeTree(object):
+
+    def __init__(self, subject_ids, derivatives):
+        self.subject_ids = subject_ids
+        self.derivatives = derivatives
+
+
+class FakeDataset(object):
+    """
+    Caches a snapshot of the derivatives on disk the first time its tree is
+    read, like Arcana datasets
+    """
+
+    def __init__(self, subject_ids):
+        self.subject_ids = subject_ids
+        self.on_disk = set()
+        self._tree = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = FakeTree(self.subject_ids, set(self.on_disk))
+        return self._tree
+
+    def clear_cache(self):
+        self._tree = None
+
+
+class FakeAnalysis(object):
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.rederived = None
+
+    def clear_caches(self):
+        self.dataset.clear_cache()
+
+    def derive(self, names):  # @UnusedVariable
+        # The subjects whose derivatives would need to be derived again
+        self.rederived = [s for s in self.dataset.subject_ids
+                          if s not in self.dataset.tree.derivatives]
+
+
+class TestDeriveShards(TestCase):
+
+    def test_shard_subjects(self):
+        subject_ids = ['{:02}'.format(i) for i in range(7)]
+        shards = shard_subjects(subject_ids, 3)
+        self.assertEqual([len(s) for s in shards], [3, 2, 2])
+        self.assertEqual(sum(shards, []), subject_ids)
+        self.assertEqual(shard_subjects(subject_ids[:2], 4),
+                         [['00'], ['01']])
+
+    def test_shard_argv(self):
+        parser = DeriveCmd.parser()
+        args = parser.parse_args([
+            '/data/bids', 'mri.T1wAnalysis', 't1', 'brain', 'seg',
+            '--parameter', 'bet_method', 'optibet', '--input', 't1w', '.*T1w',
+            '--reprocess', '--shards', '4', 'slurm', '--processor', 'slurm',
+            'account', 'partition'])
+        argv = DeriveCmd.shard_argv(args, 2, '/scratch/shards/t1',
+                                    processor=['multi', '2'])
+        self.assertEqual(argv[1:4], ['-m', 'banana.entrypoint', 'derive'])
+        shard_args = parser.parse_args(argv[4:])
+        self.assertEqual(shard_args.shard, 2)
+        self.assertIsNone(shard_args.shards)
+        self.assertEqual(shard_args.subject_ids,
+                         ['/scratch/shards/t1/shard-2.txt'])
+        self.assertEqual(shard_args.processor, ['multi', '2'])
+        for name in ('dataset_path', 'analysis_class', 'analysis_name',
+                     'derivatives', 'parameter', 'input', 'reprocess'):
+            self.assertEqual(getattr(shard_args, name), getattr(args, name))
+        # The reduction step runs over all subjects
+        reduce_args = parser.parse_args(DeriveCmd.shard_argv(
+            args, None, '/scratch/shards/t1', processor=['multi'])[4:])
+        self.assertIsNone(reduce_args.subject_ids)
+        self.assertIsNone(reduce_args.shard)
+
+    def test_reduction_sees_shard_outputs(self):
+        args = DeriveCmd.parser().parse_args([
+            '/data/bids', 'mri.T1wAnalysis', 't1', 'brain', '--shards', '2',
+            '--quiet'])
+        dataset = FakeDataset(['01', '02', '03'])
+        analysis = FakeAnalysis(dataset)
+
+        def run_shards(args, subject_ids):  # @UnusedVariable
+            # The workers write the derivatives of every subject
+            dataset.on_disk.update(subject_ids)
+            return False
+
+        with patch('banana.entrypoint.resolve_class'), \
+                patch.object(DeriveCmd, 'setup',
+                             return_value=(dataset, None, None, None)), \
+                patch.object(DeriveCmd, 'init_analysis',
+                             return_value=analysis), \
+                patch.object(DeriveCmd, 'run_shards',
+                             side_effect=run_shards):
+            DeriveCmd.run(args)
+        self.assertEqual(analysis.rederived, [])
+
+    def test_submit_shards(self):
+        from banana.utils.history import RunHistory, NodeRecord
+        tmp_dir = tempfile.mkdtemp()
+        history_path = op.join(tmp_dir, 'history.jsonl')
+        RunHistory(history_path).add([
+            NodeRecord('brain_extraction_pipeline', 'bet', 'BET', 60.0, 2.0,
+                       None, 1, 'a'),
+            NodeRecord('brain_extraction_pipeline', 'bias', 'N4', 60.0, None,
+                       None, 1, 'b')])
+        parser = DeriveCmd.parser()
+        args = parser.parse_args([
+            '/data/bids', 'mri.T1wAnalysis', 't1', 'brain', '--shards', '2',
+            'slurm', '--processor', 'slurm', 'account', '--shard_cpus', '2',
+            '--shard_wall_time', '90', '--history', history_path])
+        with patch('banana.entrypoint.sp.check_output',
+                   side_effect=[b'100\n', b'101\n']) as check_output:
+            DeriveCmd.submit_shards(args, 2, tmp_dir)
+        self.assertEqual(check_output.call_count, 2)
+        for fname in ('shards.sh', 'reduce.sh'):
+            with open(op.join(tmp_dir, fname)) as f:
+                lines = f.read().splitlines()
+            self.assertIn('#SBATCH --account=account', lines)
+            self.assertIn('#SBATCH --cpus-per-task=2', lines)
+            # 2 CPUs each running a node using up to 2.0 * 1.25 GB
+            self.assertIn('#SBATCH --mem=5000M', lines)
+            self.assertIn('#SBATCH --time=90', lines)
+            # Expand the array index as the shell would
+            job_args = parser.parse_args(shlex.split(
+                lines[-1].replace('${SLURM_ARRAY_TASK_ID}', '1'))[4:])
+            self.assertEqual(job_args.processor, ['multi', '2'])
+        # The memory can be set explicitly
+        args.shard_mem = 3.5
+        self.assertEqual(DeriveCmd.shard_resources(args), (2, 3.5))
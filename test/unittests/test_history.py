@@ -0,0 +1,43 @@
+import os.path as op
+import tempfile
+from unittest import TestCase
+from banana.utils.history import RunHistory, NodeRecord
+
+
+def make_record(node, duration, mem_peak_gb=None, source=None):
+    return NodeRecord(
+        pipeline='brain_extraction_pipeline', node=node, interface='BET',
+        duration=duration, mem_peak_gb=mem_peak_gb, cpu_percent=None,
+        n_procs=1, source=(source if source is not None
+                           else '{}-{}'.format(node, duration)))
+
+
+class TestRunHistory(TestCase):
+
+    def setUp(self):
+        self.path = op.join(tempfile.mkdtemp(), 'history', 'runs.jsonl')
+
+    def test_estimates(self):
+        history = RunHistory(self.path)
+        self.assertEqual(history.add([
+            make_record('bet', 60.0, 1.5), make_record('bet', 180.0, 2.5),
+            make_record('bias_correct', 30.0)]), 3)
+        # Records from the same source aren't added twice
+        self.assertEqual(history.add([make_record('bet', 60.0, 1.5)]), 0)
+        # Records are persisted between instances
+        history = RunHistory(self.path)
+        self.assertEqual(len(history.records), 3)
+        estimate = history.estimate('brain_extraction_pipeline', 'bet')
+        self.assertAlmostEqual(estimate.wall_time, 2.0)
+        self.assertEqual(estimate.mem_gb, 2.5)
+        self.assertEqual(estimate.num_records, 2)
+        self.assertIsNone(history.estimate('brain_extraction_pipeline',
+                                           'bias_correct').mem_gb)
+        self.assertIsNone(history.estimate('another_pipeline', 'bet'))
+
+    def test_truncated(self):
+        history = RunHistory(self.path)
+        history.add([make_record('bet', 60.0)])
+        with open(self.path, 'a') as f:
+            f.write('{"pipeline": "brain_extr')
+        self.assertEqual(len(RunHistory(self.path).records), 1)
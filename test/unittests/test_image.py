@@ -0,0 +1,62 @@
+import os.path as op
+import gzip
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel
+from banana.utils.image import ParallelGzipFile, save_image, minimal_dtype
+
+
+class TestParallelGzip(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def test_blocks(self):
+        data = np.random.RandomState(0).randint(
+            0, 16, size=100000).astype('u1').tobytes()
+        for level in (0, 1, 9):
+            path = op.join(self.tmp_dir, 'blocks{}.gz'.format(level))
+            with ParallelGzipFile(path, compression_level=level,
+                                  num_threads=3, block_size=1000) as f:
+                f.write(data[:1500])
+                f.write(data[1500:])
+            with gzip.open(path) as f:
+                self.assertEqual(f.read(), data)
+
+    def test_save_image(self):
+        array = np.arange(4 * 5 * 6 * 7, dtype='f4').reshape(4, 5, 6, 7)
+        path = op.join(self.tmp_dir, 'image.nii.gz')
+        save_image(nibabel.Nifti1Image(array, np.eye(4)), path,
+                   compression_level=1, num_threads=2)
+        self.assertTrue(np.array_equal(nibabel.load(path).get_fdata(), array))
+
+
+class TestPrecision(TestCase):
+
+    def test_minimal_dtype(self):
+        mask = np.zeros((4, 4), dtype=float)
+        mask[1:3, 1:3] = 1.0
+        self.assertEqual(minimal_dtype(mask, 'double'), np.float64)
+        self.assertEqual(minimal_dtype(mask, 'single'), np.uint8)
+        self.assertEqual(minimal_dtype(mask - 1000, 'scaled'), np.int16)
+        self.assertEqual(minimal_dtype(mask / 3, 'single'), np.float32)
+        self.assertEqual(minimal_dtype(mask / 3, 'scaled'), np.int16)
+
+    def test_double_keeps_header_dtype(self):
+        array = np.arange(1000, dtype=float).reshape(10, 10, 10)
+        header = nibabel.Nifti1Header()
+        header.set_data_dtype(np.int16)
+        path = op.join(tempfile.mkdtemp(), 'int16.nii.gz')
+        save_image(nibabel.Nifti1Image(array, np.eye(4), header), path,
+                   precision='double')
+        self.assertEqual(nibabel.load(path).get_data_dtype(), np.int16)
+
+    def test_scaled_image(self):
+        array = np.linspace(-10.0, 10.0, 1000).reshape(10, 10, 10)
+        path = op.join(tempfile.mkdtemp(), 'scaled.nii.gz')
+        save_image(nibabel.Nifti1Image(array, np.eye(4)), path,
+                   precision='scaled')
+        image = nibabel.load(path)
+        self.assertEqual(image.get_data_dtype(), np.int16)
+        self.assertTrue(np.allclose(image.get_fdata(), array, atol=1e-3))
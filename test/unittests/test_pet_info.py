@@ -0,0 +1,72 @@
+import os
+import os.path as op
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from banana.interfaces.dicom import PetTimeInfo
+from banana.utils import pet
+from banana.utils.dicom import DICOM_INDEX_CACHE_ENV
+
+
+INTERFILE = b"""!INTERFILE:=
+%study date (yyyy:mm:dd):=2019:01:01
+image duration (sec):=3600
+"""
+
+
+def write_list_mode(path, size, acquisition_time='101500.000000'):
+    with open(path + '.bf', 'wb') as f:
+        f.write(b'\0' * size)
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.3.12.2.1107.5.9.1'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.AcquisitionTime = acquisition_time
+    block = ds.private_block(0x0029, 'SIEMENS CSA HEADER', create=True)
+    block.add_new(0x10, 'OB', INTERFILE)
+    pydicom.dcmwrite(path + '.dcm', ds, enforce_file_format=True)
+
+
+class TestPetTimeInfo(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pet_dir = op.join(self.tmp_dir, 'pet')
+        os.makedirs(op.join(self.pet_dir, 'LM'))
+        write_list_mode(op.join(self.pet_dir, 'LM', 'main'), 1024)
+        # A smaller list-mode file in the top-level directory without a
+        # header
+        with open(op.join(self.pet_dir, 'calibration.bf'), 'wb') as f:
+            f.write(b'\0' * 16)
+        os.environ[DICOM_INDEX_CACHE_ENV] = op.join(self.tmp_dir, 'cache')
+        pet._header_memo.clear()
+
+    def tearDown(self):
+        os.environ.pop(DICOM_INDEX_CACHE_ENV, None)
+
+    def test_acquisitions(self):
+        acquisitions = pet.list_mode_acquisitions(self.pet_dir)
+        self.assertEqual([op.basename(a.path) for a in acquisitions],
+                         ['main.bf', 'calibration.bf'])
+        main, calibration = acquisitions
+        self.assertEqual(main.start_time, '101500.000000')
+        self.assertEqual(main.duration, 3600)
+        self.assertEqual(main.end_time, '111500.000000')
+        self.assertIsNone(calibration.header)
+        # The cached values are reused by other processes
+        pet._header_memo.clear()
+        with patch.object(pet, '_read_header') as read_header:
+            self.assertEqual(pet.list_mode_acquisitions(self.pet_dir)[0],
+                             main)
+            read_header.assert_not_called()
+
+    def test_interface(self):
+        result = PetTimeInfo(pet_data_dir=self.pet_dir).run()
+        self.assertEqual(result.outputs.pet_start_time, '101500.000000')
+        self.assertEqual(result.outputs.pet_end_time, '111500.000000')
+        self.assertEqual(result.outputs.pet_duration, 3600)
@@ -0,0 +1,104 @@
+import os
+import os.path as op
+import tempfile
+from unittest import TestCase
+from arcana import Dataset, StaticEnv, FilesetFilter
+from arcana.data import InputFilesetSpec, FilesetSpec
+from arcana.analysis.base import Analysis, AnalysisMetaClass
+from nipype.interfaces.utility import Function
+from banana.file_format import text_format
+from banana.processor import SlurmProc
+from banana.utils.history import RunHistory, NodeRecord
+from banana.utils.plan import plan_derivation, plan_summary
+
+
+def copy_file(in_file):
+    import os
+    import shutil
+    out_file = os.path.abspath(os.path.basename(in_file))
+    shutil.copyfile(in_file, out_file)
+    return out_file
+
+
+class PlanAnalysis(Analysis, metaclass=AnalysisMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('a', text_format),
+        FilesetSpec('b', text_format, 'b_pipeline'),
+        FilesetSpec('c', text_format, 'c_pipeline')]
+
+    def b_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            name='b_pipeline', desc="Copies 'a' to 'b'", citations=[],
+            name_maps=name_maps)
+        pipeline.add(
+            'copy',
+            Function(input_names=['in_file'], output_names=['out_file'],
+                     function=copy_file),
+            inputs={'in_file': ('a', text_format)},
+            outputs={'b': ('out_file', text_format)})
+        return pipeline
+
+    def c_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            name='c_pipeline', desc="Copies 'b' to 'c'", citations=[],
+            name_maps=name_maps)
+        pipeline.add(
+            'copy',
+            Function(input_names=['in_file'], output_names=['out_file'],
+                     function=copy_file),
+            inputs={'in_file': ('b', text_format)},
+            outputs={'c': ('out_file', text_format)},
+            wall_time=30, mem_gb=3)
+        return pipeline
+
+
+class TestPlanDerivation(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dataset_dir = op.join(self.tmp_dir, 'dataset')
+        for subj_id in ('01', '02'):
+            session_dir = op.join(self.dataset_dir, subj_id, 'visit')
+            os.makedirs(session_dir)
+            with open(op.join(session_dir, 'a.txt'), 'w') as f:
+                f.write(subj_id)
+        self.history = RunHistory(op.join(self.tmp_dir, 'history.jsonl'))
+        self.history.add([NodeRecord(
+            pipeline='b_pipeline', node='b_pipeline_copy',
+            interface='Function', duration=120.0, mem_peak_gb=2.5,
+            cpu_percent=None, n_procs=1, source='b-copy')])
+
+    def test_plan(self):
+        # Planning doesn't submit anything, even with a SLURM processor
+        analysis = PlanAnalysis(
+            'plan', dataset=Dataset(self.dataset_dir, depth=2),
+            processor=SlurmProc(op.join(self.tmp_dir, 'work'),
+                                email='user@example.com'),
+            environment=StaticEnv(),
+            inputs=[FilesetFilter('a', 'a', text_format)])
+        plan = plan_derivation(analysis, ['c'], history=self.history)
+        self.assertEqual([p.name for p in plan], ['b_pipeline', 'c_pipeline'])
+        for pipeline in plan:
+            self.assertEqual(pipeline.to_process, 2)
+            self.assertEqual(pipeline.num_sessions, 2)
+        # Arcana prefixes the names of the nodes with that of the pipeline
+        nodes = {(n.pipeline, n.iterables): n for p in plan for n in p.nodes
+                 if n.name.endswith('_copy')}
+        self.assertEqual(len(nodes), 4)
+        for (pipeline_name, _), node in nodes.items():
+            if pipeline_name == 'b_pipeline':
+                # Estimated from the recorded run
+                self.assertTrue(node.from_history)
+                self.assertAlmostEqual(node.wall_time, 2.0)
+                self.assertEqual(node.mem_gb, 2.5)
+            else:
+                # The values declared in the pipeline
+                self.assertFalse(node.from_history)
+                self.assertEqual(node.wall_time, 30)
+                self.assertEqual(node.mem_gb, 3)
+        cpu_hours, peak_mem_gb = plan_summary(
+            [p._replace(nodes=[n for n in p.nodes if n.name.endswith('_copy')])
+             for p in plan])
+        self.assertAlmostEqual(cpu_hours, (2 * 2.0 + 2 * 30) / 60.0)
+        self.assertEqual(peak_mem_gb, 3)
@@ -0,0 +1,24 @@
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, Mock
+from arcana.exceptions import ArcanaJobSubmittedException
+from arcana.processor.base import Processor
+from banana.processor import SlurmProc
+
+
+class TestSlurmProc(TestCase):
+
+    def test_run_several_pipelines(self):
+        processor = SlurmProc(tempfile.mkdtemp(), email='user@example.com')
+        pipelines = [Mock(), Mock()]
+        pipelines[0].name = 'brain_extraction_pipeline'
+        pipelines[1].name = 'segmentation_pipeline'
+        # The workflow is built and submitted by Arcana's Processor.run
+        with patch.object(Processor, 'run') as submit:
+            with self.assertRaises(ArcanaJobSubmittedException) as cm:
+                processor.run(*pipelines, required_outputs=[{'a'}, {'b'}],
+                              subject_ids=['01'])
+        submit.assert_called_once_with(
+            processor, *pipelines, required_outputs=[{'a'}, {'b'}],
+            subject_ids=['01'])
+        self.assertIn('segmentation_pipeline', str(cm.exception))
@@ -0,0 +1,89 @@
+import os
+import os.path as op
+import sys
+import tempfile
+from unittest import TestCase
+from banana.registry import AnalysisRegistry
+
+
+BASE_MODULE = """
+from arcana import ParamSpec
+from banana.analysis import Analysis, AnalysisMetaClass
+
+
+class BaseAnalysis(Analysis, metaclass=AnalysisMetaClass):
+
+    add_param_specs = [ParamSpec('threshold', 0.5)]
+
+
+class NotAnAnalysis(object):
+
+    desc = "Shouldn't be listed"
+"""
+
+DERIVED_MODULE = """
+from arcana import InputFilesetSpec, FilesetSpec
+from .base import BaseAnalysis
+
+
+class DerivedAnalysis(BaseAnalysis):
+
+    desc = ("An analysis that is "
+            "derived from another")
+
+    add_data_specs = [
+        InputFilesetSpec('primary', 'nifti_gz_format'),
+        FilesetSpec('brain', 'nifti_gz_format', 'brain_pipeline')]
+"""
+
+
+class TestAnalysisRegistry(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pkg_name = 'registry_test_pkg'
+        pkg_dir = op.join(self.tmp_dir, self.pkg_name)
+        os.makedirs(op.join(pkg_dir, 'sub'))
+        with open(op.join(pkg_dir, '__init__.py'), 'w') as f:
+            f.write('')
+        with open(op.join(pkg_dir, 'sub', '__init__.py'), 'w') as f:
+            f.write('from .derived import DerivedAnalysis\n')
+        with open(op.join(pkg_dir, 'sub', 'base.py'), 'w') as f:
+            f.write(BASE_MODULE)
+        self.derived_path = op.join(pkg_dir, 'sub', 'derived.py')
+        with open(self.derived_path, 'w') as f:
+            f.write(DERIVED_MODULE)
+        self.cache_path = op.join(self.tmp_dir, 'cache', 'registry.json')
+        sys.path.insert(0, self.tmp_dir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmp_dir)
+
+    def test_scan(self):
+        registry = AnalysisRegistry([self.pkg_name],
+                                    cache_path=self.cache_path)
+        classes = {c.name: c for c in registry.classes}
+        self.assertEqual(sorted(classes), ['BaseAnalysis', 'DerivedAnalysis'])
+        derived = classes['DerivedAnalysis']
+        self.assertEqual(derived.module, self.pkg_name + '.sub.derived')
+        self.assertEqual(derived.desc,
+                         "An analysis that is derived from another")
+        self.assertEqual(derived.data_specs, ['primary', 'brain'])
+        self.assertEqual(classes['BaseAnalysis'].param_specs, ['threshold'])
+        self.assertIsNone(classes['BaseAnalysis'].desc)
+        # Classes can be found from the packages that import them
+        self.assertEqual(
+            registry.find(self.pkg_name + '.sub.DerivedAnalysis'), [derived])
+        # The analysis modules aren't imported
+        self.assertNotIn(self.pkg_name + '.sub.derived', sys.modules)
+
+    def test_cache(self):
+        AnalysisRegistry([self.pkg_name],
+                         cache_path=self.cache_path).classes
+        self.assertTrue(op.exists(self.cache_path))
+        with open(self.derived_path, 'a') as f:
+            f.write('\n\nclass AnotherAnalysis(DerivedAnalysis):\n\n'
+                    '    desc = "Another"\n')
+        classes = AnalysisRegistry([self.pkg_name],
+                                   cache_path=self.cache_path).classes
+        self.assertIn('AnotherAnalysis', [c.name for c in classes])
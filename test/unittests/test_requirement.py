@@ -1,8 +1,14 @@
+import os
+import os.path as op
+import stat
+import tempfile
 from unittest import TestCase
 from arcana.environment import BaseRequirement
 from arcana.exceptions import (
     ArcanaRequirementNotFoundError, ArcanaVersionNotDetectableError)
 from banana.utils.testing import TEST_ENV
+from banana.requirement import (
+    CachedCliRequirement, requirement_cache, REQUIREMENT_CACHE_ENV)
 import banana.requirement
 
 
@@ -35,3 +41,62 @@ class TestRequirement(TestCase):
             push_deps(requirement)
 
             TEST_ENV.satisfy(*to_load)
+
+
+FAKE_CMD = """#!/bin/sh
+echo called >> {log}
+echo "fakecmd version 1.2.3"
+"""
+
+
+class TestRequirementCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = op.join(self.tmp_dir, 'calls.log')
+        self.cmd_path = op.join(self.tmp_dir, 'bin', 'fakecmd')
+        os.makedirs(op.dirname(self.cmd_path))
+        with open(self.cmd_path, 'w') as f:
+            f.write(FAKE_CMD.format(log=self.log_path))
+        os.chmod(self.cmd_path, stat.S_IRWXU)
+        self.orig_env = {k: os.environ.get(k)
+                         for k in ('PATH', REQUIREMENT_CACHE_ENV)}
+        os.environ['PATH'] = (op.dirname(self.cmd_path) + os.pathsep
+                              + os.environ['PATH'])
+        os.environ[REQUIREMENT_CACHE_ENV] = op.join(self.tmp_dir, 'cache',
+                                                    'requirements.json')
+        banana.requirement._requirement_cache = None
+
+    def tearDown(self):
+        for key, value in self.orig_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        banana.requirement._requirement_cache = None
+
+    @property
+    def num_calls(self):
+        if not op.exists(self.log_path):
+            return 0
+        with open(self.log_path) as f:
+            return len(f.readlines())
+
+    def test_cache(self):
+        req = CachedCliRequirement('fakecmd', test_cmd='fakecmd')
+        self.assertEqual(req.detect_version().sequence[:3], (1, 2, 3))
+        self.assertEqual(req.detect_version().sequence[:3], (1, 2, 3))
+        self.assertEqual(self.num_calls, 1)
+        # The cache persists between processes
+        banana.requirement._requirement_cache = None
+        req.detect_version()
+        self.assertEqual(self.num_calls, 1)
+        # Modifying the executable invalidates its entry
+        with open(self.cmd_path, 'a') as f:
+            f.write('\n')
+        req.detect_version()
+        self.assertEqual(self.num_calls, 2)
+        # As does explicitly clearing the cache
+        requirement_cache().clear()
+        req.detect_version()
+        self.assertEqual(self.num_calls, 3)
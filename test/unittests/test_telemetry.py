@@ -0,0 +1,81 @@
+import os.path as op
+import json
+import tempfile
+from unittest import TestCase
+from nipype.interfaces.utility import Function
+from banana.utils.history import RunHistory
+from banana.utils.telemetry import (
+    ProfiledStaticEnv, read_profile, summarise_profile, history_records,
+    format_profile_summary)
+
+
+def busy(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def make_record(node, wall_time, cpu_time, status='ok', start=0.0):
+    return {'pipeline': 'brain_extraction_pipeline', 'node': node,
+            'interface': 'BET', 'iterables': 'subject_id=01', 'host': 'host',
+            'pid': 1, 'start': start, 'wall_time': wall_time,
+            'cpu_time': cpu_time, 'subprocess_time': 0.0,
+            'peak_rss_gb': wall_time / 100.0, 'read_bytes': 512,
+            'write_bytes': 1024, 'n_procs': 1, 'status': status}
+
+
+class TestTelemetry(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.profile_path = op.join(self.tmp_dir, 'profile.jsonl')
+
+    def test_profiled_node(self):
+        env = ProfiledStaticEnv(self.profile_path)
+        node = env.node_types['base'](
+            env, Function(input_names=['n'], output_names=['total'],
+                          function=busy),
+            name='busy', base_dir=self.tmp_dir, wall_time=1)
+        node._hierarchy = 'workflow.busy_pipeline'
+        node.inputs.n = 100000
+        node.run()
+        records = read_profile(self.profile_path)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['pipeline'], 'busy_pipeline')
+        self.assertEqual(record['node'], 'busy')
+        self.assertEqual(record['interface'], 'Function')
+        self.assertEqual(record['status'], 'ok')
+        self.assertGreater(record['wall_time'], 0.0)
+        self.assertGreater(record['peak_rss_gb'], 0.0)
+
+    def test_summary(self):
+        records = [make_record('bet', 10.0, 9.0, start=1.0),
+                   make_record('bias_correct', 30.0, 3.0, start=2.0),
+                   make_record('bet', 5.0, 0.0, status='failed', start=3.0)]
+        summary = summarise_profile(records)
+        self.assertEqual(list(summary), ['brain_extraction_pipeline'])
+        pipeline = summary['brain_extraction_pipeline']
+        self.assertEqual(pipeline['nodes'], 3)
+        self.assertEqual(pipeline['failed'], 1)
+        self.assertEqual(pipeline['cpu_bound'], 1)
+        self.assertAlmostEqual(pipeline['wall_time'], 45.0)
+        self.assertAlmostEqual(pipeline['peak_rss_gb'], 0.3)
+        self.assertAlmostEqual(pipeline['cpu_utilisation'], 12.0 / 45.0)
+        self.assertIn('brain_extraction_pipeline',
+                      format_profile_summary(summary))
+        # Only successful runs are added to the history, once each
+        history = RunHistory(op.join(self.tmp_dir, 'history.jsonl'))
+        self.assertEqual(
+            history.add(history_records(records, self.profile_path)), 2)
+        self.assertEqual(
+            history.add(history_records(records, self.profile_path)), 0)
+        estimate = history.estimate('brain_extraction_pipeline', 'bet')
+        self.assertAlmostEqual(estimate.wall_time, 10.0 / 60)
+
+    def test_truncated(self):
+        with open(self.profile_path, 'w') as f:
+            f.write(json.dumps(make_record('bet', 10.0, 9.0)) + '\n')
+            f.write('{"pipeline": "brain_extr')
+        self.assertEqual(len(read_profile(self.profile_path)), 1)